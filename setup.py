@@ -29,15 +29,21 @@ CLASSIFIERS = [
 extension = setuptools.Extension("_sam_module",
                                  sources=["src/extensions/sammodule.cpp",
                                           "src/extensions/helper.cpp", "src/extensions/sambamparser.cpp",
-                                          "src/extensions/utilities.cpp", "src/extensions/types.cpp"],
-                                 depends=["helper.h", "sambamparser.h", "types.h", "utilities.h"],
+                                          "src/extensions/utilities.cpp", "src/extensions/types.cpp",
+                                          "src/extensions/accumulator.cpp", "src/extensions/bgzf.cpp",
+                                          "src/extensions/readtable.cpp", "src/extensions/bamindex.cpp"],
+                                 depends=["helper.h", "sambamparser.h", "types.h", "utilities.h", "accumulator.h",
+                                          "bgzf.h", "readtable.h", "bamindex.h"],
                                  include_dirs=["src/include/"],
+                                 libraries=["z"],
                                  language="c++",
                                  extra_compile_args=[
                                      "-Wno-unused-result",
                                      "-Wno-cpp",
                                      "-Wno-unused-function",
-                                 ]
+                                     "-pthread",
+                                 ],
+                                 extra_link_args=["-pthread"]
                                  )
 
 
@@ -55,7 +61,7 @@ SETUP_METADATA = \
         "packages": setuptools.find_packages('src', exclude=["tests"]),
         "include_package_data": True,
         "package_dir": {'samsum': 'src/samsum'},  # Necessary for proper importing
-        "package_data": {'tests': ["tests/test-data/*.sam"]},
+        "package_data": {'tests': ["tests/test-data/*.sam", "tests/test-data/*.bam"]},
         "py_modules": [os.path.splitext(os.path.basename(path))[0] for path in glob.glob('src/*.py')],
         "entry_points": {'console_scripts': ['samsum = samsum.__main__:main']},
         "classifiers": CLASSIFIERS,
@@ -0,0 +1,580 @@
+#include "accumulator.h"
+#include "sambamparser.h"
+
+using namespace std;
+
+
+unsigned long long merge_intervals(vector<pair<unsigned int, unsigned int> > &intervals) {
+    /* Parameters:
+      * intervals: A vector of [start, end) coordinate pairs
+     * Functionality:
+      * Sorts the intervals by their start position and merges overlapping and abutting intervals in place,
+      leaving only disjoint intervals in the vector.
+      * Returns the number of positions covered by the merged intervals.
+    */
+    unsigned long long covered = 0;
+    if (intervals.empty())
+        return covered;
+
+    sort(intervals.begin(), intervals.end());
+    size_t n = 0;
+    for (size_t i = 1; i < intervals.size(); i++) {
+        if (intervals[i].first <= intervals[n].second) {
+            if (intervals[i].second > intervals[n].second)
+                intervals[n].second = intervals[i].second;
+        }
+        else
+            intervals[++n] = intervals[i];
+    }
+    intervals.resize(n + 1);
+
+    for (size_t i = 0; i < intervals.size(); i++)
+        covered += intervals[i].second - intervals[i].first;
+    return covered;
+}
+
+
+CoverageAccumulator::CoverageAccumulator(bool multireads, int min_aln, unsigned int min_map_qual) {
+    /* Parameters:
+      * multireads: Boolean flag indicating whether secondary and supplementary alignments are used
+      * min_aln: The minimum percentage of a read's length that must be aligned for it to be included
+      * min_map_qual: The minimum mapping quality for an alignment to be included
+     * Functionality:
+      * Constructor for the CoverageAccumulator class, which sums alignment statistics for each reference sequence
+      as alignments are parsed so that no record needs to be stored.
+    */
+    this->multireads = multireads;
+    this->min_aln = min_aln;
+    this->min_map_qual = min_map_qual;
+    this->num_unmapped = 0;
+    this->num_paired = 0;
+    this->num_unpaired = 0;
+    this->num_multi_records = 0;
+    this->columns = NULL;
+    this->grouped = false;
+    this->coordinate_sorted = false;
+    this->out_of_order = false;
+    this->current_ref = UNMAPPED_DEST;
+    this->flushed_columns = 0;
+    this->flushed_unmapped_weight = 0.0;
+    this->flushed_reads = 0;
+    this->flushed_multi = 0;
+    this->flushed_singletons = 0;
+    this->flushed_secondary = 0;
+    this->track_order = false;
+    this->num_added = 0;
+}
+
+
+unsigned int CoverageAccumulator::get_ref_index(const char *ref_name, int ref_id) {
+    /* Parameters:
+      * ref_name: Name of a reference sequence
+      * ref_id: The parser's index of the reference sequence, or -1 if it isn't known
+     * Functionality:
+      * Returns the index of the reference sequence in ref_names and refs, creating a new REFSTAT if necessary.
+      * Reference sequences are numbered in the order they are first seen. If ref_id is given the index is cached in
+      ref_slots, so the name is only looked up the first time.
+    */
+    if (ref_id >= 0 && static_cast<size_t>(ref_id) < this->ref_slots.size() && this->ref_slots[ref_id] >= 0)
+        return this->ref_slots[ref_id];
+    unsigned int i = this->find_ref_index(ref_name);
+    if (ref_id >= 0) {
+        if (static_cast<size_t>(ref_id) >= this->ref_slots.size())
+            this->ref_slots.resize(ref_id + 1, -1);
+        this->ref_slots[ref_id] = i;
+    }
+    return i;
+}
+
+
+unsigned int CoverageAccumulator::find_ref_index(const char *ref_name) {
+    /* Parameters:
+      * ref_name: Name of a reference sequence
+     * Functionality:
+      * Returns the index of the reference sequence in ref_names and refs, looked up by name in ref_index, creating a
+      new REFSTAT if necessary.
+    */
+    map<std::string, unsigned int>::iterator it = this->ref_index.find(ref_name);
+    if (it != this->ref_index.end())
+        return it->second;
+
+    REFSTAT ref;
+    ref.reads_mapped = 0;
+    ref.bases_mapped = 0;
+    ref.leftmost = UINT_MAX;
+    ref.rightmost = 0;
+    ref.merged = 0;
+    ref.covered = 0;
+    ref.closed = false;
+
+    unsigned int i = this->refs.size();
+    this->refs.push_back(ref);
+    this->ref_names.push_back(ref_name);
+    this->ref_index[ref_name] = i;
+    return i;
+}
+
+
+void CoverageAccumulator::add_alignment(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: An ALIGNMENT with a reference sequence name, populated by one of the MatchOutputParser classes
+     * Functionality:
+      * Secondary and supplementary alignments are dropped unless multireads is true, as are unmapped reads.
+      * The alignment is counted towards its read's alignment multiplicity and its destination is recorded so its
+      weight can be summed by finalize() once the multiplicity of every read is known.
+      * Alignments that fall below the mapping quality or aligned percentage thresholds have their weight redirected
+      to the unmapped fragments. All others are added to their reference sequence's statistics, and to columns
+      if it has been set.
+      * If grouped is true all alignments of a read are expected to be adjacent, so the previous read is weighed and
+      forgotten by flush_group() as soon as an alignment of a different read is added.
+      * If coordinate_sorted is true the previous reference sequence is closed once an alignment to another one is
+      added. Unless multireads or grouped are also true, alignments are weighed from their flags by weigh_by_flags()
+      instead of being added to the reads table.
+    */
+    if (aln.multi)
+        this->num_multi_records++;
+    if (aln.multi && !this->multireads)
+        return;
+    if (!aln.mapped)
+        return;
+
+    if (aln.paired)
+        this->num_paired++;
+    else
+        this->num_unpaired++;
+
+    // The end and read length were decoded from the CIGAR by the parser
+    unsigned int aln_len = aln.end - aln.start;
+    int dest = UNMAPPED_DEST;
+    if (aln.mq >= this->min_map_qual && aln.read_length > 0 &&
+        100.0 * aln_len / aln.read_length >= this->min_aln) {
+        dest = this->get_ref_index(aln.subject, aln.ref_id);
+        if (this->coordinate_sorted && dest != this->current_ref) {
+            if (this->refs[dest].closed)
+                this->out_of_order = true;
+            this->close_reference(this->current_ref);
+            this->current_ref = dest;
+        }
+        REFSTAT &ref = this->refs[dest];
+        ref.reads_mapped++;
+        ref.bases_mapped += aln_len;
+        if (aln.start < ref.leftmost)
+            ref.leftmost = aln.start;
+        if (aln.end > ref.rightmost)
+            ref.rightmost = aln.end;
+        // Alignments that start within the last interval extend it, which is always the case for sorted input
+        if (!ref.intervals.empty() && aln.start >= ref.intervals.back().first &&
+            aln.start <= ref.intervals.back().second) {
+            if (aln.end > ref.intervals.back().second)
+                ref.intervals.back().second = aln.end;
+        }
+        else
+            ref.intervals.push_back(make_pair(aln.start, aln.end));
+        if (ref.intervals.size() >= 2*ref.merged + 1024) {
+            merge_intervals(ref.intervals);
+            ref.merged = ref.intervals.size();
+        }
+    }
+
+    if (this->columns && dest != UNMAPPED_DEST) {
+        this->columns->ref_id.push_back(dest);
+        this->columns->start.push_back(aln.start);
+        this->columns->end.push_back(aln.end);
+        this->columns->mapq.push_back(aln.mq);
+        this->columns->read_length.push_back(aln.read_length);
+    }
+
+    if (this->coordinate_sorted && !this->grouped && !this->multireads) {
+        this->weigh_by_flags(aln, dest);
+        return;
+    }
+
+    if (this->grouped && this->group_name != aln.query) {
+        this->flush_group();
+        this->group_name.assign(aln.query);
+    }
+
+    READSTAT initial;
+    initial.pair.first = false;
+    initial.pair.second = false;
+    initial.pair.third = 0;
+    initial.pair.fourth = 0;
+    initial.fwd_dest = UNMAPPED_DEST;
+    initial.rev_dest = UNMAPPED_DEST;
+    size_t entry_i;
+    READSTAT &rs = this->reads.insert(aln.query, initial, &entry_i);
+
+    unsigned int n;
+    if (!aln.parity) {
+        rs.pair.first = true;  // This is a forward read
+        n = ++rs.pair.third;
+        if (n == 1)
+            rs.fwd_dest = dest;
+    }
+    else {
+        rs.pair.second = true;  // This is a reverse read
+        n = ++rs.pair.fourth;
+        if (n == 1)
+            rs.rev_dest = dest;
+    }
+
+    if (this->columns && dest != UNMAPPED_DEST) {
+        this->columns->reads.push_back(&rs);
+        this->columns->parities.push_back(aln.parity);
+        if (this->track_order)
+            this->column_entry.push_back(entry_i);
+    }
+
+    if (n > 1) {
+        EXTRA_DEST extra_dest;
+        extra_dest.read = &rs;
+        extra_dest.parity = aln.parity;
+        extra_dest.dest = dest;
+        this->extra.push_back(extra_dest);
+        if (this->track_order) {
+            this->extra_order.push_back(this->num_added);
+            this->extra_entry.push_back(entry_i);
+        }
+    }
+    else if (this->track_order) {
+        if (this->first_order.size() < 2*this->reads.size())
+            this->first_order.resize(2*this->reads.size(), 0);
+        this->first_order[2*entry_i + aln.parity] = this->num_added;
+    }
+    this->num_added++;
+}
+
+
+void CoverageAccumulator::merge(CoverageAccumulator &other) {
+    /* Parameters:
+      * other: A CoverageAccumulator with track_order set, that the alignments following those of this one were added to
+     * Functionality:
+      * Adds the alignments of other to this accumulator as if they had been added to it directly, so that the byte
+      ranges of an alignment file can be parsed in parallel and the results are identical to parsing it serially.
+      * The reference sequences of other are looked up by name and their statistics and intervals are combined.
+      * The reads of other are looked up in the reads table by their hash and name, and their alignment counts added,
+      before any weights are calculated. A read's first alignment in other becomes one of its extra destinations if
+      it already had an alignment of the same parity, and the extra destinations are appended in the order they
+      were added to other so the weights are summed in the same order as they would have been serially.
+      * Only used for accumulators where neither grouped nor coordinate_sorted are set; other is cleared.
+    */
+    vector<int> ref_map(other.refs.size());
+    for (size_t i = 0; i < other.refs.size(); i++) {
+        ref_map[i] = this->get_ref_index(other.ref_names[i].c_str());
+        REFSTAT &ref = this->refs[ref_map[i]];
+        REFSTAT &other_ref = other.refs[i];
+        ref.reads_mapped += other_ref.reads_mapped;
+        ref.bases_mapped += other_ref.bases_mapped;
+        if (other_ref.leftmost < ref.leftmost)
+            ref.leftmost = other_ref.leftmost;
+        if (other_ref.rightmost > ref.rightmost)
+            ref.rightmost = other_ref.rightmost;
+        ref.intervals.insert(ref.intervals.end(), other_ref.intervals.begin(), other_ref.intervals.end());
+        vector<pair<unsigned int, unsigned int> >().swap(other_ref.intervals);
+        if (ref.intervals.size() >= 2*ref.merged + 1024) {
+            merge_intervals(ref.intervals);
+            ref.merged = ref.intervals.size();
+        }
+    }
+    this->num_unmapped += other.num_unmapped;
+    this->num_paired += other.num_paired;
+    this->num_unpaired += other.num_unpaired;
+    this->num_multi_records += other.num_multi_records;
+
+    READSTAT initial;
+    initial.pair.first = false;
+    initial.pair.second = false;
+    initial.pair.third = 0;
+    initial.pair.fourth = 0;
+    initial.fwd_dest = UNMAPPED_DEST;
+    initial.rev_dest = UNMAPPED_DEST;
+    vector<READSTAT *> merged(other.reads.size());
+    vector<pair<uint64_t, EXTRA_DEST> > pending;
+    for (size_t n = 0; n < other.reads.size(); n++) {
+        READ_ENTRY<READSTAT> &entry = other.reads.entries[n];
+        READSTAT &other_rs = entry.value;
+        READSTAT &rs = this->reads.insert_hashed(entry.hash, entry.name, initial);
+        int dests[2] = {other_rs.fwd_dest, other_rs.rev_dest};
+        unsigned int counts[2] = {other_rs.pair.third, other_rs.pair.fourth};
+        for (int parity = 0; parity < 2; parity++) {
+            if (counts[parity] == 0)
+                continue;
+            int dest = dests[parity] == UNMAPPED_DEST ? UNMAPPED_DEST : ref_map[dests[parity]];
+            unsigned int &count = parity ? rs.pair.fourth : rs.pair.third;
+            if (count == 0)
+                (parity ? rs.rev_dest : rs.fwd_dest) = dest;
+            else {
+                EXTRA_DEST extra_dest;
+                extra_dest.read = &rs;
+                extra_dest.parity = parity;
+                extra_dest.dest = dest;
+                pending.push_back(make_pair(other.first_order[2*n + parity], extra_dest));
+            }
+            count += counts[parity];
+        }
+        rs.pair.first = rs.pair.first || other_rs.pair.first;
+        rs.pair.second = rs.pair.second || other_rs.pair.second;
+        merged[n] = &rs;
+    }
+
+    for (size_t j = 0; j < other.extra.size(); j++) {
+        EXTRA_DEST extra_dest = other.extra[j];
+        extra_dest.read = merged[other.extra_entry[j]];
+        if (extra_dest.dest != UNMAPPED_DEST)
+            extra_dest.dest = ref_map[extra_dest.dest];
+        pending.push_back(make_pair(other.extra_order[j], extra_dest));
+    }
+    sort(pending.begin(), pending.end(),
+         [](const pair<uint64_t, EXTRA_DEST> &a, const pair<uint64_t, EXTRA_DEST> &b) { return a.first < b.first; });
+    for (size_t j = 0; j < pending.size(); j++)
+        this->extra.push_back(pending[j].second);
+
+    if (this->columns && other.columns) {
+        ALIGNMENT_COLUMNS &cols = *this->columns;
+        ALIGNMENT_COLUMNS &other_cols = *other.columns;
+        for (size_t k = 0; k < other_cols.ref_id.size(); k++) {
+            cols.ref_id.push_back(ref_map[other_cols.ref_id[k]]);
+            cols.reads.push_back(merged[other.column_entry[k]]);
+        }
+        cols.start.insert(cols.start.end(), other_cols.start.begin(), other_cols.start.end());
+        cols.end.insert(cols.end.end(), other_cols.end.begin(), other_cols.end.end());
+        cols.mapq.insert(cols.mapq.end(), other_cols.mapq.begin(), other_cols.mapq.end());
+        cols.read_length.insert(cols.read_length.end(), other_cols.read_length.begin(), other_cols.read_length.end());
+        cols.parities.insert(cols.parities.end(), other_cols.parities.begin(), other_cols.parities.end());
+    }
+    other.reads.clear();
+    other.extra.clear();
+}
+
+
+void CoverageAccumulator::sum_read_weights(vector<double> &weights, double &unmapped_weight) {
+    /* Parameters:
+      * weights: A vector with an element for each reference sequence in refs that the fragment weights are added to
+      * unmapped_weight: Reference to a double that the weight of alignments redirected to the unmapped fragments
+      is added to
+     * Functionality:
+      * Calculates the weight of every alignment in reads and extra from its read's multiplicity, as in
+      assign_read_weights, and sums them by their destination.
+    */
+    for (deque<READ_ENTRY<READSTAT> >::iterator it = this->reads.entries.begin(); it != this->reads.entries.end(); ++it) {
+        READSTAT &rs = it->value;
+        if (rs.pair.third > 0) {
+            float w = calculate_weight(0, rs.pair);
+            if (rs.fwd_dest == UNMAPPED_DEST) unmapped_weight += w;
+            else weights[rs.fwd_dest] += w;
+        }
+        if (rs.pair.fourth > 0) {
+            float w = calculate_weight(1, rs.pair);
+            if (rs.rev_dest == UNMAPPED_DEST) unmapped_weight += w;
+            else weights[rs.rev_dest] += w;
+        }
+    }
+
+    for (vector<EXTRA_DEST>::iterator it = this->extra.begin(); it != this->extra.end(); ++it) {
+        float w = calculate_weight(it->parity, it->read->pair);
+        if (it->dest == UNMAPPED_DEST) unmapped_weight += w;
+        else weights[it->dest] += w;
+    }
+}
+
+
+void CoverageAccumulator::weigh_columns(size_t start) {
+    /* Parameters:
+      * start: Index of the first alignment in columns that hasn't been weighed
+     * Functionality:
+      * Calculates the weight of the alignments in columns from start onwards from their read's multiplicity.
+    */
+    ALIGNMENT_COLUMNS &cols = *this->columns;
+    cols.weight.resize(cols.ref_id.size());
+    for (size_t i = start; i < cols.reads.size(); i++)
+        cols.weight[i] = calculate_weight(cols.parities[i], cols.reads[i]->pair);
+}
+
+
+void CoverageAccumulator::flush_group() {
+    /*
+      * Used for name-grouped input once every alignment of the reads in the reads table has been added.
+      * The weights of the reads' alignments are summed into flushed_weights and flushed_unmapped_weight and the reads are
+      counted as identify_multireads would, before the reads table is cleared. Memory is therefore proportional to
+      the number of alignments of a single read rather than the number of reads.
+    */
+    if (this->reads.size() == 0)
+        return;
+    this->flushed_weights.resize(this->refs.size(), 0.0);
+    this->sum_read_weights(this->flushed_weights, this->flushed_unmapped_weight);
+    this->flushed_secondary += this->count_multireads(this->flushed_multi, this->flushed_singletons);
+    this->flushed_reads += this->reads.size();
+    if (this->columns) {
+        this->weigh_columns(this->flushed_columns);
+        this->flushed_columns = this->columns->reads.size();
+    }
+    this->reads.clear();
+    this->extra.clear();
+}
+
+
+void CoverageAccumulator::close_reference(int ref_i) {
+    /* Parameters:
+      * ref_i: Index of a reference sequence in refs, or UNMAPPED_DEST
+     * Functionality:
+      * Used for coordinate-sorted input once every alignment to the reference sequence has been added.
+      The alignment intervals are merged to find the number of positions covered and then freed.
+    */
+    if (ref_i == UNMAPPED_DEST)
+        return;
+    REFSTAT &ref = this->refs[ref_i];
+    ref.covered = merge_intervals(ref.intervals);
+    vector<pair<unsigned int, unsigned int> >().swap(ref.intervals);
+    ref.merged = 0;
+    ref.closed = true;
+}
+
+
+void CoverageAccumulator::weigh_by_flags(ALIGNMENT &aln, int dest) {
+    /* Parameters:
+      * aln: An ALIGNMENT that has passed the multireads filter
+      * dest: The destination of the alignment's weight, either a reference index or UNMAPPED_DEST
+     * Functionality:
+      * Used for coordinate-sorted input when secondary and supplementary alignments are dropped, so every read and
+      parity has a single alignment. The read's multiplicity then only depends on whether its mate mapped, which the
+      flags tell us, so the weight is summed immediately without adding the read to the reads table.
+      * Reads are counted once, by their forward alignment if both mates mapped.
+    */
+    bool both_mapped = aln.paired && !aln.singleton;
+    float w = both_mapped ? 0.5 : 1.0;
+    if (dest == UNMAPPED_DEST)
+        this->flushed_unmapped_weight += w;
+    else {
+        this->flushed_weights.resize(this->refs.size(), 0.0);
+        this->flushed_weights[dest] += w;
+        if (this->columns)
+            this->columns->weight.push_back(w);
+    }
+
+    if (!both_mapped) {
+        this->flushed_reads++;
+        this->flushed_singletons++;
+    }
+    else if (!aln.parity)
+        this->flushed_reads++;
+}
+
+
+void CoverageAccumulator::add_unmapped(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: An ALIGNMENT of a read that wasn't aligned to a reference sequence
+     * Functionality:
+      * Counts the unmapped read, along with whether it is paired, so that finalize() can tell paired- from single-end
+      libraries even if none of the reads were mapped, e.g. in a part of a file with only unmapped reads.
+    */
+    this->num_unmapped++;
+    if (aln.paired)
+        this->num_paired++;
+    else
+        this->num_unpaired++;
+}
+
+
+int CoverageAccumulator::finalize(vector<double> &weights, double &unmapped_weight) {
+    /* Parameters:
+      * weights: A vector that is populated with the sum of fragment weights for each reference sequence in refs
+      * unmapped_weight: Reference to a double that is set to the weight of all fragments that were not mapped
+     * Functionality:
+      * Calculates the weight of every alignment from its read's multiplicity, as in assign_read_weights, and sums
+      them by their destination. The weights of reads already flushed from name-grouped input are included.
+      * If the alignments are also being stored in columns, the weight of each alignment is stored as well.
+      * Returns 5 if a mixture of single- and paired-end reads were encountered, 6 if the input was expected to be
+      sorted by coordinate but a reference sequence's alignments weren't adjacent, 0 otherwise.
+    */
+    if (this->out_of_order)
+        return 6;
+    bool paired;
+    if (this->num_unpaired == 0)
+        paired = true;
+    else if (this->num_paired == 0)
+        paired = false;
+    else
+        return 5;
+
+    if (this->grouped)
+        this->flush_group();
+
+    weights.assign(this->refs.size(), 0.0);
+    for (size_t i = 0; i < this->flushed_weights.size(); i++)
+        weights[i] = this->flushed_weights[i];
+    unmapped_weight = paired ? this->num_unmapped*0.5 : this->num_unmapped;
+    unmapped_weight += this->flushed_unmapped_weight;
+
+    this->sum_read_weights(weights, unmapped_weight);
+
+    if (this->columns) {
+        this->weigh_columns(this->flushed_columns);
+        vector<READSTAT *>().swap(this->columns->reads);
+        vector<bool>().swap(this->columns->parities);
+    }
+    return 0;
+}
+
+
+long CoverageAccumulator::count_multireads(unsigned long &multi, unsigned long &num_singletons) {
+    /* Parameters:
+      * multi: Reference to the number of multireads, incremented for each read with multiple alignments
+      * num_singletons: Reference to the number of orphan reads, incremented for each read whose mate didn't map
+     * Functionality:
+      * Counts the multireads, orphans and secondary hits in the reads table.
+      * Returns the number of secondary hits.
+    */
+    long num_secondary_hits = 0;
+    for (deque<READ_ENTRY<READSTAT> >::iterator it = this->reads.entries.begin(); it != this->reads.entries.end(); ++it) {
+        struct QUADRUPLE<bool, bool, unsigned int, unsigned int> &pair = it->value.pair;
+        if( !(pair.first && pair.second) )
+            num_singletons++;
+        if( pair.third > 1) {
+            multi++;
+            num_secondary_hits += pair.third-1;
+        }
+        if( pair.fourth > 1) {
+            multi++;
+            num_secondary_hits += pair.fourth-1;
+        }
+    }
+    return num_secondary_hits;
+}
+
+
+long CoverageAccumulator::identify_multireads(unsigned long &multi, unsigned long &num_singletons) {
+    /* Parameters:
+      * multi: Reference to the number of multireads, incremented for each read with multiple alignments
+      * num_singletons: Reference to the number of orphan reads, incremented for each read whose mate didn't map
+     * Functionality:
+      * Counts the multireads, orphans and secondary hits as the function of the same name does for reads_dict,
+      including those of reads already flushed from name-grouped input.
+      * Returns the number of secondary hits.
+    */
+    multi += this->flushed_multi;
+    num_singletons += this->flushed_singletons;
+    return this->flushed_secondary + this->count_multireads(multi, num_singletons);
+}
+
+
+unsigned long CoverageAccumulator::num_reads() {
+    /*
+      * Returns the number of distinct reads that were added, including those already flushed from name-grouped input.
+    */
+    return this->flushed_reads + this->reads.size();
+}
+
+
+unsigned long long CoverageAccumulator::bases_covered(unsigned int ref_i) {
+    /* Parameters:
+      * ref_i: Index of a reference sequence in refs
+     * Functionality:
+      * Merges the alignment intervals of the reference sequence and returns the number of positions covered.
+    */
+    REFSTAT &ref = this->refs[ref_i];
+    if (ref.closed)
+        return ref.covered;
+    unsigned long long covered = merge_intervals(ref.intervals);
+    ref.merged = ref.intervals.size();
+    return covered;
+}
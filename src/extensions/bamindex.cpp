@@ -0,0 +1,222 @@
+#include <algorithm>
+#include "bamindex.h"
+
+using namespace std;
+
+
+static bool read_bytes(const vector<char> &buf, size_t &pos, void *dst, size_t n) {
+    /* Parameters:
+      * buf: The uncompressed contents of an index file
+      * pos: The position in buf to read from, advanced by n
+      * dst: A buffer of at least n bytes
+     * Functionality:
+      * Copies the next n bytes of buf into dst. Returns false if buf is too short.
+    */
+    if (pos + n > buf.size())
+        return false;
+    memcpy(dst, &buf[pos], n);
+    pos += n;
+    return true;
+}
+
+
+void merge_chunks(vector<BAM_CHUNK> &chunks) {
+    /* Parameters:
+      * chunks: A vector of BAM_CHUNKs
+     * Functionality:
+      * Sorts the chunks by their start and merges overlapping and abutting chunks in place, so every record is
+      only read once when the chunks are read in order.
+    */
+    if (chunks.empty())
+        return;
+    sort(chunks.begin(), chunks.end(),
+         [](const BAM_CHUNK &a, const BAM_CHUNK &b) { return a.beg < b.beg; });
+    size_t n = 0;
+    for (size_t i = 1; i < chunks.size(); i++) {
+        if (chunks[i].beg <= chunks[n].end) {
+            if (chunks[i].end > chunks[n].end)
+                chunks[n].end = chunks[i].end;
+        }
+        else
+            chunks[++n] = chunks[i];
+    }
+    chunks.resize(n + 1);
+}
+
+
+BamIndex::BamIndex() {
+    this->min_shift = 14;
+    this->depth = 5;
+    this->n_no_coor = 0;
+}
+
+
+uint32_t BamIndex::meta_bin() {
+    /*
+      * Returns the number of the pseudo-bin that stores the metadata of each reference sequence: one more than the
+      largest bin for the index's depth (37450 for BAI).
+    */
+    return ((1 << (this->depth*3 + 3)) - 1) / 7 + 1;
+}
+
+
+int BamIndex::load(const std::string &filename) {
+    /* Parameters:
+      * filename: Path to a BAI or CSI index. CSI indices are BGZF-compressed while BAI indices are not.
+     * Functionality:
+      * Reads the bins, chunks and metadata of every reference sequence in the index.
+      * Returns 0 on success, 1 if the index could not be read.
+    */
+    this->filename = filename;
+    vector<char> buf;
+    if (is_bgzf(filename)) {
+        BgzfReader bgzf(filename);
+        char block[BGZF_MAX_BLOCK_SIZE];
+        size_t n;
+        while ((n = bgzf.read(block, BGZF_MAX_BLOCK_SIZE)) > 0)
+            buf.insert(buf.end(), block, block + n);
+        if (bgzf.failed)
+            return 1;
+    }
+    else {
+        std::ifstream input(filename.c_str(), std::ifstream::in | std::ifstream::binary);
+        if (!input.good())
+            return 1;
+        buf.assign(std::istreambuf_iterator<char>(input), std::istreambuf_iterator<char>());
+    }
+
+    size_t pos = 4;
+    bool csi;
+    if (buf.size() >= 4 && memcmp(&buf[0], "BAI\1", 4) == 0)
+        csi = false;
+    else if (buf.size() >= 4 && memcmp(&buf[0], "CSI\1", 4) == 0)
+        csi = true;
+    else
+        return 1;
+
+    if (csi) {
+        int32_t l_aux;
+        if (!read_bytes(buf, pos, &this->min_shift, 4) || !read_bytes(buf, pos, &this->depth, 4) ||
+            !read_bytes(buf, pos, &l_aux, 4))
+            return 1;
+        pos += l_aux;
+    }
+
+    int32_t n_ref;
+    if (!read_bytes(buf, pos, &n_ref, 4) || n_ref < 0)
+        return 1;
+    uint32_t meta = this->meta_bin();
+    this->refs.assign(n_ref, INDEX_REF());
+    for (int32_t r = 0; r < n_ref; r++) {
+        INDEX_REF &ref = this->refs[r];
+        ref.n_mapped = 0;
+        ref.n_unmapped = 0;
+        int32_t n_bin;
+        if (!read_bytes(buf, pos, &n_bin, 4))
+            return 1;
+        for (int32_t b = 0; b < n_bin; b++) {
+            uint32_t bin;
+            uint64_t loffset = 0;
+            int32_t n_chunk;
+            if (!read_bytes(buf, pos, &bin, 4) || (csi && !read_bytes(buf, pos, &loffset, 8)) ||
+                !read_bytes(buf, pos, &n_chunk, 4))
+                return 1;
+            vector<BAM_CHUNK> chunks(n_chunk);
+            for (int32_t c = 0; c < n_chunk; c++) {
+                if (!read_bytes(buf, pos, &chunks[c].beg, 8) || !read_bytes(buf, pos, &chunks[c].end, 8))
+                    return 1;
+            }
+            if (bin == meta) {
+                // The second chunk of the metadata bin holds the number of mapped and unmapped records
+                if (n_chunk == 2) {
+                    ref.n_mapped = chunks[1].beg;
+                    ref.n_unmapped = chunks[1].end;
+                }
+                continue;
+            }
+            ref.bins[bin] = chunks;
+            if (csi)
+                ref.loffsets[bin] = loffset;
+        }
+        if (!csi) {
+            int32_t n_intv;
+            if (!read_bytes(buf, pos, &n_intv, 4) || n_intv < 0)
+                return 1;
+            ref.intervals.resize(n_intv);
+            for (int32_t i = 0; i < n_intv; i++) {
+                if (!read_bytes(buf, pos, &ref.intervals[i], 8))
+                    return 1;
+            }
+        }
+    }
+    // The number of unplaced, unmapped records is optional
+    if (!read_bytes(buf, pos, &this->n_no_coor, 8))
+        this->n_no_coor = 0;
+    return 0;
+}
+
+
+void BamIndex::query(int ref_id, uint32_t beg, uint32_t end, vector<BAM_CHUNK> &chunks) {
+    /* Parameters:
+      * ref_id: Index of a reference sequence in the BAM header
+      * beg: The 0-based start of the region
+      * end: The 0-based, exclusive end of the region
+      * chunks: A vector that the chunks which may contain records overlapping the region are appended to
+     * Functionality:
+      * Finds every bin that overlaps the region at each level of the binning scheme, as reg2bins() does in the SAM
+      specification, and appends their chunks. Chunks that end before the lowest offset of a record overlapping
+      the region's start, taken from the linear index or the bins' loffsets, are skipped.
+    */
+    if (ref_id < 0 || static_cast<size_t>(ref_id) >= this->refs.size() || end <= beg)
+        return;
+    INDEX_REF &ref = this->refs[ref_id];
+
+    uint64_t min_offset = 0;
+    if (!ref.intervals.empty()) {
+        size_t window = beg >> this->min_shift;
+        min_offset = ref.intervals[window < ref.intervals.size() ? window : ref.intervals.size() - 1];
+    }
+    else if (!ref.loffsets.empty()) {
+        // Use the lowest offset of the smallest bin containing the region's start that is in the index
+        int shift = this->min_shift;
+        uint32_t level_start = ((1 << (this->depth*3)) - 1) / 7;
+        for (int level = this->depth; level >= 0; level--) {
+            map<uint32_t, uint64_t>::iterator it = ref.loffsets.find(level_start + (beg >> shift));
+            if (it != ref.loffsets.end()) {
+                min_offset = it->second;
+                break;
+            }
+            shift += 3;
+            if (level > 0)
+                level_start -= 1 << ((level - 1)*3);
+        }
+    }
+
+    int shift = this->min_shift + this->depth*3;
+    uint32_t level_start = 0;
+    for (int level = 0; level <= this->depth; level++) {
+        uint32_t first = level_start + (beg >> shift);
+        uint32_t last = level_start + ((end - 1) >> shift);
+        for (map<uint32_t, vector<BAM_CHUNK> >::iterator it = ref.bins.lower_bound(first);
+             it != ref.bins.end() && it->first <= last; ++it) {
+            for (vector<BAM_CHUNK>::iterator chunk = it->second.begin(); chunk != it->second.end(); ++chunk) {
+                if (chunk->end > min_offset)
+                    chunks.push_back(*chunk);
+            }
+        }
+        level_start += 1 << (level*3);
+        shift -= 3;
+    }
+}
+
+
+uint64_t BamIndex::num_records() {
+    /*
+      * Returns the number of records in the BAM file according to the index: the mapped and placed-but-unmapped
+      records of every reference sequence and the unplaced, unmapped records.
+    */
+    uint64_t n = this->n_no_coor;
+    for (vector<INDEX_REF>::iterator it = this->refs.begin(); it != this->refs.end(); ++it)
+        n += it->n_mapped + it->n_unmapped;
+    return n;
+}
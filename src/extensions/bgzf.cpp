@@ -0,0 +1,309 @@
+#include "bgzf.h"
+
+using namespace std;
+
+
+bool is_bgzf(const std::string &filename) {
+    /* Parameters:
+      * filename: Path to an alignment file
+     * Functionality:
+      * Reads the magic bytes at the start of the file and returns true if it begins with a gzip header,
+      as BGZF-compressed BAM files do, or false otherwise (e.g. for a plain-text SAM file).
+    */
+    unsigned char magic[2] = {0, 0};
+    std::ifstream input(filename.c_str(), std::ifstream::in | std::ifstream::binary);
+    if (!input.good())
+        return false;
+    input.read(reinterpret_cast<char *>(magic), 2);
+    return input.gcount() == 2 && magic[0] == 31 && magic[1] == 139;
+}
+
+
+int inflate_block(const char *src, size_t src_len, char *dst, size_t dst_len) {
+    /* Parameters:
+      * src: The raw DEFLATE-compressed data of a BGZF block
+      * src_len: The number of compressed bytes in src
+      * dst: A buffer that is at least dst_len bytes, to be filled with the uncompressed data
+      * dst_len: The number of uncompressed bytes, taken from the ISIZE field of the BGZF block
+     * Functionality:
+      * Inflates a single BGZF block with zlib. Returns 0 on success, 1 otherwise.
+    */
+    z_stream zs;
+    zs.zalloc = Z_NULL;
+    zs.zfree = Z_NULL;
+    zs.opaque = Z_NULL;
+    zs.next_in = (Bytef *) src;
+    zs.avail_in = src_len;
+    zs.next_out = (Bytef *) dst;
+    zs.avail_out = dst_len;
+
+    if (inflateInit2(&zs, -15) != Z_OK)
+        return 1;
+    int status = inflate(&zs, Z_FINISH);
+    inflateEnd(&zs);
+    if (status != Z_STREAM_END || zs.total_out != dst_len)
+        return 1;
+    return 0;
+}
+
+
+int decompress_block(const vector<char> &block, vector<char> &data) {
+    /* Parameters:
+      * block: A complete BGZF block, including its header and footer, as read by BgzfReader::read_raw_block
+      * data: A vector that is resized and filled with the block's uncompressed data
+     * Functionality:
+      * Finds the compressed data and the uncompressed size in a BGZF block and inflates it into data.
+      * Returns 0 on success, 1 if the block could not be decompressed.
+    */
+    uint16_t xlen;
+    uint32_t isize;
+    memcpy(&xlen, &block[10], 2);
+    memcpy(&isize, &block[block.size() - 4], 4);
+
+    size_t cdata_start = 12 + xlen;
+    size_t cdata_len = block.size() - cdata_start - BGZF_FOOTER_SIZE;
+    data.resize(isize);
+    if (isize == 0)
+        return 0;
+    return inflate_block(&block[cdata_start], cdata_len, &data[0], isize);
+}
+
+
+BgzfReader::BgzfReader(const std::string &filename) {
+    /* Parameters:
+      * filename: Name of the BGZF-compressed (e.g. BAM) file to be read
+     * Functionality:
+      * Constructor for the BgzfReader class. Opens the file in binary mode.
+    */
+    this->filename = filename;
+    this->input.open(filename.c_str(), std::ifstream::in | std::ifstream::binary);
+    this->offset = 0;
+    this->block_address = 0;
+    this->n_threads = 1;
+    this->batch_i = 0;
+    this->failed = false;
+    this->compressed.reserve(BGZF_MAX_BLOCK_SIZE);
+    this->data.reserve(BGZF_MAX_BLOCK_SIZE);
+}
+
+BgzfReader::~BgzfReader() {
+    this->input.close();
+}
+
+bool BgzfReader::good() {
+    return this->input.good();
+}
+
+void BgzfReader::set_threads(unsigned int n_threads) {
+    /* Parameters:
+      * n_threads: The number of threads to decompress BGZF blocks with
+     * Functionality:
+      * When n_threads is greater than one, blocks are read in batches and decompressed in parallel by read_batch().
+    */
+    this->n_threads = n_threads > 0 ? n_threads : 1;
+}
+
+int BgzfReader::read_raw_block(vector<char> &block) {
+    /* Parameters:
+      * block: A vector that is filled with the complete BGZF block, including its header and footer
+     * Functionality:
+      * Reads the next BGZF block from the file without decompressing it.
+      The block size is found in the 'BC' sub-field of the gzip extra field.
+      * Returns 1 if a block was read, 0 at the end of the file and -1 if the block is malformed.
+    */
+    char header[12];
+    this->input.read(header, 12);
+    if (this->input.gcount() == 0)
+        return 0;
+    if (this->input.gcount() < 12 || (unsigned char) header[0] != 31 || (unsigned char) header[1] != 139 ||
+        (unsigned char) header[3] != 4)
+        return -1;
+
+    uint16_t xlen;
+    memcpy(&xlen, &header[10], 2);
+    block.resize(12 + xlen);
+    memcpy(&block[0], header, 12);
+    this->input.read(&block[12], xlen);
+    if (this->input.gcount() < xlen)
+        return -1;
+
+    // Search the extra sub-fields for the BGZF block size
+    long bsize = -1;
+    size_t i = 12;
+    while (i + 4 <= block.size()) {
+        uint16_t slen;
+        memcpy(&slen, &block[i+2], 2);
+        if (block[i] == 66 && block[i+1] == 67 && slen == 2) {
+            uint16_t bsize_minus_one;
+            memcpy(&bsize_minus_one, &block[i+4], 2);
+            bsize = bsize_minus_one + 1;
+        }
+        i += 4 + slen;
+    }
+    if (bsize < static_cast<long>(block.size() + BGZF_FOOTER_SIZE))
+        return -1;
+
+    size_t remaining = bsize - block.size();
+    block.resize(bsize);
+    this->input.read(&block[12 + xlen], remaining);
+    if (static_cast<size_t>(this->input.gcount()) < remaining)
+        return -1;
+    return 1;
+}
+
+void decompress_blocks(vector<vector<char> > &raw_batch, vector<vector<char> > &batch, size_t n_blocks,
+                       unsigned int thread_i, unsigned int n_threads, vector<int> &status) {
+    /* Parameters:
+      * raw_batch: A vector of complete BGZF blocks
+      * batch: A vector that is at least n_blocks long, populated with the uncompressed data of each block
+      * n_blocks: The number of blocks in raw_batch to decompress
+      * thread_i: The index of this thread; every n_threads-th block starting at thread_i is decompressed
+      * status: A vector where the return value of decompress_block() is stored for each block
+     * Functionality:
+      * The work done by a single thread in BgzfReader::read_batch().
+    */
+    for (size_t i = thread_i; i < n_blocks; i += n_threads)
+        status[i] = decompress_block(raw_batch[i], batch[i]);
+}
+
+size_t BgzfReader::read_batch() {
+    /*
+      * Reads the next BGZF_BLOCKS_PER_THREAD*n_threads blocks from the file and decompresses them in parallel.
+      * The blocks are kept in the order they were read so the uncompressed stream is identical to the one
+      produced by reading one block at a time.
+      * Returns the number of blocks that were successfully read and decompressed. If a block is malformed or
+      couldn't be decompressed, failed is set and the blocks before it are returned.
+    */
+    size_t max_blocks = BGZF_BLOCKS_PER_THREAD*this->n_threads;
+    size_t n_blocks = 0;
+    if (this->failed)
+        return 0;
+    this->raw_batch.resize(max_blocks);
+    this->batch.resize(max_blocks);
+    this->batch_addresses.resize(max_blocks);
+    while (n_blocks < max_blocks) {
+        this->batch_addresses[n_blocks] = this->input.tellg();
+        int status = this->read_raw_block(this->raw_batch[n_blocks]);
+        if (status < 0) {
+            std::cerr << "ERROR: Malformed or truncated BGZF block at offset " << this->batch_addresses[n_blocks];
+            std::cerr << " of '" << this->filename << "'." << std::endl;
+            this->failed = true;
+        }
+        if (status != 1)
+            break;
+        n_blocks++;
+    }
+
+    vector<int> status(n_blocks, 0);
+    vector<std::thread> threads;
+    unsigned int n_workers = n_blocks < this->n_threads ? n_blocks : this->n_threads;
+    for (unsigned int t = 0; t < n_workers; t++)
+        threads.push_back(std::thread(decompress_blocks, std::ref(this->raw_batch), std::ref(this->batch),
+                                      n_blocks, t, n_workers, std::ref(status)));
+    for (unsigned int t = 0; t < n_workers; t++)
+        threads[t].join();
+
+    for (size_t i = 0; i < n_blocks; i++) {
+        if (status[i] != 0) {
+            std::cerr << "ERROR: Unable to decompress BGZF block at offset " << this->batch_addresses[i];
+            std::cerr << " of '" << this->filename << "'." << std::endl;
+            this->failed = true;
+            n_blocks = i;
+            break;
+        }
+    }
+    this->batch.resize(n_blocks);
+    this->batch_i = 0;
+    return n_blocks;
+}
+
+bool BgzfReader::read_block() {
+    /*
+      * Reads and decompresses the next non-empty BGZF block into data.
+      * If more than one thread is used, the block is taken from the current batch, which is refilled when exhausted.
+      * Returns false at the end of the file or if a block is malformed or could not be decompressed, in which case
+      failed is set.
+    */
+    do {
+        if (this->n_threads > 1) {
+            if (this->batch_i >= this->batch.size() && this->read_batch() == 0)
+                return false;
+            this->block_address = this->batch_addresses[this->batch_i];
+            this->data.swap(this->batch[this->batch_i++]);
+        }
+        else {
+            if (this->failed)
+                return false;
+            this->block_address = this->input.tellg();
+            int status = this->read_raw_block(this->compressed);
+            if (status < 0) {
+                std::cerr << "ERROR: Malformed or truncated BGZF block at offset " << this->block_address;
+                std::cerr << " of '" << this->filename << "'." << std::endl;
+                this->failed = true;
+            }
+            if (status != 1)
+                return false;
+            if (decompress_block(this->compressed, this->data) != 0) {
+                std::cerr << "ERROR: Unable to decompress BGZF block at offset " << this->block_address;
+                std::cerr << " of '" << this->filename << "'." << std::endl;
+                this->failed = true;
+                return false;
+            }
+        }
+        this->offset = 0;
+    } while (this->data.empty());
+    return true;
+}
+
+size_t BgzfReader::read(void *dst, size_t n) {
+    /* Parameters:
+      * dst: A buffer to copy the uncompressed bytes into
+      * n: The number of bytes to read
+     * Functionality:
+      * Copies the next n uncompressed bytes into dst, reading new blocks as necessary.
+      * Returns the number of bytes that were read, which is less than n only at the end of the file.
+    */
+    char *out = static_cast<char *>(dst);
+    size_t n_read = 0;
+    while (n_read < n) {
+        if (this->offset >= this->data.size() && !this->read_block())
+            break;
+        size_t available = this->data.size() - this->offset;
+        size_t n_copy = (n - n_read < available) ? n - n_read : available;
+        memcpy(out + n_read, &this->data[this->offset], n_copy);
+        this->offset += n_copy;
+        n_read += n_copy;
+    }
+    return n_read;
+}
+
+bool BgzfReader::seek(uint64_t virtual_offset) {
+    /* Parameters:
+      * virtual_offset: A BGZF virtual file offset, e.g. from a BAM index, with the address of a block in the upper
+      48 bits and the offset within its uncompressed data in the lower 16 bits
+     * Functionality:
+      * Moves the stream to the virtual offset, discarding any blocks that were read ahead.
+      * Returns false if the block could not be read.
+    */
+    this->input.clear();
+    this->input.seekg(virtual_offset >> 16);
+    this->batch.clear();
+    this->batch_i = 0;
+    this->data.clear();
+    this->offset = 0;
+    if (!this->read_block())
+        return false;
+    this->offset = virtual_offset & 0xFFFF;
+    return true;
+}
+
+uint64_t BgzfReader::tell() {
+    /*
+      * Returns the virtual offset of the next uncompressed byte. If the current block has been read completely the
+      next block is read first, so the offset of a record is the same as the one stored in a BAM index.
+      * Returns UINT64_MAX at the end of the file.
+    */
+    if (this->offset >= this->data.size() && !this->read_block())
+        return UINT64_MAX;
+    return (static_cast<uint64_t>(this->block_address) << 16) | this->offset;
+}
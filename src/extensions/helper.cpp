@@ -3,46 +3,26 @@
 using namespace std;
 
 
-void add_alignment_positions(vector<MATCH *> &all_reads, char* &index) {
+void add_filtered_weights(vector<FILTERED_ALIGNMENT> &filtered,
+                          ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
+                          float &unmapped_weight_sum) {
     /* Parameters:
-      * all_reads: A vector populated by MATCH instances that contain information to be converted into strings
-     * Functionality:
-      * Iterates through MATCH instances in all_reads and calculates the alignment length from the start/stop positions
-    */
-
-    for ( vector<MATCH *>::iterator it = all_reads.begin(); it != all_reads.end(); ++it)  {
-        update_end_and_read_length(*it);
-    }
-}
-
-
-void remove_low_quality_matches(vector<MATCH *> &mapped_reads, unsigned int min_map_qual, float &unmapped_weight_sum) {
-    /* Parameters:
-      * mapped_reads: A vector of MATCH instances that is to be filtered
-      * min_map_qual: An integer representing the minimum mapping quality for an alignment to be included
+      * filtered: The alignments that fell below the mapping quality or aligned percentage thresholds while parsing
+      * reads_dict: A ReadTable indexed by read-names with QUADRUPLE values counting every alignment of each read
       * unmapped_weight_sum: Reference to a float that tracks the sum weight of fragments
      * Functionality:
-      * A new filtered_matches vector is created and all MATCH instances that pass the min_map_qual are appended to it.
-      * Their weights are added to the unmapped_weight_sum float since these are no longer returned as MATCHes
+      * The weight of each filtered alignment is calculated from its read's multiplicity, as in assign_read_weights,
+      and added to the unmapped_weight_sum float since these are never returned as MATCHes
     */
-    vector<MATCH *> filtered_matches;
-    filtered_matches.reserve(mapped_reads.size());
-    for ( vector<MATCH *>::iterator it = mapped_reads.begin(); it != mapped_reads.end(); ++it)  {
-        if ((*it)->mq < min_map_qual) {
-            unmapped_weight_sum += (*it)->w;
-            Py_DECREF((PyObject*)*it);
-        }
-        else
-            filtered_matches.push_back((*it));
+    for ( vector<FILTERED_ALIGNMENT>::iterator it = filtered.begin(); it != filtered.end(); ++it)  {
+        unmapped_weight_sum += calculate_weight(it->parity, reads_dict.entries[it->read_i].value);
     }
-    mapped_reads.clear();
-    mapped_reads = filtered_matches;
-    filtered_matches.clear();
 }
 
-bool check_reads_paired(vector<MATCH *> &mapped_reads) {
+bool check_reads_paired(vector<MATCH *> &mapped_reads, vector<FILTERED_ALIGNMENT> &filtered) {
     /* Parameters:
       * mapped_reads: A vector of MATCH instances that is to be filtered
+      * filtered: The alignments that fell below the mapping quality or aligned percentage thresholds while parsing
      * Functionality:
       * Looks at the MATCH->paired attribute of each read and determines whether the query sequences are from a
         paired-end or single-end sequencing library. true is returned if all reads are paired, false otherwise.
@@ -52,10 +32,37 @@ bool check_reads_paired(vector<MATCH *> &mapped_reads) {
         if (!(*it)->paired)
             sum++;
     }
+    for ( vector<FILTERED_ALIGNMENT>::iterator it = filtered.begin(); it != filtered.end(); ++it)  {
+        if (!it->paired)
+            sum++;
+    }
     if (sum == 0) return true;
-    if (sum == mapped_reads.size()) return false;
+    if (sum == mapped_reads.size() + filtered.size()) return false;
     else {
         std::cerr << "ERROR: Mixture of single- and paired-end reads detected in alignments." << std::endl;
         std::exit(5);
     }
 }
+
+void set_match_subjects(vector<MATCH *> &mapped_reads, vector<std::string> &ref_names) {
+    /* Parameters:
+      * mapped_reads: A vector of MATCH instances with a ref_id
+      * ref_names: The name of each reference sequence, indexed by ref_id
+     * Functionality:
+      * Creates a single interned Python string for the name of each reference sequence and gives each MATCH a
+      reference to the one for its ref_id, so the names aren't copied for every alignment.
+    */
+    vector<PyObject *> subjects(ref_names.size(), NULL);
+    for (vector<MATCH *>::iterator it = mapped_reads.begin(); it != mapped_reads.end(); ++it)  {
+        MATCH *match = *it;
+        if (match->subject != NULL || match->ref_id < 0 || static_cast<size_t>(match->ref_id) >= ref_names.size())
+            continue;
+        PyObject *&subject = subjects[match->ref_id];
+        if (subject == NULL)
+            subject = PyUnicode_InternFromString(ref_names[match->ref_id].c_str());
+        Py_INCREF(subject);
+        match->subject = subject;
+    }
+    for (vector<PyObject *>::iterator it = subjects.begin(); it != subjects.end(); ++it)
+        Py_XDECREF(*it);
+}
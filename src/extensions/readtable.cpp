@@ -0,0 +1,69 @@
+#include <stdlib.h>
+#include "readtable.h"
+
+using namespace std;
+
+
+uint64_t hash_read_name(const char *name) {
+    /* Parameters:
+      * name: A null-terminated read name
+     * Functionality:
+      * Calculates the 64-bit FNV-1a hash of the name, followed by the splitmix64 finalizer so that the low bits used
+      to index a ReadTable's slots depend on every character of the name.
+    */
+    uint64_t hash = 14695981039346656037ULL;
+    for (const unsigned char *c = (const unsigned char *) name; *c != '\0'; c++) {
+        hash ^= *c;
+        hash *= 1099511628211ULL;
+    }
+    hash ^= hash >> 30;
+    hash *= 0xbf58476d1ce4e5b9ULL;
+    hash ^= hash >> 27;
+    hash *= 0x94d049bb133111ebULL;
+    hash ^= hash >> 31;
+    return hash;
+}
+
+
+NameArena::NameArena() {
+    this->used = NAME_ARENA_BLOCK_SIZE;
+}
+
+
+NameArena::~NameArena() {
+    for (vector<char *>::iterator it = this->blocks.begin(); it != this->blocks.end(); ++it)
+        free(*it);
+}
+
+
+const char *NameArena::copy(const char *str) {
+    /* Parameters:
+      * str: A null-terminated string
+     * Functionality:
+      * Copies the string into the current block, starting a new block if it doesn't fit.
+      Strings longer than a block are given a block of their own.
+      * Returns a pointer to the copy, which is valid until the arena is cleared or destroyed.
+    */
+    size_t n = strlen(str) + 1;
+    if (this->used + n > NAME_ARENA_BLOCK_SIZE) {
+        this->blocks.push_back((char *) malloc(n > NAME_ARENA_BLOCK_SIZE ? n : NAME_ARENA_BLOCK_SIZE));
+        this->used = 0;
+    }
+    char *dst = this->blocks.back() + this->used;
+    memcpy(dst, str, n);
+    this->used = n > NAME_ARENA_BLOCK_SIZE ? NAME_ARENA_BLOCK_SIZE : this->used + n;
+    return dst;
+}
+
+
+void NameArena::clear() {
+    /*
+      * Forgets every string copied into the arena. The first block is kept for reuse and the others are freed.
+    */
+    if (this->blocks.empty())
+        return;
+    for (size_t i = 1; i < this->blocks.size(); i++)
+        free(this->blocks[i]);
+    this->blocks.resize(1);
+    this->used = 0;
+}
@@ -3,11 +3,88 @@
 using namespace std;
 
 MatchOutputParser::MatchOutputParser(const std::string &filename, const std::string &format) {
+    /* Parameters:
+      * filename: Name of the alignment file to be parsed
+      * format: The format of the alignment file, either "sam" or "bam"
+     * Functionality:
+      * Constructor for MatchOutputParser class
+      * Sets all variables used for counting alignments while parsing to 0
+    */
      this->filename = filename;
      this->format = format;
+     this->num_lines = 0;
+     this->unique_queries = 0;
+     this->num_mapped = 0;
      this->num_unmapped = 0;
+     this->num_fwd = 0;
+     this->num_rev = 0;
+     this->num_unpaired = 0;
+     this->num_multireads = 0;
+     this->secondary_alns = 0;
+     this->num_singletons = 0;
+     this->num_distinct_reads_mapped = 0;
+     this->num_indexed = 0;
+     this->truncated = false;
+     this->first_paired = -1;
+     this->progress = NULL;
+     this->progress_interval = 0;
 };
 
+void MatchOutputParser::parse_hd_line(const char *line) {
+    /* Parameters:
+      * line: An @HD header line. Only the tags before the first newline are read.
+     * Functionality:
+      * Sets sort_order and group_order from the SO and GO tags of the line, if they are present.
+    */
+    const char *tag = line;
+    const char *end = strchr(line, '\n');
+    while ((tag = strchr(tag, '\t')) != NULL && (end == NULL || tag < end)) {
+        tag++;
+        size_t len = strcspn(tag, "\t\n");
+        if (strncmp(tag, "SO:", 3) == 0)
+            this->sort_order.assign(tag + 3, len - 3);
+        else if (strncmp(tag, "GO:", 3) == 0)
+            this->group_order.assign(tag + 3, len - 3);
+    }
+}
+
+bool MatchOutputParser::name_grouped() {
+    /*
+      * Returns true if the header declares that all alignments of a read are adjacent, either because the file is
+      sorted by query name (SO:queryname) or grouped by query (GO:query).
+    */
+    return this->sort_order == "queryname" || this->group_order == "query";
+}
+
+int MatchOutputParser::restrict_to(const std::string &index_file, const vector<REGION> &regions) {
+    /*
+      * Only BAM files can be indexed, so by default restricting the alignments to regions fails.
+      * Returns 1.
+    */
+    std::cerr << "ERROR: Only indexed BAM files can be restricted to regions, not '" << this->filename << "'.";
+    std::cerr << std::endl;
+    return 1;
+}
+
+int MatchOutputParser::restrict_to_bytes(size_t beg, size_t end) {
+    /*
+      * Only the lines of SAM files can be found from a byte offset, so by default restricting the alignments to a
+      byte range fails.
+      * Returns 1.
+    */
+    std::cerr << "ERROR: Only SAM files can be restricted to a byte range, not '" << this->filename << "'.";
+    std::cerr << std::endl;
+    return 1;
+}
+
+bool MatchOutputParser::coordinate_sorted() {
+    /*
+      * Returns true if the header declares that the alignments are sorted by reference sequence and position
+      (SO:coordinate), so all alignments to a reference sequence are adjacent.
+    */
+    return this->sort_order == "coordinate";
+}
+
 unsigned long MatchOutputParser::get_Num_Unmapped_Reads() {
     return this->num_unmapped;
 }
@@ -15,6 +92,13 @@ unsigned long MatchOutputParser::get_Num_Unmapped_Reads() {
 MatchOutputParser::~MatchOutputParser() {
 }
 
+void MatchOutputParser::set_threads(unsigned int n_threads) {
+    /*
+      * Alignment files are parsed by a single thread unless the format's parser overrides this function.
+    */
+    return;
+}
+
 std::string MatchOutputParser::summarise() {
     char buf[1000];
     std::string summary_str;
@@ -49,124 +133,285 @@ SamFileParser::SamFileParser(const std::string &filename, const std::string &for
      * Functionality:
       * Constructor for SamFileParser class
       * Attempts to open the SAM file that was provided as the file name and throws an error, and returns, if unable to
-      * Sets all SamFileParser variables used for counting alignments while parsing to 0
     */
      this->filename = filename;
-     this->input.open(filename.c_str(), std::ifstream::in);
-     this->num_lines = 0;
-     this->unique_queries = 0;
-     this->num_mapped = 0;
-     this->num_unmapped = 0;
-     this->num_fwd = 0;
-     this->num_rev = 0;
-     this->num_unpaired = 0;
-     this->num_multireads = 0;
-     this->secondary_alns = 0;
-     this->num_singletons = 0;
-     this->num_distinct_reads_mapped = 0;
+     this->mapped.open(filename);
      this->header_pattern.assign("@", 1);
-     this->unmapped_pattern.assign("*", 1);
+     this->record.reserve(1000);
+     this->n_threads = 1;
+     this->offset = 0;
+     this->range_end = this->mapped.size;
+     this->bytes_beg = 0;
+     this->bytes_end = 0;
      return;
 }
 
 SamFileParser::~SamFileParser() {
-   this->input.close();
+   this->mapped.close();
 }
 
-bool SamFileParser::getMateInfo(unsigned int bitflag, MATCH *match)  {
+bool SamFileParser::good() {
+    return this->mapped.opened;
+}
+
+unsigned long long SamFileParser::bytes_read() {
+    return this->offset;
+}
+
+void SamFileParser::set_threads(unsigned int n_threads) {
     /* Parameters:
-      * bitflag: The second column in a SAM file with bitwise encodings of mapping information
-      * match: A MATCH instance
+      * n_threads: The number of threads to parse the alignments with
      * Functionality:
-      * Perform bit-wise calculations to get information on the read's alignment, mate pairing, etc.
-      * Returns `true` if either the first or second read in pair mapped, else `false`.
-      * Details for the MATCH object are in types.h
+      * When n_threads is greater than one, the alignments are split into byte ranges that are parsed in parallel
+      by consume_alignments().
     */
+    this->n_threads = n_threads > 0 ? n_threads : 1;
+}
 
-    unsigned int a = bitflag;
-    bool orphan = 0;
-    bool non_primary = 0;  // This is True if neither of the non-primary or supplementary alignment bits are set
-    a = a >> 2;  // Skip the "read mapped" and "mapped in proper pair" bits
-    match->mapped = !(a&1);  // mapped == 1 if the read was mapped b/c the third (0x4) bit isn't set
-    orphan = a&1;  // orphan == 0 if the read was unmapped
+void SamFileParser::seek_range(size_t beg, size_t end) {
+    /* Parameters:
+      * beg: Offset in the file of the start of the byte range
+      * end: Offset in the file of the end of the byte range
+     * Functionality:
+      * Restricts next_alignment() to the lines that start in the range [beg, end).
+      The line that beg falls in belongs to the previous range unless beg is the start of the line, so it is skipped.
+    */
+    this->range_end = end < this->mapped.size ? end : this->mapped.size;
+    this->offset = beg;
+    if (beg > 0 && beg < this->mapped.size && this->mapped.data[beg - 1] != '\n') {
+        const char *nl = static_cast<const char *>(memchr(this->mapped.data + beg, '\n', this->mapped.size - beg));
+        this->offset = nl ? nl - this->mapped.data + 1 : this->mapped.size;
+    }
+}
 
-    a = a >> 1;  // Move to the next, "mate unmapped" bit
-    orphan = orphan^(a&1);  // `orphan` is 1 if the mate was unmapped (or doesn't exist) XOR `orphan` is set to 1
+int SamFileParser::restrict_to_bytes(size_t beg, size_t end) {
+    /* Parameters:
+      * beg: Offset in the file of the start of the byte range
+      * end: Offset in the file of the end of the byte range
+     * Functionality:
+      * Restricts consume_alignments() to the alignment lines that start in the range [beg, end), as seek_range()
+      does, once the header has been parsed. A range that starts within the header starts at its end instead.
+      * Returns 0.
+    */
+    this->bytes_beg = beg;
+    this->bytes_end = end;
+    return 0;
+}
+
+bool SamFileParser::next_line(const char *&line, size_t &length) {
+    /* Parameters:
+      * line: Set to the start of the next line in the mapped file
+      * length: Set to the length of the line, excluding the newline
+     * Functionality:
+      * Finds the end of the line starting at offset with memchr and moves offset to the start of the following line.
+      * The pages of the mapped file that have been scanned are released periodically.
+      * Returns false once offset reaches range_end.
+    */
+    if (this->offset >= this->range_end)
+        return false;
+    line = this->mapped.data + this->offset;
+    const char *nl = static_cast<const char *>(memchr(line, '\n', this->mapped.size - this->offset));
+    length = nl ? nl - line : this->mapped.size - this->offset;
+    // Only the current line is referenced, the fields that are kept having been copied
+    if (this->offset >= this->mapped.released + 2*MAPPED_RELEASE_SIZE)
+        this->mapped.release(this->offset - MAPPED_RELEASE_SIZE);
+    this->offset += length + 1;
+    return true;
+}
+
+static void consume_range(SamFileParser *parser, CoverageAccumulator *accumulator, int *status) {
+    /* Parameters:
+      * parser: A SamFileParser restricted to a byte range of the file with seek_range()
+      * accumulator: The CoverageAccumulator that the alignments in the range are added to
+      * status: Set to the value returned by MatchOutputParser::consume_alignments()
+     * Functionality:
+      * The work done by a single thread in SamFileParser::consume_alignments().
+    */
+    *status = parser->MatchOutputParser::consume_alignments(*accumulator);
+}
 
-    a = a >> 3;  // Move to the sixth (0x64) "first in pair" bit
-    if ( a&1 )  {
-        match->parity = false;
-        a = a >> 1;
+int SamFileParser::consume_alignments(CoverageAccumulator &accumulator) {
+    /* Parameters:
+      * accumulator: A CoverageAccumulator that each alignment is added to
+     * Functionality:
+      * If n_threads is greater than one, the alignments following the header are split into n_threads byte ranges
+      that are aligned to lines. Each range is parsed by its own thread into its own CoverageAccumulator, which
+      records the order its alignments were added in.
+      * The accumulators are then merged into accumulator in the order of their ranges, before any weights are
+      calculated, so that the results are identical to parsing the file with a single thread.
+      * Name-grouped and coordinate-sorted input, which accumulator summarises as it is parsed, is parsed serially.
+      * Progress is only reported once every range has been parsed and merged.
+      * If the file was restricted to a byte range with restrict_to_bytes(), only the alignments in that range are
+      parsed, split the same way.
+    */
+    if (this->bytes_end > 0)
+        this->seek_range(this->bytes_beg > this->offset ? this->bytes_beg : this->offset, this->bytes_end);
+    size_t data_start = this->offset;
+    size_t file_size = this->range_end;
+    if (this->n_threads <= 1 || accumulator.grouped || accumulator.coordinate_sorted || file_size <= data_start)
+        return MatchOutputParser::consume_alignments(accumulator);
+
+    unsigned int n = this->n_threads;
+    vector<size_t> bounds(n + 1);
+    for (unsigned int t = 0; t <= n; t++)
+        bounds[t] = data_start + (file_size - data_start)*t/n;
+
+    vector<SamFileParser *> parsers(n, this);
+    vector<CoverageAccumulator *> accumulators(n, &accumulator);
+    vector<int> status(n, 0);
+    this->range_end = bounds[1];
+    for (unsigned int t = 1; t < n; t++) {
+        parsers[t] = new SamFileParser(this->filename, this->format);
+        parsers[t]->seek_range(bounds[t], bounds[t + 1]);
+        accumulators[t] = new CoverageAccumulator(accumulator.multireads, accumulator.min_aln,
+                                                  accumulator.min_map_qual);
+        accumulators[t]->track_order = true;
+        accumulators[t]->reads.verify_names = accumulator.reads.verify_names;
+        if (accumulator.columns)
+            accumulators[t]->columns = new ALIGNMENT_COLUMNS();
     }
-    else {
-        a = a >> 1;  // Move to the seventh (0x128) "second in pair" bit
-        if ( a&1 )
-            match->parity  = true;
-        else
-            return false;
+
+    PyObject *progress = this->progress;
+    this->progress = NULL;
+    vector<std::thread> threads;
+    for (unsigned int t = 0; t < n; t++)
+        threads.push_back(std::thread(consume_range, parsers[t], accumulators[t], &status[t]));
+    for (unsigned int t = 0; t < n; t++)
+        threads[t].join();
+
+    int max_status = status[0];
+    for (unsigned int t = 1; t < n; t++) {
+        accumulator.merge(*accumulators[t]);
+        this->num_lines += parsers[t]->num_lines;
+        this->num_mapped += parsers[t]->num_mapped;
+        this->num_unmapped += parsers[t]->num_unmapped;
+        this->num_unpaired += parsers[t]->num_unpaired;
+        this->num_fwd += parsers[t]->num_fwd;
+        this->num_rev += parsers[t]->num_rev;
+        if (status[t] > max_status)
+            max_status = status[t];
+        delete accumulators[t]->columns;
+        delete accumulators[t];
+        delete parsers[t];
     }
+    this->range_end = file_size;
+    this->progress = progress;
+    return max_status;
+}
 
-    a = a >> 1;  // Move to the eighth, "not primary alignment" position
-    non_primary = a&1;  // Should be 0 if it is the primary alignment
-    a = a >> 3;  // Move to the eleventh (0x2048) "supplementary alignment" bit position
-    match->multi = non_primary^(a&1);  // Is a multiread if it is either a non-primary XOR secondary alignment
-    match->chimeric = a&1;  // This hints at a possible chimera, but it would have to be validated downstream
-    match->singleton = orphan;
-    return true;
+bool SamFileParser::getMateInfo(unsigned int bitflag, MATCH *match)  {
+    /* Parameters:
+      * bitflag: The second column in a SAM file with bitwise encodings of mapping information
+      * match: A MATCH instance
+     * Functionality:
+      * Wrapper for decode_bitflag() that populates a MATCH instance's mate information.
+    */
+    return decode_bitflag(bitflag, match);
 }
 
-bool SamFileParser::nextline(MATCH *match) {
+bool SamFileParser::next_alignment(ALIGNMENT &aln) {
     /* Parameters:
-      * match: Reference to a MATCH instance that is to be populated with alignment information
+      * aln: Reference to an ALIGNMENT that is to be populated with the next alignment line's information
      * Functionality:
-      * Function for adding values of a short-read alignment in a SAM file to a match instance.
-      * Specifically, the `paired`, `query`, `subject`, `start`, and `end` values are populated.
-      * If the line of the SamFileParser matches the header_pattern, lines are skipped until they no longer match
-      and the line has >= 9 tab-separated columns.
-    */
-    if (this->fields.size() < 9) return false;
-
-    match->query = (char *)malloc(strlen(this->fields[0]) + 1);
-    strcpy(match->query, this->fields[0]);
-    match->subject = (char *)malloc(strlen(this->fields[2]) + 1);
-    strcpy(match->subject, this->fields[2]);
-    match->start = atoi(this->fields[3]);
-    match->mq = atoi(this->fields[4]);
-    match->cigar = (char *)malloc(strlen(this->fields[5]) + 1);
-    strcpy(match->cigar, this->fields[5]);
-    match->paired = getMateInfo(static_cast<unsigned int>(atoi(this->fields[1])), match);
-
-    // TODO: test to ensure the end position is calculated correctly. It currently isn't.
-    if ( match->parity ) // Read is second in pair and will be aligned right-to-left
-    match->end =  match->start - std::string(this->fields[9]).size();
-    else
-    match->end =  match->start + std::string(this->fields[9]).size();
+      * Reads the next line of the SAM file and populates the `query`, `subject`, `start`, `mq`, `cigar` fields,
+      as well as the mate information decoded from the bitwise flag and the lengths decoded from the CIGAR.
+      * The line is scanned in place in the mapped file. Only the first six fields are copied, into the parser's
+      record buffer where they are null-terminated, so the strings are only valid until the next line is read.
+      * The ref_id of the reference sequence is looked up in ref_ids, without allocating a string.
+      * If the read was not aligned to a reference sequence (RNAME is '*') only the query name is copied and
+      aln.subject is set to NULL, without looking past the third field.
+      * Returns false at the end of the file or if the line has fewer than 9 tab-separated columns.
+    */
+    const char *line;
+    size_t length;
+    if (!this->next_line(line, length))
+        return false;
+
+    // Positions of the tabs that end the first eight fields
+    const char *tabs[8];
+    const char *p = line;
+    const char *end = line + length;
+    for (int i = 0; i < 8; i++) {
+        tabs[i] = static_cast<const char *>(memchr(p, '\t', end - p));
+        if (tabs[i] == NULL)
+            return false;
+        p = tabs[i] + 1;
+        if (i == 2 && *(tabs[1] + 1) == '*')
+            break;
+    }
 
+    memset(&aln, 0, sizeof(ALIGNMENT));
+    aln.ref_id = -1;
+    if (*(tabs[1] + 1) == '*') {
+        this->record.assign(line, tabs[0]);
+        this->record.push_back('\0');
+        aln.query = &this->record[0];
+        // Unmapped reads still tell whether the library is paired
+        aln.paired = (atoi(tabs[0] + 1) & 1) != 0;
+        return true;
+    }
+
+    this->record.assign(line, tabs[5]);
+    this->record.push_back('\0');
+    for (int i = 0; i < 5; i++)
+        this->record[tabs[i] - line] = '\0';
+    aln.query = &this->record[0];
+    aln.subject = &this->record[tabs[1] + 1 - line];
+    aln.cigar = &this->record[tabs[4] + 1 - line];
+    int &ref_id = this->ref_ids.insert(aln.subject, this->ref_names.size());
+    if (static_cast<size_t>(ref_id) == this->ref_names.size())
+        this->ref_names.push_back(aln.subject);
+    aln.ref_id = ref_id;
+    aln.start = atoi(tabs[2] + 1);
+    aln.mq = atoi(tabs[3] + 1);
+    aln.paired = decode_bitflag(static_cast<unsigned int>(atoi(tabs[0] + 1)), &aln);
+    decode_alignment_cigar(aln);
     return true;
 }
 
-int SamFileParser::parse_header(map<std::string, int> &ref_dict) {
+int SamFileParser::parse_header(vector<pair<std::string, unsigned long> > &ref_lengths) {
     /* Parameters:
-      * ref_dict: Pointer to a map of strings (to be reference names) as values and integers as keys
+      * ref_lengths: Reference to a vector that is populated with the name and length of each reference sequence
      * Functionality:
-      * Iterates over the lines in a SAM file (SamFileParser.input attribute) while the lines match the
+      * Iterates over the lines in a SAM file (SamFileParser.mapped attribute) while the lines match the
        SamFileParser.header_pattern attribute ('@').
+      * The SN and LN tags of each @SQ line are appended to ref_lengths in the order they appear, and the names to
+      ref_names so that the ref_id of an alignment is the index of its reference sequence in the header.
+      * Leaves offset at the start of the first alignment line.
       * Returns the line number that the header ends at.
     */
     string line;
+    const char *start;
+    size_t length;
     int line_no = 0;
-    while (std::getline(this->input, line).good()) {
+    while (this->next_line(start, length)) {
+        line.assign(start, length);
         if (match_string(line, this->header_pattern, true) ) {
+            if (line.compare(0, 4, "@HD\t") == 0)
+                this->parse_hd_line(line.c_str());
             this->fields.clear();
             split(line, this->fields, this->buf, '\t');
             if (strcmp(this->fields[0], "@SQ") == 0) {
-                ref_dict[lstrip(this->fields[1], ':')] = atoi(lstrip(this->fields[2], ':'));
+                const char *name = NULL;
+                unsigned long length = 0;
+                for (size_t i = 1; i < this->fields.size(); i++) {
+                    if (strncmp(this->fields[i], "SN:", 3) == 0)
+                        name = this->fields[i] + 3;
+                    else if (strncmp(this->fields[i], "LN:", 3) == 0)
+                        length = strtoul(this->fields[i] + 3, NULL, 10);
+                }
+                if (name) {
+                    ref_lengths.push_back(make_pair(std::string(name), length));
+                    int &ref_id = this->ref_ids.insert(name, this->ref_names.size());
+                    if (static_cast<size_t>(ref_id) == this->ref_names.size())
+                        this->ref_names.push_back(name);
+                }
             }
             else
                 continue;
         }
         else {
-            this->input.seekg(long(this->input.tellg())-(line.size()+1));
+            this->offset = start - this->mapped.data;
             return line_no;
         }
         line_no++;
@@ -174,120 +419,543 @@ int SamFileParser::parse_header(map<std::string, int> &ref_dict) {
     return line_no;
 }
 
-int SamFileParser::consume_sam(vector<MATCH *> &all_alignments, bool multireads, bool show_status) {
+BamFileParser::BamFileParser(const std::string &filename, const std::string &format):
+        MatchOutputParser(filename, format), bgzf(filename) {
     /* Parameters:
-      * all_alignments: Pointer to a vector of MATCH objects that has yet to be populated
-      * multireads: Boolean flag indicating whether reads that have multiple ambiguous mapping positions are used
-      * show_stats: Boolean indicating whether the number of reads parsed should be printed to screen
+      * filename: Name of the BAM file to be parsed
      * Functionality:
-      * Basic function for parsing a SAM file.
-      * All mapped reads are saved as a MATCH instance and these objects are stored in all_alignments.
-      * The number of mapped, unmapped, forward, and reverse reads are counted.
-      * These are counts are non-unique so double counts could arise from reads with multiple alignments
+      * Constructor for BamFileParser class. The BGZF blocks of the file are read by a BgzfReader.
     */
-    string line;
-    map<std::string, int> ref_dict;
+    this->record.reserve(1000);
+    this->restricted = false;
+    this->chunk_i = 0;
+    this->in_chunk = false;
+    return;
+}
 
-     if(!this->input.good()) {
-         std::cerr << "ERROR: Unable to open '"<< filename <<"' for reading." << std::endl;
-         return 1;
-     }
+BamFileParser::~BamFileParser() {
+}
 
-    this->parse_header(ref_dict);
+bool BamFileParser::good() {
+    return this->bgzf.good();
+}
 
-    if ( show_status )
-        std::cout << "Number of SAM alignment lines processed: " << std::endl;
+unsigned long long BamFileParser::bytes_read() {
+    /*
+      * Returns the offset of the compressed BGZF block being read.
+    */
+    return this->bgzf.block_address;
+}
 
-    while (std::getline(this->input, line).good()) {
-        this->num_lines++;
-        if (show_status && this->num_lines % 10000 == 0)
-            std::cout << "\n\033[F\033[J" << this->num_lines;
-        this->fields.clear();
-        split(line, this->fields, this->buf, '\t');
-        if ( match_string(string(this->fields[2]), this->unmapped_pattern, true) ) {
-            this->num_unmapped++;
-            continue;
-        }
+void BamFileParser::set_threads(unsigned int n_threads) {
+    this->bgzf.set_threads(n_threads);
+}
 
-        MATCH *match = Match_cnew();
-        if (!this->nextline(match))
-            break;
+int BamFileParser::parse_header(vector<pair<std::string, unsigned long> > &ref_lengths) {
+    /* Parameters:
+      * ref_lengths: Reference to a vector that is populated with the name and length of each reference sequence
+     * Functionality:
+      * Reads the BAM magic string, skips the plain-text header and reads the binary reference sequence dictionary
+      into ref_lengths and ref_names, which is indexed by the refID of each alignment record.
+      * If the parser has been restricted to regions, these are resolved and first_paired is set from the first record.
+      * Returns the number of reference sequences, or -1 if the file is not a valid BAM file.
+    */
+    char magic[4];
+    int32_t l_text, n_ref, l_name, l_ref;
+
+    if (this->bgzf.read(magic, 4) < 4 || strncmp(magic, "BAM\1", 4) != 0) {
+        std::cerr << "ERROR: '" << this->filename << "' is not a BAM file." << std::endl;
+        return -1;
+    }
+    this->bgzf.read(&l_text, 4);
+    this->record.resize(l_text > 0 ? l_text + 1 : 1);
+    this->bgzf.read(&this->record[0], l_text);
+    this->record[l_text > 0 ? l_text : 0] = '\0';
+    if (strncmp(&this->record[0], "@HD\t", 4) == 0)
+        this->parse_hd_line(&this->record[0]);
+
+    this->bgzf.read(&n_ref, 4);
+    this->ref_names.clear();
+    for (int32_t i = 0; i < n_ref; i++) {
+        this->bgzf.read(&l_name, 4);
+        this->record.resize(l_name);
+        this->bgzf.read(&this->record[0], l_name);
+        this->bgzf.read(&l_ref, 4);
+        this->ref_names.push_back(std::string(&this->record[0]));
+        ref_lengths.push_back(make_pair(this->ref_names.back(), (unsigned long) l_ref));
+    }
+    if (this->restricted) {
+        if (this->resolve_regions() != 0)
+            return -1;
+        // The regions might not hold any reads, so the first record tells whether the library is paired.
+        // next_alignment() seeks to the first chunk before reading anything else
+        ALIGNMENT aln;
+        if (this->read_alignment(aln))
+            this->first_paired = aln.paired ? 1 : 0;
+    }
+    return n_ref;
+}
 
-        this->num_mapped++;
+int BamFileParser::restrict_to(const std::string &index_file, const vector<REGION> &regions) {
+    /* Parameters:
+      * index_file: Path to the BAI or CSI index of the BAM file
+      * regions: The regions of reference sequences that alignments are read from
+     * Functionality:
+      * Loads the index so that next_alignment() only reads the BGZF chunks that may hold records overlapping the
+      regions, and only returns those records. The regions are looked up once the header has been parsed.
+      * The number of records in the file is taken from the index's metadata and stored in num_indexed.
+      * Returns 0 on success, 1 if the index could not be read.
+    */
+    if (this->index.load(index_file) != 0) {
+        std::cerr << "ERROR: Unable to read the BAM index '" << index_file << "'." << std::endl;
+        return 1;
+    }
+    this->requested = regions;
+    this->restricted = true;
+    this->num_indexed = this->index.num_records();
+    return 0;
+}
 
-        if (!match->paired)
-            this->num_unpaired++;
-        else {
-            if (match->parity)
-                this->num_rev++;
-            else this->num_fwd++;
+int BamFileParser::resolve_regions() {
+    /*
+      * Finds the reference ID of each requested region, merges the overlapping regions of each reference sequence
+      and collects the index chunks for all regions, merged so no record is read twice.
+      * Returns 0 on success, 1 if a region's reference sequence is not in the header.
+    */
+    map<std::string, int32_t> ref_ids;
+    for (size_t i = 0; i < this->ref_names.size(); i++)
+        ref_ids[this->ref_names[i]] = i;
+
+    this->regions.clear();
+    for (vector<REGION>::iterator it = this->requested.begin(); it != this->requested.end(); ++it) {
+        map<std::string, int32_t>::iterator ref = ref_ids.find(it->name);
+        if (ref == ref_ids.end()) {
+            std::cerr << "ERROR: Reference sequence '" << it->name << "' is not in the header of '";
+            std::cerr << this->filename << "'." << std::endl;
+            return 1;
         }
+        if (it->end > it->beg)
+            this->regions[ref->second].push_back(make_pair(it->beg, it->end));
+    }
 
-        if (match->multi && !multireads)  // Drop secondary and supplementary alignments
-            continue;
+    this->chunks.clear();
+    for (map<int32_t, vector<pair<uint32_t, uint32_t> > >::iterator it = this->regions.begin();
+         it != this->regions.end(); ++it) {
+        merge_intervals(it->second);
+        for (size_t i = 0; i < it->second.size(); i++)
+            this->index.query(it->first, it->second[i].first, it->second[i].second, this->chunks);
+    }
+    merge_chunks(this->chunks);
+    this->chunk_i = 0;
+    this->in_chunk = false;
+    return 0;
+}
+
+bool BamFileParser::overlaps_regions() {
+    /*
+      * Returns true if the record that was last read overlaps one of the regions of its reference sequence.
+      Records that were not aligned are considered to cover their position alone.
+    */
+    int32_t ref_id, pos;
+    uint16_t n_cigar_op;
+    memcpy(&ref_id, &this->record[0], 4);
+    memcpy(&pos, &this->record[4], 4);
+    memcpy(&n_cigar_op, &this->record[12], 2);
+    map<int32_t, vector<pair<uint32_t, uint32_t> > >::iterator ref = this->regions.find(ref_id);
+    if (ref == this->regions.end() || pos < 0)
+        return false;
+
+    CIGAR_LENGTHS lengths;
+    decode_cigar_ops(n_cigar_op > 0 ? &this->cigar_ops[0] : NULL, n_cigar_op, lengths);
+    uint32_t beg = pos;
+    uint32_t end = beg + lengths.aln_len;
+    if (end == beg)
+        end = beg + 1;
+    // The merged regions are disjoint and sorted, so the first region ending after beg is the only candidate
+    vector<pair<uint32_t, uint32_t> > &intervals = ref->second;
+    vector<pair<uint32_t, uint32_t> >::iterator it = upper_bound(
+            intervals.begin(), intervals.end(), beg,
+            [](uint32_t value, const pair<uint32_t, uint32_t> &interval) { return value < interval.second; });
+    return it != intervals.end() && it->first < end;
+}
 
-        // if it is not mapped then ignore it
-        if (!match->mapped) {
-            Py_DECREF((PyObject*)match);
+bool BamFileParser::next_alignment(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: Reference to an ALIGNMENT that is to be populated with the next alignment record's information
+     * Functionality:
+      * Reads the next record with read_alignment(). If the parser has been restricted to regions, the chunks
+      found in the index are read in order and only records overlapping the regions are returned.
+      * Returns false at the end of the file, or of the last chunk, or if a record is truncated.
+    */
+    if (!this->restricted)
+        return this->read_alignment(aln);
+
+    while (this->chunk_i < this->chunks.size()) {
+        BAM_CHUNK &chunk = this->chunks[this->chunk_i];
+        if (!this->in_chunk) {
+            if (!this->bgzf.seek(chunk.beg)) {
+                // Chunks from the index are within the file
+                this->truncated = true;
+                return false;
+            }
+            this->in_chunk = true;
+        }
+        if (this->bgzf.tell() >= chunk.end) {
+            this->chunk_i++;
+            this->in_chunk = false;
             continue;
         }
+        if (!this->read_alignment(aln))
+            return false;
+        if (this->overlaps_regions())
+            return true;
+    }
+    return false;
+}
 
-        // store it to process later by looking up the dictionary
-        try {
-            all_alignments.push_back(match);
-        }
-        catch (...) {
-            PyErr_Format(PyExc_RuntimeError, "Failing at %s.", match->query);
-            return 1;
+bool BamFileParser::read_alignment(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: Reference to an ALIGNMENT that is to be populated with the next alignment record's information
+     * Functionality:
+      * Reads the next binary alignment record and populates the `query`, `subject`, `start`, `mq` fields,
+      as well as the binary CIGAR operations, the lengths decoded from them and the mate information decoded from
+      the bitwise flag.
+      * Positions are converted from 0-based to 1-based to match those in SAM files.
+      * The query name is borrowed from the parser's buffer and is only valid until the next record is read.
+      * If the read was not aligned to a reference sequence (refID is -1) aln.subject is set to NULL.
+      * Returns false at the end of the file or if the record or its BGZF block is truncated, in which case truncated
+      is set.
+    */
+    int32_t block_size, ref_id, pos;
+    uint8_t l_read_name, mapq;
+    uint16_t n_cigar_op, flag;
+
+    size_t n_read = this->bgzf.read(&block_size, 4);
+    if (n_read < 4) {
+        // The file may only end between two records
+        this->truncated = n_read > 0 || this->bgzf.failed;
+        return false;
+    }
+    if (block_size < 32) {
+        this->truncated = true;
+        return false;
+    }
+    this->record.resize(block_size);
+    if (this->bgzf.read(&this->record[0], block_size) < static_cast<size_t>(block_size)) {
+        this->truncated = true;
+        return false;
+    }
+
+    const char *rec = &this->record[0];
+    memcpy(&ref_id, rec, 4);
+    memcpy(&pos, rec + 4, 4);
+    memcpy(&l_read_name, rec + 8, 1);
+    memcpy(&mapq, rec + 9, 1);
+    memcpy(&n_cigar_op, rec + 12, 2);
+    memcpy(&flag, rec + 14, 2);
+
+    memset(&aln, 0, sizeof(ALIGNMENT));
+    aln.ref_id = -1;
+    aln.query = &this->record[32];
+    if (ref_id < 0 || static_cast<size_t>(ref_id) >= this->ref_names.size()) {
+        aln.paired = (flag & 1) != 0;
+        return true;
+    }
+
+    this->cigar_ops.resize(n_cigar_op);
+    if (n_cigar_op > 0)
+        memcpy(&this->cigar_ops[0], rec + 32 + l_read_name, 4*n_cigar_op);
+
+    aln.subject = const_cast<char *>(this->ref_names[ref_id].c_str());
+    aln.ref_id = ref_id;
+    aln.start = pos + 1;
+    aln.mq = mapq;
+    aln.cigar_ops = n_cigar_op > 0 ? &this->cigar_ops[0] : NULL;
+    aln.n_cigar_op = n_cigar_op;
+    aln.paired = decode_bitflag(static_cast<unsigned int>(flag), &aln);
+    decode_alignment_cigar(aln);
+    return true;
+}
+
+MatchOutputParser *open_alignment_file(const std::string &filename) {
+    /* Parameters:
+      * filename: Path to a SAM or BAM file
+     * Functionality:
+      * Picks the parser for the alignment file from its magic bytes: a BamFileParser if it is BGZF-compressed,
+      otherwise a SamFileParser. The caller is responsible for deleting the returned parser.
+    */
+    if (is_bgzf(filename))
+        return new BamFileParser(filename, "bam");
+    return new SamFileParser(filename, "sam");
+}
+
+void AlignmentBuffer::add(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: An ALIGNMENT whose strings are borrowed from a parser
+     * Functionality:
+      * Stores a copy of the alignment, with its query name and CIGAR string copied into text.
+    */
+    this->offsets.push_back(this->text.size());
+    this->text.insert(this->text.end(), aln.query, aln.query + strlen(aln.query) + 1);
+    this->offsets.push_back(this->text.size());
+    if (aln.cigar)
+        this->text.insert(this->text.end(), aln.cigar, aln.cigar + strlen(aln.cigar) + 1);
+    else {
+        std::string cigar = cigar_ops_to_string(aln.cigar_ops, aln.n_cigar_op);
+        this->text.insert(this->text.end(), cigar.c_str(), cigar.c_str() + cigar.size() + 1);
+    }
+    this->alignments.push_back(aln);
+}
+
+int AlignmentBuffer::to_matches(vector<MATCH *> &matches) {
+    /* Parameters:
+      * matches: A vector that a new MATCH instance is appended to for each alignment in the buffer
+     * Functionality:
+      * Converts the buffered alignments into MATCH instances, which requires the GIL, and empties the buffer.
+      * Returns 0 on success, or 1 with a Python exception set if a MATCH couldn't be created.
+    */
+    int status = 0;
+    for (size_t i = 0; i < this->alignments.size(); i++) {
+        ALIGNMENT &aln = this->alignments[i];
+        aln.query = &this->text[this->offsets[2*i]];
+        aln.cigar = &this->text[this->offsets[2*i + 1]];
+        MATCH *match = Match_from_alignment(aln);
+        if (match == NULL) {
+            PyErr_NoMemory();
+            status = 1;
+            break;
         }
+        matches.push_back(match);
     }
-    this->fields.clear();
+    this->alignments.clear();
+    this->text.clear();
+    this->offsets.clear();
+    return status;
+}
 
-    if ( show_status )
-        std::cout << "\n\033[F\033[J" << this->num_lines << std::endl;
 
+void MatchOutputParser::set_progress(PyObject *progress, unsigned int interval) {
+    /* Parameters:
+      * progress: A Python callable, or NULL. A reference is borrowed so it must outlive the parse.
+      * interval: The minimum number of milliseconds between calls to progress
+     * Functionality:
+      * Sets the callable that report_progress() passes the parsing statistics to.
+    */
+    this->progress = progress;
+    this->progress_interval = interval;
+    this->last_progress = std::chrono::steady_clock::now();
+}
+
+unsigned long long MatchOutputParser::bytes_read() {
+    /*
+      * Returns the number of bytes of the alignment file that have been parsed, used for reporting progress.
+    */
     return 0;
 }
 
+bool MatchOutputParser::progress_due() {
+    /*
+      * Returns true if a progress callable was given and progress_interval milliseconds have passed since it was
+      last called. The clock is only read every PROGRESS_CHECK_LINES lines.
+    */
+    if (this->progress == NULL || this->num_lines % PROGRESS_CHECK_LINES != 0)
+        return false;
+    return std::chrono::steady_clock::now() - this->last_progress >=
+           std::chrono::milliseconds(this->progress_interval);
+}
+
+int MatchOutputParser::report_progress() {
+    /*
+      * Calls the progress callable with the number of lines, bytes, mapped and unmapped alignments parsed so far.
+      * The GIL is acquired for the call, so it may be called whether or not the calling thread holds the GIL.
+      * Returns 0 on success, or 1 with a Python exception set if the callable raised one.
+    */
+    if (this->progress == NULL)
+        return 0;
+    PyGILState_STATE gil = PyGILState_Ensure();
+    PyObject *result = PyObject_CallFunction(this->progress, "kKkk", this->num_lines, this->bytes_read(),
+                                             this->num_mapped, this->num_unmapped);
+    Py_XDECREF(result);
+    PyGILState_Release(gil);
+    this->last_progress = std::chrono::steady_clock::now();
+    return result == NULL ? 1 : 0;
+}
+
+bool MatchOutputParser::count_alignment(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: The alignment that was just parsed
+     * Functionality:
+      * Counts the alignment line and whether it was mapped, paired, forward or reverse.
+      * Returns true if the alignment is to a reference sequence.
+    */
+    this->num_lines++;
+    if (aln.subject == NULL) {
+        this->num_unmapped++;
+        return false;
+    }
+
+    this->num_mapped++;
+
+    if (!aln.paired)
+        this->num_unpaired++;
+    else {
+        if (aln.parity)
+            this->num_rev++;
+        else this->num_fwd++;
+    }
+    return true;
+}
 
-int SamFileParser::alignment_multiplicity_audit(vector<MATCH *> &all_alignments,
-                                                map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict) {
+int MatchOutputParser::consume(vector<MATCH *> &all_alignments, bool multireads, unsigned int min_map_qual,
+                               int min_aln,
+                               ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
+                               vector<FILTERED_ALIGNMENT> &filtered) {
     /* Parameters:
       * all_alignments: Pointer to a vector of MATCH objects that has yet to be populated
-      * reads_dict: Pointer to a map indexed by read-names with QUADRUPLE values that store all reads in the SAM file
+      * multireads: Boolean flag indicating whether reads that have multiple ambiguous mapping positions are used
+      * min_map_qual: The minimum mapping quality for an alignment to be saved as a MATCH
+      * min_aln: The minimum percentage of a read's length that must be aligned for it to be saved as a MATCH
+      * reads_dict: A ReadTable indexed by read-names with QUADRUPLE values that is populated with the number of
+      forward and reverse alignments of each read
+      * filtered: A vector that the alignments which fell below min_map_qual or min_aln are appended to
      * Functionality:
-      * 
-    */
-    struct QUADRUPLE <bool, bool, unsigned int, unsigned int> p;
-    for ( vector<MATCH *>::iterator it = all_alignments.begin(); it != all_alignments.end(); ++it)  {
-        if (reads_dict.find((*it)->query) == reads_dict.end()) {
-            p.first = false;
-            p.second = false;
-            p.third = 0;
-            p.fourth = 0;
-            reads_dict[(*it)->query] = p;
-        }
+      * Basic function for parsing a SAM or BAM file. Must be called with the GIL held.
+      * Secondary and supplementary alignments are dropped unless multireads is true, as are unmapped reads.
+      * Every other alignment is counted towards its read's multiplicity in reads_dict. Those that pass the mapping
+      quality and aligned percentage thresholds are saved as a MATCH instance in all_alignments; for the others only
+      their read and parity are recorded in filtered so their weight can be added to the unmapped fragments.
+      * The number of mapped, unmapped, forward, and reverse reads are counted.
+      * These are counts are non-unique so double counts could arise from reads with multiple alignments
+      * The file is parsed without the GIL. Alignments are copied into an AlignmentBuffer and the GIL is only
+      acquired to convert every ALIGNMENT_BATCH_SIZE of them into MATCH instances.
+      * Returns 0 on success, or 1 if the file couldn't be parsed or the progress callable raised an exception.
+    */
+    ALIGNMENT aln;
+    AlignmentBuffer buffer;
+    int status = 0;
+    struct QUADRUPLE <bool, bool, unsigned int, unsigned int> initial;
+    initial.first = false;
+    initial.second = false;
+    initial.third = 0;
+    initial.fourth = 0;
+
+     if(!this->good()) {
+         std::cerr << "ERROR: Unable to open '"<< filename <<"' for reading." << std::endl;
+         return 1;
+     }
 
-        if (!(*it)->parity) {
-            reads_dict[(*it)->query].first = true;  // This is a forward read
-            if ((*it)->mapped)
-                reads_dict[(*it)->query].third++;
+    if (this->parse_header(this->ref_lengths) < 0)
+        return 1;
+
+    Py_BEGIN_ALLOW_THREADS
+    while (status == 0) {
+        bool more = this->next_alignment(aln);
+        if (more && this->count_alignment(aln) && (multireads || !aln.multi) && aln.mapped) {
+            size_t read_i;
+            struct QUADRUPLE <bool, bool, unsigned int, unsigned int> &read = reads_dict.insert(aln.query, initial,
+                                                                                                 &read_i);
+            if (!aln.parity) {
+                read.first = true;  // This is a forward read
+                read.third++;
+            }
+            else {
+                read.second = true;  // This is a reverse read
+                read.fourth++;
+            }
+
+            if (aln.mq >= min_map_qual && aln.read_length > 0 &&
+                100.0 * (aln.end - aln.start) / aln.read_length >= min_aln)
+                buffer.add(aln);
+            else {
+                FILTERED_ALIGNMENT rejected;
+                rejected.read_i = read_i;
+                rejected.parity = aln.parity;
+                rejected.paired = aln.paired;
+                filtered.push_back(rejected);
+            }
+        }
+        if (more && this->progress_due())
+            status = this->report_progress();
+
+        if (!more || buffer.alignments.size() >= ALIGNMENT_BATCH_SIZE) {
+            Py_BLOCK_THREADS
+            if (status == 0)
+                status = buffer.to_matches(all_alignments);
+            Py_UNBLOCK_THREADS
+            if (!more)
+                break;
         }
-        else {
-            reads_dict[(*it)->query].second = true;  // This is a reverse read
-            if ((*it)->mapped)
-                reads_dict[(*it)->query].fourth++;
-        }                       
     }
-    return 0;
+    Py_END_ALLOW_THREADS
+
+    if (status == 0 && this->truncated)
+        status = 1;
+    if (status == 0)
+        status = this->report_progress();
+    return status;
+}
+
+
+int MatchOutputParser::consume_into(CoverageAccumulator &accumulator) {
+    /* Parameters:
+      * accumulator: A CoverageAccumulator that each alignment is added to
+     * Functionality:
+      * Parses a SAM or BAM file in the same manner as consume() except that alignments are folded into the
+      CoverageAccumulator as they are read rather than being stored as MATCH instances.
+      * Alignments are only borrowed from the parser's buffer so memory is independent of the number of alignments.
+      * Doesn't use the Python API, except to report progress, so it may be called without the GIL.
+      * Returns 0 on success, or 1 if the file couldn't be parsed or the progress callable raised an exception.
+    */
+     if(!this->good()) {
+         std::cerr << "ERROR: Unable to open '"<< filename <<"' for reading." << std::endl;
+         return 1;
+     }
+
+    if (this->parse_header(this->ref_lengths) < 0)
+        return 1;
+
+    // Reads can be weighed as soon as their last alignment is parsed if the header declares them to be grouped
+    if (this->name_grouped())
+        accumulator.grouped = true;
+    // Reference sequences can be closed as soon as the next one starts if the alignments are sorted by coordinate.
+    // Reads span reference sequences so those kept for their multiplicity are only identified by the hash of their name
+    if (this->coordinate_sorted()) {
+        accumulator.coordinate_sorted = true;
+        accumulator.reads.verify_names = false;
+    }
+
+    int status = this->consume_alignments(accumulator);
+    if (status == 0)
+        status = this->report_progress();
+    return status;
+}
+
+
+int MatchOutputParser::consume_alignments(CoverageAccumulator &accumulator) {
+    /* Parameters:
+      * accumulator: A CoverageAccumulator that each alignment is added to
+     * Functionality:
+      * The alignment loop of consume_into(), run once the header has been parsed.
+      * Returns 0 on success, or 1 if the progress callable raised an exception or the file is truncated.
+    */
+    ALIGNMENT aln;
+
+    while (this->next_alignment(aln)) {
+        if (this->count_alignment(aln))
+            accumulator.add_alignment(aln);
+        else
+            accumulator.add_unmapped(aln);
+        if (this->progress_due() && this->report_progress() != 0)
+            return 1;
+    }
+    return this->truncated ? 1 : 0;
 }
 
 
-long identify_multireads(map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
-                         map<std::string, float > &multireads, unsigned long &multi, unsigned long &num_singletons) {
+long identify_multireads(ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
+                         unsigned long &multi, unsigned long &num_singletons) {
     /* Parameters:
-      * reads_dict: A map indexed by read-names with QUADRUPLE values that store all reads in the SAM file
-      * multireads: An empty map that is passed by reference of strings indexing floats
+      * reads_dict: A ReadTable indexed by read-names with QUADRUPLE values that store all reads in the SAM file
      * Functionality:
       * Count the number of orphan reads (reads with mates that didn't map), multireads, and secondary hits
       * Counting singletons: iterate through all read names (keys) in reads_dict
@@ -299,20 +967,17 @@ long identify_multireads(map<std::string, struct QUADRUPLE<bool, bool, unsigned
     */
     long num_secondary_hits = 0;
 
-    for ( map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> >::iterator it = reads_dict.begin();
-          it != reads_dict.end();
-          ++it) {
-        if( !(it->second.first && it->second.second) )
+    deque<READ_ENTRY<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > >::iterator it;
+    for (it = reads_dict.entries.begin(); it != reads_dict.entries.end(); ++it) {
+        if( !(it->value.first && it->value.second) )
             num_singletons++;
-        if( it->second.third > 1) {
+        if( it->value.third > 1) {
             multi++;
-            multireads[it->first] = 0.0;
-            num_secondary_hits += it->second.third-1;
+            num_secondary_hits += it->value.third-1;
         }
-        if( it->second.fourth  > 1) {
+        if( it->value.fourth  > 1) {
             multi++;
-            multireads[it->first] = 0.0;
-            num_secondary_hits += it->second.fourth-1;
+            num_secondary_hits += it->value.fourth-1;
         }
     }
 
@@ -334,10 +999,10 @@ float calculate_weight(int parity, struct QUADRUPLE<bool, bool, unsigned int, un
 
 
 void assign_read_weights(vector<MATCH* > &all_reads,
-                         map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict) {
+                         ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict) {
     /* Parameters:
       * all_reads: A complete list of MATCH instances, one for each mapped read
-      * reads_dict: A map indexed by read-names with QUADRUPLE values that store all reads in the SAM file
+      * reads_dict: A ReadTable indexed by read-names with QUADRUPLE values that store all reads in the SAM file
      * Functionality:
       * Basically calculates the weights such that the sum of the paired reads is 1 - for FPKM calculation
       * Iterate through the all_reads vector and depending on whether the read was forward (parity == false) or reverse
@@ -346,7 +1011,7 @@ void assign_read_weights(vector<MATCH* > &all_reads,
     */
     int n = 0;
     for ( vector<MATCH *>::iterator it = all_reads.begin(); it != all_reads.end(); ++it)  {
-        (*it)->w = calculate_weight((*it)->parity, reads_dict[(*it)->query]);
+        (*it)->w = calculate_weight((*it)->parity, *reads_dict.find((*it)->query));
         n++;
     }
 
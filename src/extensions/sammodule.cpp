@@ -1,7 +1,6 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <cstdlib>
-#include <iostream>
 #include "sambamparser.h"
 #include <string.h>
 //#include "helper.h"
@@ -34,16 +33,40 @@ static int module_clear(PyObject *m) {
 // Function signatures go here
 static PyObject *get_mapped_reads(PyObject *self, PyObject *args);
 
+static PyObject *get_reference_alignments(PyObject *self, PyObject *args);
+
 static PyObject *get_alignment_strings(PyObject *self, PyObject *args);
+
+static PyObject *get_reference_coverage(PyObject *self, PyObject *args);
+
+static PyObject *get_alignment_columns(PyObject *self, PyObject *args);
+
+static PyObject *get_reference_lengths(PyObject *self, PyObject *args);
+
+static PyObject *get_index_stats(PyObject *self, PyObject *args);
+
+static PyObject *decode_cigar_string(PyObject *self, PyObject *args);
 // End function signatures
 
 
 // Docstrings for functions go here
 static char get_mapped_reads_docstring[] =
-        "Parses a SAM file and returns the read names of every read that was mapped to a reference sequence.\n";
+        "Parses a SAM or BAM file and returns the read names of every read that was mapped to a reference sequence.\n";
+static char get_reference_alignments_docstring[] =
+        "Parses a SAM or BAM file and returns the alignments to each reference sequence, indexed by its name.\n";
 
 static char get_alignment_strings_docstring[] =
         "Parses a SAM file and returns a string representing the first eight fields for every alignment made.\n";
+static char get_reference_coverage_docstring[] =
+        "Parses a SAM or BAM file and returns a dictionary of alignment statistics summed for each reference sequence.\n";
+static char get_alignment_columns_docstring[] =
+        "Parses a SAM or BAM file and returns the alignments that passed the thresholds as columns of values.\n";
+static char get_reference_lengths_docstring[] =
+        "Parses the header of a SAM or BAM file and returns a dictionary of reference sequence lengths.\n";
+static char get_index_stats_docstring[] =
+        "Reads the index of a BAM file and returns the number of mapped and unmapped records of each reference sequence.\n";
+static char decode_cigar_docstring[] =
+        "Decodes a CIGAR string and returns its aligned length, read length and soft-clipped lengths at either end.\n";
 // End of docstrings
 
 // Define all of the module methods in this:
@@ -52,11 +75,34 @@ static PyMethodDef module_methods[] = {
         get_mapped_reads,
         METH_VARARGS,
         get_mapped_reads_docstring},
-        {NULL, NULL, 0, NULL},
+        {"get_reference_alignments",
+        get_reference_alignments,
+        METH_VARARGS,
+        get_reference_alignments_docstring},
         {"get_alignment_strings",
         get_alignment_strings,
         METH_VARARGS,
         get_alignment_strings_docstring},
+        {"get_reference_coverage",
+        get_reference_coverage,
+        METH_VARARGS,
+        get_reference_coverage_docstring},
+        {"get_alignment_columns",
+        get_alignment_columns,
+        METH_VARARGS,
+        get_alignment_columns_docstring},
+        {"get_reference_lengths",
+        get_reference_lengths,
+        METH_VARARGS,
+        get_reference_lengths_docstring},
+        {"get_index_stats",
+        get_index_stats,
+        METH_VARARGS,
+        get_index_stats_docstring},
+        {"decode_cigar",
+        decode_cigar_string,
+        METH_VARARGS,
+        decode_cigar_docstring},
         {NULL, NULL, 0, NULL}
 };
 
@@ -89,61 +135,113 @@ PyMODINIT_FUNC PyInit__sam_module(void) {
 
     if(PyType_Ready(&MatchType) < 0)
         return NULL;
+
+    if(PyType_Ready(&ColumnType) < 0)
+        return NULL;
     
     Py_INCREF((PyObject *) &MatchType);
     PyModule_AddObject(m, "MATCH", (PyObject *) &MatchType);
 
+    Py_INCREF((PyObject *) &ColumnType);
+    PyModule_AddObject(m, "Column", (PyObject *) &ColumnType);
+
     return m;
 }
 
-static PyObject *get_mapped_reads(PyObject *self, PyObject *args) {
+static int progress_from_arg(PyObject *progress_py, PyObject **progress) {
     /*
-      * Create a new SamFileParser instance
-      * Read the alignments using SamFileParser::consume_sam()
-      * Identify the reads with multiple alignments (mutlireads)
-      * Redistribute the weights of these reads based on its alignment multiplicity
-      * Return a list of interleaved `read_name`s and `reference_name, weight, left-most position, CIGAR`
+      * Sets progress to the optional progress callable passed to one of the module's functions, or NULL if None
+      * Returns 0 on success, or 1 with a Python exception set if progress_py isn't callable
     */
-    char * aln_file;  // This could either be a SAM or BAM file
-    char * index;
-    bool all_alignments;  // A flag indicating whether secondary and supplementary alignments should be used (True)
-    int aln_percent;  // The minimum alignment length - this currently isn't used here
-    int min_map_qual;  // The minimum mapping quality
-    if (!PyArg_ParseTuple(args, "sbiis", &aln_file, &all_alignments, &aln_percent, &min_map_qual, &index)) {
-        return NULL;
+    *progress = NULL;
+    if (progress_py == NULL || progress_py == Py_None)
+        return 0;
+    if (!PyCallable_Check(progress_py)) {
+        PyErr_SetString(PyExc_TypeError, "progress must be callable.");
+        return 1;
     }
+    *progress = progress_py;
+    return 0;
+}
 
-    PyObject *mapping_info_py = PyList_New(0);
-    std::cout << "Parsing alignment file " << aln_file << std::endl;
+static void log_info(const std::string &message) {
+    /*
+      * Passes a message to Python's logging.info so it is written wherever samsum's log is, rather than to stdout
+      * Must be called with the GIL held. Exceptions raised while logging are cleared
+    */
+    PyObject *logging = PyImport_ImportModule("logging");
+    if (logging == NULL) {
+        PyErr_Clear();
+        return;
+    }
+    PyObject *result = PyObject_CallMethod(logging, "info", "s", message.c_str());
+    if (result == NULL)
+        PyErr_Clear();
+    Py_XDECREF(result);
+    Py_DECREF(logging);
+}
+
+static void set_parse_error(MatchOutputParser &sam_file) {
+    /*
+      * Sets a Python IOError for an alignment file that couldn't be parsed, unless an exception raised by the progress
+      callable is already set, in which case it is passed on
+    */
+    if (PyErr_Occurred())
+        return;
+    if (sam_file.truncated)
+        PyErr_Format(PyExc_IOError, "'%s' is truncated or corrupted.", sam_file.filename.c_str());
+    else
+        PyErr_Format(PyExc_IOError, "Unable to parse alignments from '%s'.", sam_file.filename.c_str());
+}
+
+static int read_matches(char *aln_file, bool all_alignments, int aln_percent, int min_map_qual,
+                        PyObject *progress, unsigned int progress_interval,
+                        vector<MATCH *> &mapped_reads, vector<std::string> &ref_names) {
+    /*
+      * Create a new SamFileParser or BamFileParser instance, depending on the alignment file's format
+      * Read the alignments using MatchOutputParser::consume(), which releases the GIL while parsing and passes the
+      number of lines, bytes, mapped and unmapped alignments parsed to the optional progress callable at most every
+      progress_interval milliseconds
+      * Alignments below the mapping quality or aligned percentage thresholds are filtered while parsing, so no MATCH is
+      created for them; their weights are added to the unmapped fragments
+      * Identify the reads with multiple alignments (mutlireads)
+      * Redistribute the weights of these reads based on its alignment multiplicity
+      * mapped_reads is populated with the MATCH instances, followed by one storing the weight of the unmapped
+      fragments, and ref_names with the names of the reference sequences indexed by their ref_id
+      * Returns 0 on success, or 1 with a Python exception set if the file couldn't be parsed, in which case
+      mapped_reads is empty
+    */
+    log_info("Parsing alignment file " + std::string(aln_file) + "\n");
 
-    bool verbose = true;
-    vector<MATCH *> mapped_reads;
     float unmapped_weight_sum;
-    cout << "Reserving space for mapped reads... " << std::flush;
-    mapped_reads.reserve(8000000); // still required if 
-    cout << "done." << endl;
-    map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > reads_dict;
-    map<std::string, float > multireads;
-
-    SamFileParser sam_file(aln_file, "sam");
-    int status = sam_file.consume_sam(mapped_reads, all_alignments, verbose);
-    if ( status > 0 )
-        return mapping_info_py;
-
-    if (check_reads_paired(mapped_reads))
+    ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > reads_dict;
+    vector<FILTERED_ALIGNMENT> filtered;
+
+    MatchOutputParser *aln_parser = open_alignment_file(aln_file);
+    MatchOutputParser &sam_file = *aln_parser;
+    sam_file.set_progress(progress, progress_interval);
+    int status = sam_file.consume(mapped_reads, all_alignments, min_map_qual, aln_percent, reads_dict, filtered);
+    if ( status > 0 ) {
+        for (vector<MATCH *>::iterator it = mapped_reads.begin(); it != mapped_reads.end(); ++it)
+            Py_DECREF((PyObject *) *it);
+        mapped_reads.clear();
+        set_parse_error(sam_file);
+        delete aln_parser;
+        return 1;
+    }
+
+    if (check_reads_paired(mapped_reads, filtered))
         unmapped_weight_sum = (sam_file.num_unmapped*0.5);
     else
         unmapped_weight_sum = sam_file.num_unmapped;
 
-    sam_file.alignment_multiplicity_audit(mapped_reads, reads_dict);
-
     // Identify multireads with and count the number of secondary adn supplementary alignments
-    long num_secondary_hits = identify_multireads(reads_dict, multireads,
-                                                  sam_file.num_multireads, sam_file.num_singletons);
+    long num_secondary_hits = identify_multireads(reads_dict, sam_file.num_multireads, sam_file.num_singletons);
 
     // Redistribute read weights using multiple alignment information in reads_dict
+    // Alignments that fell below the thresholds while parsing only contribute their weight to the unmapped fragments
     assign_read_weights(mapped_reads, reads_dict);
-    remove_low_quality_matches(mapped_reads, min_map_qual, unmapped_weight_sum);
+    add_filtered_weights(filtered, reads_dict, unmapped_weight_sum);
 
     // Set the SamFileParser values
     sam_file.unique_queries = reads_dict.size();
@@ -154,42 +252,112 @@ static PyObject *get_mapped_reads(PyObject *self, PyObject *args) {
     
     MATCH *unmapped = Match_cnew();
     unmapped->w = unmapped_weight_sum;
-    unmapped->query = "NA";
-    unmapped->subject = "UNMAPPED";
+    unmapped->query = strdup("NA");
+    unmapped->subject = PyUnicode_InternFromString("UNMAPPED");
+    unmapped->ref_id = -1;
     unmapped->parity = 0;
     mapped_reads.push_back(unmapped);
+    set_match_subjects(mapped_reads, sam_file.ref_names);
+    ref_names.swap(sam_file.ref_names);
 
-    // Print the various SAM alignment stats
-    if ( verbose )
-        std::cout << sam_file.summarise();
-
-    if ( verbose )
-        cout << "Calculating alignment positions... " << std::flush;
+    // Log the various SAM alignment stats
+    log_info(sam_file.summarise());
 
-    add_alignment_positions(mapped_reads, index); //update match end and read_length
+    delete aln_parser;
+    return 0;
+}
 
-    if ( verbose )
-        cout << "done." << endl << std::flush;
+static PyObject *get_mapped_reads(PyObject *self, PyObject *args) {
+    /*
+      * Read the alignments that passed the thresholds as MATCH instances with read_matches()
+      * Return a list of the MATCH instances in the order they were parsed, followed by one with the subject
+      "UNMAPPED" storing the weight of the unmapped fragments
+    */
+    char * aln_file;  // This could either be a SAM or BAM file
+    char * index;
+    bool all_alignments;  // A flag indicating whether secondary and supplementary alignments should be used (True)
+    int aln_percent;  // The minimum percentage of a read's length that must be aligned
+    int min_map_qual;  // The minimum mapping quality
+    PyObject *progress_py = NULL;  // An optional callable that is passed the parsing statistics
+    unsigned int progress_interval = 1000;  // The minimum number of milliseconds between calls to progress
+    PyObject *progress;
+    if (!PyArg_ParseTuple(args, "sbiis|OI", &aln_file, &all_alignments, &aln_percent, &min_map_qual, &index,
+                          &progress_py, &progress_interval)) {
+        return NULL;
+    }
+    if (progress_from_arg(progress_py, &progress) > 0)
+        return NULL;
 
-    if ( verbose )
-        cout << "Building alignment list... " <<std::flush;
+    vector<MATCH *> mapped_reads;
+    vector<std::string> ref_names;
+    if (read_matches(aln_file, all_alignments, aln_percent, min_map_qual, progress, progress_interval,
+                     mapped_reads, ref_names) > 0)
+        return PyErr_Occurred() ? NULL : PyList_New(0);
+
+    // The list steals the reference to each MATCH so they are freed along with the list
+    PyObject *mapping_info_py = PyList_New(mapped_reads.size());
+    for (size_t i = 0; i < mapped_reads.size(); i++)
+        PyList_SET_ITEM(mapping_info_py, i, (PyObject *)mapped_reads[i]);
+    return mapping_info_py;
+}
 
-    long x = 0;
-    vector<MATCH *>::iterator qi_it;
-    for (qi_it = mapped_reads.begin(); qi_it != mapped_reads.end(); ++qi_it ) {
-        MATCH *mt = (*qi_it);
-        if (PyList_Append(mapping_info_py, Py_BuildValue("O", (PyObject *)mt)) == -1)
-            x++;
+static PyObject *get_reference_alignments(PyObject *self, PyObject *args) {
+    /*
+      * Read the alignments that passed the thresholds as MATCH instances with read_matches()
+      * Bucket the MATCH instances by their ref_id with a counting sort, which keeps the alignments of each reference
+      sequence in the order they were parsed
+      * Return a dictionary indexed by reference sequence names, in the order of their ref_id, with lists of their
+      MATCH instances. Reference sequences without alignments are omitted. The MATCH storing the weight of the unmapped
+      fragments is in a list under "UNMAPPED".
+    */
+    char * aln_file;  // This could either be a SAM or BAM file
+    bool all_alignments;  // A flag indicating whether secondary and supplementary alignments should be used (True)
+    int aln_percent;  // The minimum percentage of a read's length that must be aligned
+    int min_map_qual;  // The minimum mapping quality
+    PyObject *progress_py = NULL;  // An optional callable that is passed the parsing statistics
+    unsigned int progress_interval = 1000;  // The minimum number of milliseconds between calls to progress
+    PyObject *progress;
+    if (!PyArg_ParseTuple(args, "sbii|OI", &aln_file, &all_alignments, &aln_percent, &min_map_qual,
+                          &progress_py, &progress_interval)) {
+        return NULL;
     }
+    if (progress_from_arg(progress_py, &progress) > 0)
+        return NULL;
 
-    if ( verbose )
-        cout << "done." << endl << std::flush;
+    vector<MATCH *> mapped_reads;
+    vector<std::string> ref_names;
+    if (read_matches(aln_file, all_alignments, aln_percent, min_map_qual, progress, progress_interval,
+                     mapped_reads, ref_names) > 0)
+        return PyErr_Occurred() ? NULL : PyDict_New();
+
+    // Count the alignments of each reference sequence; the last bucket holds the unmapped MATCH
+    size_t n_refs = ref_names.size();
+    vector<size_t> counts(n_refs + 1, 0);
+    for (vector<MATCH *>::iterator it = mapped_reads.begin(); it != mapped_reads.end(); ++it)
+        counts[(*it)->ref_id < 0 ? n_refs : (*it)->ref_id]++;
+
+    vector<PyObject *> groups(n_refs + 1, NULL);
+    vector<size_t> filled(n_refs + 1, 0);
+    for (size_t i = 0; i <= n_refs; i++) {
+        if (counts[i] > 0)
+            groups[i] = PyList_New(counts[i]);
+    }
+    // Each list steals the reference to its MATCH instances
+    for (vector<MATCH *>::iterator it = mapped_reads.begin(); it != mapped_reads.end(); ++it) {
+        size_t i = (*it)->ref_id < 0 ? n_refs : (*it)->ref_id;
+        PyList_SET_ITEM(groups[i], filled[i]++, (PyObject *)*it);
+    }
 
-    if (x > 0) {
-        sprintf(sam_file.buf, "WARNING: Failed to append %ld/%zu items into mapped reads list.", x, mapped_reads.size());
-        cerr << sam_file.buf << endl;
+    PyObject *grouped_py = PyDict_New();
+    for (size_t i = 0; i <= n_refs; i++) {
+        if (groups[i] == NULL)
+            continue;
+        // Every MATCH in a group shares the same subject string, which is used as the key
+        PyObject *subject = ((MATCH *)PyList_GET_ITEM(groups[i], 0))->subject;
+        PyDict_SetItem(grouped_py, subject, groups[i]);
+        Py_DECREF(groups[i]);
     }
-    return mapping_info_py;
+    return grouped_py;
 }
 
 static PyObject *get_alignment_strings(PyObject *self, PyObject *args) {
@@ -208,6 +376,323 @@ static PyObject *get_alignment_strings(PyObject *self, PyObject *args) {
     }
 
     PyObject *mapping_info_py = PyList_New(0);
-    std::cout << "Parsing alignment file " << aln_file << std::endl;
+    log_info("Parsing alignment file " + std::string(aln_file) + "\n");
     return mapping_info_py;
 }
+
+
+static int regions_from_list(PyObject *regions_py, vector<REGION> &regions) {
+    /*
+      * Converts a Python sequence of (name, start, end) tuples, with 0-based half-open coordinates, into REGIONs
+      * Returns 0 on success, or 1 with a Python exception set
+    */
+    PyObject *seq = PySequence_Fast(regions_py, "Regions must be a sequence of (name, start, end) tuples.");
+    if (seq == NULL)
+        return 1;
+    Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+    for (Py_ssize_t i = 0; i < n; i++) {
+        const char *name;
+        unsigned int beg, end;
+        if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(seq, i), "sII", &name, &beg, &end)) {
+            Py_DECREF(seq);
+            return 1;
+        }
+        REGION region;
+        region.name = name;
+        region.beg = beg;
+        region.end = end;
+        regions.push_back(region);
+    }
+    Py_DECREF(seq);
+    return 0;
+}
+
+static int accumulate_alignments(char *aln_file, CoverageAccumulator &accumulator, int n_threads, bool name_grouped,
+                                 const char *index_file, vector<REGION> &regions,
+                                 PyObject *progress, unsigned int progress_interval,
+                                 unsigned long long bytes_beg, unsigned long long bytes_end,
+                                 vector<double> &weights, double &unmapped_weight) {
+    /*
+      * Create a new SamFileParser or BamFileParser instance, depending on the alignment file's format
+      * If index_file is given, only the alignments overlapping regions are read by seeking to the chunks found in
+      the BAM index. The weight of every fragment outside of the regions is then estimated from the number of records
+      in the index and included in the unmapped weight, so the total number of fragments estimates that of the whole
+      file. The index doesn't tell secondary and supplementary records apart, so these are counted as fragments too
+      * If bytes_end is greater than zero, only the alignment lines of a SAM file that start in [bytes_beg, bytes_end)
+      are read, so a file whose reads' alignments are adjacent can be parsed in separate parts
+      * If name_grouped is true, or the header declares the alignments to be sorted or grouped by query name, each
+      read's weights are calculated as soon as its alignments have been parsed and only one read is held in memory
+      * Fold each alignment into the CoverageAccumulator using MatchOutputParser::consume_into() without the GIL.
+      SAM files are split into n_threads byte ranges that are parsed in parallel and merged in order
+      * The number of lines, bytes, mapped and unmapped alignments parsed is passed to the optional progress callable
+      at most every progress_interval milliseconds
+      * Redistribute the weights of multireads based on their alignment multiplicity with CoverageAccumulator::finalize()
+      * Returns 0 on success, or 1 with a Python exception set
+    */
+    int status;
+
+    log_info("Parsing alignment file " + std::string(aln_file) + "\n");
+
+    MatchOutputParser *aln_parser = open_alignment_file(aln_file);
+    MatchOutputParser &sam_file = *aln_parser;
+    sam_file.set_threads(n_threads);
+    sam_file.set_progress(progress, progress_interval);
+    accumulator.grouped = name_grouped;
+    if (index_file != NULL && sam_file.restrict_to(index_file, regions) != 0) {
+        PyErr_Format(PyExc_IOError, "Unable to restrict '%s' to regions with the index '%s'.", aln_file, index_file);
+        delete aln_parser;
+        return 1;
+    }
+    if (bytes_end > 0 && sam_file.restrict_to_bytes(bytes_beg, bytes_end) != 0) {
+        PyErr_Format(PyExc_ValueError, "Unable to restrict '%s' to a byte range.", aln_file);
+        delete aln_parser;
+        return 1;
+    }
+
+    // No Python objects are touched while parsing so other Python threads are free to run
+    Py_BEGIN_ALLOW_THREADS
+    status = sam_file.consume_into(accumulator);
+    Py_END_ALLOW_THREADS
+
+    if (status > 0) {
+        set_parse_error(sam_file);
+        delete aln_parser;
+        return 1;
+    }
+    if (accumulator.grouped)
+        log_info("Alignments are grouped by query name; weighing reads as they are parsed.\n");
+    else if (accumulator.coordinate_sorted)
+        log_info("Alignments are sorted by coordinate; summarising reference sequences as they are parsed.\n");
+
+    status = accumulator.finalize(weights, unmapped_weight);
+    if (status == 6) {
+        PyErr_SetString(PyExc_ValueError, "Alignments are not sorted by coordinate, as declared by the header.");
+        delete aln_parser;
+        return 1;
+    }
+    else if (status > 0) {
+        PyErr_SetString(PyExc_ValueError, "Mixture of single- and paired-end reads detected in alignments.");
+        delete aln_parser;
+        return 1;
+    }
+
+    if (index_file != NULL) {
+        // Each primary record is a whole fragment for single-end reads and half of one for paired-end reads.
+        // If the regions held no reads, the first record of the file tells whether the library is paired
+        bool paired = sam_file.first_paired == 1;
+        if (accumulator.num_paired + accumulator.num_unpaired > 0)
+            paired = accumulator.num_unpaired == 0;
+        double record_weight = paired ? 0.5 : 1.0;
+        // The index counts secondary and supplementary records with the mapped ones but doesn't tell them apart,
+        // so every record is taken to be primary and the total is an estimate that is too large if there are any
+        double mapped_weight = 0.0;
+        for (size_t i = 0; i < weights.size(); i++)
+            mapped_weight += weights[i];
+        unmapped_weight = record_weight*sam_file.num_indexed - mapped_weight;
+        if (unmapped_weight < 0)
+            unmapped_weight = 0;
+    }
+
+    long num_secondary_hits = accumulator.identify_multireads(sam_file.num_multireads, sam_file.num_singletons);
+    sam_file.unique_queries = accumulator.num_reads();
+    sam_file.secondary_alns = num_secondary_hits;
+    sam_file.num_distinct_reads_mapped = sam_file.num_mapped - num_secondary_hits;
+
+    log_info(sam_file.summarise());
+    delete aln_parser;
+    return 0;
+}
+
+static PyObject *get_reference_coverage(PyObject *self, PyObject *args) {
+    /*
+      * Parse the alignment file with accumulate_alignments()
+      * Return a dictionary indexed by reference names with tuples of
+      `reads_mapped, weight_total, bases_mapped, bases_covered, leftmost, rightmost` as values.
+      The weight of the unmapped fragments is stored under "UNMAPPED".
+    */
+    char * aln_file;  // This could either be a SAM or BAM file
+    bool all_alignments;  // A flag indicating whether secondary and supplementary alignments should be used (True)
+    int aln_percent;  // The minimum percentage of a read that must be aligned
+    int min_map_qual;  // The minimum mapping quality
+    int n_threads = 1;  // The number of threads used for decompressing BAM files or parsing SAM files
+    int name_grouped = 0;  // A flag indicating the alignments of each read are adjacent, regardless of the header
+    char *index_file = NULL;  // Path to the BAM file's index, needed if regions are given
+    PyObject *regions_py = NULL;  // A sequence of (name, start, end) tuples that the alignments are restricted to
+    PyObject *progress_py = NULL;  // An optional callable that is passed the parsing statistics
+    unsigned int progress_interval = 1000;  // The minimum number of milliseconds between calls to progress
+    PyObject *progress;
+    if (!PyArg_ParseTuple(args, "sbii|iizOOI", &aln_file, &all_alignments, &aln_percent, &min_map_qual, &n_threads,
+                          &name_grouped, &index_file, &regions_py, &progress_py, &progress_interval)) {
+        return NULL;
+    }
+    vector<REGION> regions;
+    if (regions_py != NULL && regions_py != Py_None && regions_from_list(regions_py, regions) > 0)
+        return NULL;
+    if (progress_from_arg(progress_py, &progress) > 0)
+        return NULL;
+
+    CoverageAccumulator accumulator(all_alignments, aln_percent, min_map_qual);
+    vector<double> weights;
+    double unmapped_weight;
+    if (accumulate_alignments(aln_file, accumulator, n_threads, name_grouped != 0, index_file, regions,
+                              progress, progress_interval, 0, 0, weights, unmapped_weight) > 0)
+        return NULL;
+
+    PyObject *coverage_py = PyDict_New();
+    for (unsigned int i = 0; i < accumulator.refs.size(); i++) {
+        REFSTAT &ref = accumulator.refs[i];
+        PyObject *ref_stats = Py_BuildValue("(kdKKII)", ref.reads_mapped, weights[i], ref.bases_mapped,
+                                            accumulator.bases_covered(i), ref.leftmost, ref.rightmost);
+        PyDict_SetItemString(coverage_py, accumulator.ref_names[i].c_str(), ref_stats);
+        Py_DECREF(ref_stats);
+    }
+    PyObject *unmapped = Py_BuildValue("(kdKKII)", 0UL, unmapped_weight, 0ULL, 0ULL, 0U, 0U);
+    PyDict_SetItemString(coverage_py, "UNMAPPED", unmapped);
+    Py_DECREF(unmapped);
+
+    return coverage_py;
+}
+
+static PyObject *get_alignment_columns(PyObject *self, PyObject *args) {
+    /*
+      * Parse the alignment file with accumulate_alignments(), storing each alignment that passed the thresholds
+      in a struct-of-arrays ALIGNMENT_COLUMNS instead of a MATCH instance. The alignments of a SAM file can be
+      restricted to the lines that start in the byte range [bytes_beg, bytes_end)
+      * Return a dictionary with a Column for each of `ref_id`, `start`, `end`, `weight`, `mapq` and `read_length`,
+      the list of reference names indexed by ref_id (`ref_names`) and the weight of unmapped fragments (`unmapped`).
+      The Columns can be wrapped by numpy.frombuffer without copying.
+    */
+    char * aln_file;  // This could either be a SAM or BAM file
+    bool all_alignments;  // A flag indicating whether secondary and supplementary alignments should be used (True)
+    int aln_percent;  // The minimum percentage of a read that must be aligned
+    int min_map_qual;  // The minimum mapping quality
+    int n_threads = 1;  // The number of threads used for decompressing BAM files or parsing SAM files
+    int name_grouped = 0;  // A flag indicating the alignments of each read are adjacent, regardless of the header
+    char *index_file = NULL;  // Path to the BAM file's index, needed if regions are given
+    PyObject *regions_py = NULL;  // A sequence of (name, start, end) tuples that the alignments are restricted to
+    PyObject *progress_py = NULL;  // An optional callable that is passed the parsing statistics
+    unsigned int progress_interval = 1000;  // The minimum number of milliseconds between calls to progress
+    unsigned long long bytes_beg = 0;  // The offset of the start of the byte range of a SAM file to parse
+    unsigned long long bytes_end = 0;  // The offset of the end of the byte range, or 0 to parse the whole file
+    PyObject *progress;
+    if (!PyArg_ParseTuple(args, "sbii|iizOOIKK", &aln_file, &all_alignments, &aln_percent, &min_map_qual, &n_threads,
+                          &name_grouped, &index_file, &regions_py, &progress_py, &progress_interval,
+                          &bytes_beg, &bytes_end)) {
+        return NULL;
+    }
+    vector<REGION> regions;
+    if (regions_py != NULL && regions_py != Py_None && regions_from_list(regions_py, regions) > 0)
+        return NULL;
+    if (progress_from_arg(progress_py, &progress) > 0)
+        return NULL;
+
+    ALIGNMENT_COLUMNS columns;
+    CoverageAccumulator accumulator(all_alignments, aln_percent, min_map_qual);
+    accumulator.columns = &columns;
+    vector<double> weights;
+    double unmapped_weight;
+    if (accumulate_alignments(aln_file, accumulator, n_threads, name_grouped != 0, index_file, regions,
+                              progress, progress_interval, bytes_beg, bytes_end, weights, unmapped_weight) > 0)
+        return NULL;
+
+    PyObject *ref_names = PyList_New(accumulator.ref_names.size());
+    for (unsigned int i = 0; i < accumulator.ref_names.size(); i++)
+        PyList_SET_ITEM(ref_names, i, PyUnicode_FromString(accumulator.ref_names[i].c_str()));
+
+    return Py_BuildValue("{s:N,s:d,s:N,s:N,s:N,s:N,s:N,s:N}",
+                         "ref_names", ref_names,
+                         "unmapped", unmapped_weight,
+                         "ref_id", Column_from_vector(columns.ref_id, "I"),
+                         "start", Column_from_vector(columns.start, "I"),
+                         "end", Column_from_vector(columns.end, "I"),
+                         "weight", Column_from_vector(columns.weight, "f"),
+                         "mapq", Column_from_vector(columns.mapq, "B"),
+                         "read_length", Column_from_vector(columns.read_length, "I"));
+}
+
+static PyObject *get_reference_lengths(PyObject *self, PyObject *args) {
+    /*
+      * Create a new SamFileParser or BamFileParser instance, depending on the alignment file's format
+      * Parse only the header of the alignment file with MatchOutputParser::parse_header()
+      * Return a dictionary of reference sequence lengths indexed by their names, in the order of the header.
+      The dictionary is empty if the header has no @SQ lines.
+    */
+    char * aln_file;  // This could either be a SAM or BAM file
+    if (!PyArg_ParseTuple(args, "s", &aln_file)) {
+        return NULL;
+    }
+
+    MatchOutputParser *aln_parser = open_alignment_file(aln_file);
+    if (!aln_parser->good() || aln_parser->parse_header(aln_parser->ref_lengths) < 0) {
+        PyErr_Format(PyExc_IOError, "Unable to parse the header of '%s'.", aln_file);
+        delete aln_parser;
+        return NULL;
+    }
+
+    PyObject *lengths_py = PyDict_New();
+    vector<pair<std::string, unsigned long> >::iterator it;
+    for (it = aln_parser->ref_lengths.begin(); it != aln_parser->ref_lengths.end(); ++it) {
+        PyObject *length = PyLong_FromUnsignedLong(it->second);
+        PyDict_SetItemString(lengths_py, it->first.c_str(), length);
+        Py_DECREF(length);
+    }
+    delete aln_parser;
+
+    return lengths_py;
+}
+
+static PyObject *get_index_stats(PyObject *self, PyObject *args) {
+    /*
+      * Parse the header of a BAM file for its reference sequence names and read its BAI or CSI index with BamIndex
+      * Return a dictionary indexed by reference names with tuples of `mapped, unmapped`, the number of records
+      in the index's metadata for each reference sequence. The number of unplaced, unmapped records is stored under
+      "*" as `(0, unmapped)`.
+    */
+    char * aln_file;
+    char * index_file;
+    if (!PyArg_ParseTuple(args, "ss", &aln_file, &index_file)) {
+        return NULL;
+    }
+
+    MatchOutputParser *aln_parser = open_alignment_file(aln_file);
+    if (!aln_parser->good() || aln_parser->parse_header(aln_parser->ref_lengths) < 0) {
+        PyErr_Format(PyExc_IOError, "Unable to parse the header of '%s'.", aln_file);
+        delete aln_parser;
+        return NULL;
+    }
+    BamIndex index;
+    if (index.load(index_file) != 0) {
+        PyErr_Format(PyExc_IOError, "Unable to read the BAM index '%s'.", index_file);
+        delete aln_parser;
+        return NULL;
+    }
+
+    PyObject *stats_py = PyDict_New();
+    for (size_t i = 0; i < aln_parser->ref_lengths.size() && i < index.refs.size(); i++) {
+        PyObject *counts = Py_BuildValue("(KK)", index.refs[i].n_mapped, index.refs[i].n_unmapped);
+        PyDict_SetItemString(stats_py, aln_parser->ref_lengths[i].first.c_str(), counts);
+        Py_DECREF(counts);
+    }
+    PyObject *unplaced = Py_BuildValue("(KK)", 0ULL, index.n_no_coor);
+    PyDict_SetItemString(stats_py, "*", unplaced);
+    Py_DECREF(unplaced);
+    delete aln_parser;
+
+    return stats_py;
+}
+
+
+static PyObject *decode_cigar_string(PyObject *self, PyObject *args) {
+    /*
+      * Decode a CIGAR string with the same decoder that is used while parsing alignment files
+      * Return a tuple of `aligned_length, read_length, clip_start, clip_end`: the number of reference and query bases
+      consumed by the CIGAR and the number of soft-clipped bases at the start and end of the read
+    */
+    char *cigar;
+    if (!PyArg_ParseTuple(args, "s", &cigar)) {
+        return NULL;
+    }
+    CIGAR_LENGTHS lengths;
+    decode_cigar(cigar, lengths);
+    return Py_BuildValue("(IIII)", lengths.aln_len, lengths.read_len, lengths.clip_start, lengths.clip_end);
+}
@@ -9,13 +9,16 @@ PyObject *Match_new(PyTypeObject *type, PyObject *args, PyObject *kwargs){
 
     if (!self) return NULL;
 
-    self->query[0] = '\0';
-    self->subject[0] = '\0';
-    self->cigar[0] = '\0';
+    self->query = NULL;
+    self->subject = NULL;
+    self->cigar = NULL;
+    self->ref_id = -1;
     self->start = 0;
     self->end = 0;
     self->mq = 0;
     self->read_length = 0;
+    self->clip_start = 0;
+    self->clip_end = 0;
     self->percent_id = 0.0;
     self->paired = true;
     self->parity= true;
@@ -32,16 +35,26 @@ PyObject *Match_new(PyTypeObject *type, PyObject *args, PyObject *kwargs){
 
 static int Match_init(MATCH *self, PyObject *args, PyObject *kwargs){
     static char* kwlist[] = {"start", "end" , "weight", "query", "cigar", "subject", "read_length", "percent_id", NULL};
+    char *query, *cigar, *subject;
 
     if(! PyArg_ParseTupleAndKeywords(args, kwargs, "iifsssif", kwlist,
-           &self->start, &self->end, &self->w, &self->query, &self->cigar, &self->subject, &self->read_length, &self->percent_id))
+           &self->start, &self->end, &self->w, &query, &cigar, &subject, &self->read_length, &self->percent_id))
         return -1;
+    // The strings are borrowed from the arguments so the MATCH keeps its own copies
+    free(self->query);
+    free(self->cigar);
+    Py_XDECREF(self->subject);
+    self->query = strdup(query);
+    self->cigar = strdup(cigar);
+    self->subject = PyUnicode_InternFromString(subject);
     return 0;
 
 }
 
 static void Match_dealloc(MATCH *self){
+    free(self->query);
     free(self->cigar);
+    Py_XDECREF(self->subject);
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
@@ -51,15 +64,18 @@ static PyMemberDef Match_members[] = {
     {"weight", T_FLOAT, offsetof(MATCH, w), 0, "Match attribute"},
     {"query", T_STRING , offsetof(MATCH, query), 0, "Match attribute"}, //string type are read_only after passing to python
     {"cigar", T_STRING , offsetof(MATCH, cigar), 0, "Match attribute"},
-    {"subject", T_STRING , offsetof(MATCH, subject), 0, "Match attribute"},
-    {"read_length", T_FLOAT, offsetof(MATCH, read_length), 0, "Match attribute"},
+    {"subject", T_OBJECT , offsetof(MATCH, subject), READONLY, "Match attribute"},
+    {"ref_id", T_INT , offsetof(MATCH, ref_id), READONLY, "Match attribute"},
+    {"read_length", T_UINT, offsetof(MATCH, read_length), 0, "Match attribute"},
+    {"clip_start", T_UINT, offsetof(MATCH, clip_start), 0, "Match attribute"},
+    {"clip_end", T_UINT, offsetof(MATCH, clip_end), 0, "Match attribute"},
     {"percent_id", T_FLOAT , offsetof(MATCH, percent_id), 0, "Match attribute"},
     {NULL}
 };
 
 PyObject *Match_repr(MATCH *self) {
 	if (self->mapped) {
-		return PyUnicode_FromFormat("<Match> %s (%d) mapped to %s",
+		return PyUnicode_FromFormat("<Match> %s (%d) mapped to %S",
 		                            self->query, self->read_length, self->subject);
 	} else {
 		return PyUnicode_FromFormat("<Match> %s (%d) was not aligned",
@@ -117,44 +133,200 @@ PyTypeObject MatchType = {
     Match_new,                 /* tp_new */
 };
 
-unsigned int decode_cigar(MATCH* self){
-    unsigned int read_len = 0;
-    unsigned int aln_len = 0 ;
-
-    string consume_ref =  "MDN=X";
-	string consume_query = "MIS=X";
-	
-	string buffer = "";
-
-    char * c;
-    for (c = self->cigar; *c != '\0'; c++ ){
-		if(isdigit(*c)){
-			buffer = buffer + *c;
-		} else {
-			if(consume_ref.find(*c) != string::npos){
-				aln_len += atoi(buffer.c_str());
-			}
-            if (consume_query.find(*c) != string::npos){
-				read_len += atoi(buffer.c_str());
-			}
-			buffer = "";
-        }
-    }
+static void Column_dealloc(COLUMN *self){
+    if (self->owner)
+        self->release(self->owner);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int Column_getbuffer(COLUMN *self, Py_buffer *view, int flags) {
+    /*
+      * Exposes the COLUMN's data as a writable, contiguous one-dimensional buffer.
+    */
+    static char empty[1] = {0};
+    view->obj = (PyObject *)self;
+    Py_INCREF(self);
+    view->buf = self->data ? self->data : empty;
+    view->len = self->length*self->itemsize;
+    view->readonly = 0;
+    view->itemsize = self->itemsize;
+    view->format = (flags & PyBUF_FORMAT) ? const_cast<char *>(self->format) : NULL;
+    view->ndim = 1;
+    view->shape = (flags & PyBUF_ND) ? &self->length : NULL;
+    view->strides = (flags & PyBUF_STRIDES) ? &self->itemsize : NULL;
+    view->suboffsets = NULL;
+    view->internal = NULL;
+    return 0;
+}
+
+static Py_ssize_t Column_length(COLUMN *self) {
+    return self->length;
+}
+
+static PyBufferProcs Column_as_buffer = {
+    (getbufferproc)Column_getbuffer,
+    (releasebufferproc)0,
+};
+
+static PySequenceMethods Column_as_sequence = {
+    (lenfunc)Column_length,    /* sq_length */
+};
+
+PyTypeObject ColumnType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_sam_module.Column",      /* tp_name */
+    sizeof(COLUMN),            /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)Column_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    &Column_as_sequence,       /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    &Column_as_buffer,         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "Column of alignment values exposed through the buffer protocol", /* tp_doc */
+};
 
-    if (read_len == 0)
-        PyErr_SetString(PyExc_ValueError, "alignment length calculated from CIGAR was zero.");
+static inline void add_cigar_op(unsigned int op, unsigned int op_len, CIGAR_LENGTHS &lengths) {
+    /* Parameters:
+      * op: The BAM code of a CIGAR operation, from 0 to 8 for MIDNSHP=X
+      * op_len: The length of the operation
+      * lengths: The CIGAR_LENGTHS of the operations before this one, which are updated
+     * Functionality:
+      * Adds the operation's length to the reference and query lengths if it consumes them. Soft clips before any
+      other operation that consumes the reference or query are at the start of the read, all others at its end.
+    */
+    // Bit masks of the operations (by their BAM codes) that consume the reference and the query, respectively
+    const unsigned int consume_ref = 0x18D;  // M, D, N, =, X
+    const unsigned int consume_query = 0x193;  // M, I, S, =, X
+    if (op == 4) {
+        if (lengths.aln_len == 0 && lengths.read_len == lengths.clip_start)
+            lengths.clip_start += op_len;
+        else
+            lengths.clip_end += op_len;
+    }
+    if ((consume_ref >> op) & 1)
+        lengths.aln_len += op_len;
+    if ((consume_query >> op) & 1)
+        lengths.read_len += op_len;
+}
 
-    self->read_length = read_len;
+void decode_cigar(const char *cigar, CIGAR_LENGTHS &lengths) {
+    /* Parameters:
+      * cigar: A CIGAR string from a SAM file
+      * lengths: Reference to a CIGAR_LENGTHS that is populated
+     * Functionality:
+      * Decodes the CIGAR string in a single pass, accumulating each operation's length from its digits, and sums the
+      lengths of the operations that consume the reference (aligned length) and those that consume the query (read
+      length), as well as the soft clips at either end. Unknown operations, such as the '*' of a missing CIGAR, are
+      ignored.
+    */
+    static const char ops[] = "MIDNSHP=X";
+    memset(&lengths, 0, sizeof(CIGAR_LENGTHS));
+    unsigned int op_len = 0;
+    for (const char *c = cigar; *c != '\0'; c++) {
+        if (*c >= '0' && *c <= '9') {
+            op_len = 10*op_len + (*c - '0');
+            continue;
+        }
+        const char *op = strchr(ops, *c);
+        if (op != NULL)
+            add_cigar_op(op - ops, op_len, lengths);
+        op_len = 0;
+    }
+}
 
-    return aln_len;
+void decode_cigar_ops(const uint32_t *cigar_ops, unsigned int n_cigar_op, CIGAR_LENGTHS &lengths) {
+    /* Parameters:
+      * cigar_ops: Binary CIGAR operations from a BAM record; the lower four bits are the operation (MIDNSHP=X)
+      and the upper 28 bits are the operation length
+      * n_cigar_op: The number of operations in cigar_ops
+      * lengths: Reference to a CIGAR_LENGTHS that is populated
+     * Functionality:
+      * The binary equivalent of decode_cigar().
+    */
+    memset(&lengths, 0, sizeof(CIGAR_LENGTHS));
+    for (unsigned int i = 0; i < n_cigar_op; i++) {
+        if ((cigar_ops[i] & 0xf) <= 8)
+            add_cigar_op(cigar_ops[i] & 0xf, cigar_ops[i] >> 4, lengths);
+    }
+}
 
+void decode_alignment_cigar(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: An ALIGNMENT with a start position and either a text cigar or binary cigar_ops
+     * Functionality:
+      * Decodes the alignment's CIGAR once, setting its end position, read length and soft-clipped lengths.
+    */
+    CIGAR_LENGTHS lengths;
+    if (aln.cigar)
+        decode_cigar(aln.cigar, lengths);
+    else
+        decode_cigar_ops(aln.cigar_ops, aln.n_cigar_op, lengths);
+    aln.end = aln.start + lengths.aln_len;
+    aln.read_length = lengths.read_len;
+    aln.clip_start = lengths.clip_start;
+    aln.clip_end = lengths.clip_end;
+}
 
+std::string cigar_ops_to_string(const uint32_t *cigar_ops, unsigned int n_cigar_op) {
+    /* Parameters:
+      * cigar_ops: Binary CIGAR operations from a BAM record
+      * n_cigar_op: The number of operations in cigar_ops
+     * Functionality:
+      * Returns the text representation of the binary CIGAR operations, as it would be written in a SAM file.
+    */
+    const char *op_codes = "MIDNSHP=X";
+    std::string cigar;
+    char buffer[16];
+    if (n_cigar_op == 0)
+        return "*";
+    for (unsigned int i = 0; i < n_cigar_op; i++) {
+        sprintf(buffer, "%u%c", cigar_ops[i] >> 4, op_codes[(cigar_ops[i] & 0xf) % 9]);
+        cigar.append(buffer);
+    }
+    return cigar;
 }
 
-void update_end_and_read_length(MATCH * self){
-    if (self->subject == "UNMAPPED")
-        return ;
+MATCH *Match_from_alignment(ALIGNMENT &aln) {
+    /* Parameters:
+      * aln: An ALIGNMENT populated by one of the MatchOutputParser classes
+     * Functionality:
+      * Creates a new MATCH instance with copies of the ALIGNMENT's query and cigar, since those are borrowed from the
+      parser. Only the reference sequence's ref_id is stored; its name is shared by all of its alignments and is set
+      once the names of every reference sequence are known, with set_match_subjects().
+    */
+    MATCH *match = Match_cnew();
+    if (!match) return NULL;
 
-    unsigned int aln_len = decode_cigar(self);
-    self->end = self->start + aln_len;
-}
\ No newline at end of file
+    match->query = strdup(aln.query);
+    match->subject = NULL;
+    match->ref_id = aln.ref_id;
+    if (aln.cigar)
+        match->cigar = strdup(aln.cigar);
+    else
+        match->cigar = strdup(cigar_ops_to_string(aln.cigar_ops, aln.n_cigar_op).c_str());
+    match->start = aln.start;
+    match->end = aln.end;
+    match->read_length = aln.read_length;
+    match->clip_start = aln.clip_start;
+    match->clip_end = aln.clip_end;
+    match->mq = aln.mq;
+    match->paired = aln.paired;
+    match->parity = aln.parity;
+    match->mapped = aln.mapped;
+    match->orphan = aln.orphan;
+    match->multi = aln.multi;
+    match->chimeric = aln.chimeric;
+    match->singleton = aln.singleton;
+    return match;
+}
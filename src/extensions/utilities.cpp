@@ -1,27 +1,105 @@
 #include <stdlib.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include "utilities.h"
 
-/*
-CML -- this function has been made robust to lines that are >1000 characters
-by allocating more space for buf if required
-*/
-void split(const string &strn, std::vector<char *> &v, char *buf, char d) {
-  if (strn.length() > 1000 )
-      buf = (char *) malloc ((strn.length() + 1) * sizeof(char));
-  strcpy(buf, strn.c_str());
+void split(const string &strn, std::vector<char *> &v, std::vector<char> &buf, char d) {
+  /*
+    Copies strn into buf, which grows as needed for long lines, and splits the copy on the delimiter d in place.
+    The pointers in v are only valid until buf is modified.
+  */
+  buf.assign(strn.begin(), strn.end());
+  buf.push_back('\0');
+  char *c = &buf[0];
   v.clear();
   v.reserve(15);
-  v.push_back(buf);
-  while(*buf != '\0') {
-     if(*buf==d) {
-       *buf = '\0';
-       v.push_back(buf+1);
+  v.push_back(c);
+  while(*c != '\0') {
+     if(*c==d) {
+       *c = '\0';
+       v.push_back(c+1);
      }
-     buf++;
+     c++;
   }
 }
 
 
+MappedFile::MappedFile() {
+    this->data = NULL;
+    this->size = 0;
+    this->opened = false;
+    this->released = 0;
+}
+
+
+MappedFile::~MappedFile() {
+    this->close();
+}
+
+
+bool MappedFile::open(const std::string &filename) {
+    /* Parameters:
+      * filename: Path to a regular file
+     * Functionality:
+      * Maps the whole file into memory for reading. The kernel is advised that the file will be read sequentially
+      so it reads ahead of the pages being scanned.
+      * Returns true if the file was opened, even if it is empty and therefore not mapped.
+    */
+    this->close();
+    int fd = ::open(filename.c_str(), O_RDONLY);
+    if (fd < 0)
+        return false;
+    struct stat st;
+    if (fstat(fd, &st) != 0 || !S_ISREG(st.st_mode)) {
+        ::close(fd);
+        return false;
+    }
+    this->size = st.st_size;
+    if (this->size > 0) {
+        void *addr = mmap(NULL, this->size, PROT_READ, MAP_PRIVATE, fd, 0);
+        if (addr == MAP_FAILED) {
+            ::close(fd);
+            this->size = 0;
+            return false;
+        }
+        madvise(addr, this->size, MADV_SEQUENTIAL);
+        this->data = static_cast<const char *>(addr);
+    }
+    // The mapping remains valid once the file descriptor is closed
+    ::close(fd);
+    this->opened = true;
+    return true;
+}
+
+
+void MappedFile::release(size_t end) {
+    /* Parameters:
+      * end: Offset in the file that no bytes before will be read again
+     * Functionality:
+      * Drops the pages before end from memory, so the resident memory of a sequential scan doesn't grow with the size
+      of the file. The pages are read from the file again if they are accessed.
+    */
+    size_t page_size = sysconf(_SC_PAGESIZE);
+    end -= end % page_size;
+    if (this->data == NULL || end <= this->released)
+        return;
+    madvise(const_cast<char *>(this->data) + this->released, end - this->released, MADV_DONTNEED);
+    this->released = end;
+}
+
+
+void MappedFile::close() {
+    if (this->data != NULL)
+        munmap(const_cast<char *>(this->data), this->size);
+    this->data = NULL;
+    this->size = 0;
+    this->opened = false;
+    this->released = 0;
+}
+
+
 char* lstrip(char *str, char c) {
     /* utilities::lstrip:
       Parameters:
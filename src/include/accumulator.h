@@ -0,0 +1,131 @@
+#ifndef _ACCUMULATOR
+#define _ACCUMULATOR
+#include <map>
+#include <string>
+#include <vector>
+#include <algorithm>
+#include <climits>
+#include <stdint.h>
+#include "types.h"
+#include "readtable.h"
+
+using namespace std;
+
+// Destination index used for alignments whose weight is redirected to the unmapped fragments
+#define UNMAPPED_DEST -1
+
+struct REFSTAT {
+    /*
+      * Summary statistics for all of the alignments to a single reference sequence
+      * reads_mapped is the number of alignments that passed the mapping quality and aligned percentage thresholds
+      * bases_mapped is the sum of the aligned lengths, used for calculating the mean depth
+      * leftmost and rightmost are the outermost alignment coordinates
+      * intervals stores the [start, end) coordinates of alignments, periodically merged into disjoint intervals
+      * merged is the number of disjoint intervals after the last merge
+      * closed is true once the intervals of coordinate-sorted input have been merged into covered and freed
+     */
+    unsigned long reads_mapped;
+    unsigned long long bases_mapped;
+    unsigned int leftmost, rightmost;
+    vector<pair<unsigned int, unsigned int> > intervals;
+    size_t merged;
+    unsigned long long covered;
+    bool closed;
+};
+
+struct READSTAT {
+    /*
+      * pair follows the convention of reads_dict in MatchOutputParser::consume:
+      first and second are true if a forward or reverse alignment of the read was seen, respectively, while
+      third and fourth count the number of forward and reverse alignments
+      * fwd_dest and rev_dest are the destinations (reference index or UNMAPPED_DEST) of the first alignments
+     */
+    struct QUADRUPLE<bool, bool, unsigned int, unsigned int> pair;
+    int fwd_dest, rev_dest;
+};
+
+struct EXTRA_DEST {
+    /*
+      * Destination of an alignment beyond the first for a read and parity, i.e. a multiread
+     */
+    READSTAT *read;
+    bool parity;
+    int dest;
+};
+
+struct ALIGNMENT_COLUMNS {
+    /*
+      * Struct-of-arrays storage for the alignments that passed the thresholds, one element per alignment.
+      * reads and parities are only needed until finalize() has calculated the weights.
+     */
+    vector<uint32_t> ref_id;
+    vector<uint32_t> start;
+    vector<uint32_t> end;
+    vector<float> weight;
+    vector<uint8_t> mapq;
+    vector<uint32_t> read_length;
+    vector<READSTAT *> reads;
+    vector<bool> parities;
+};
+
+class CoverageAccumulator {
+    public:
+        /* Class Variables */
+        bool multireads;
+        int min_aln;
+        unsigned int min_map_qual;
+        unsigned long num_unmapped;
+        unsigned long num_paired;
+        unsigned long num_unpaired;
+        unsigned long num_multi_records;
+        vector<std::string> ref_names;
+        vector<REFSTAT> refs;
+        map<std::string, unsigned int> ref_index;
+        // Caches the index in refs of each ref_id assigned by the parser, or -1 if it hasn't been looked up
+        vector<int> ref_slots;
+        ReadTable<READSTAT> reads;
+        vector<EXTRA_DEST> extra;
+        ALIGNMENT_COLUMNS *columns;
+        // Variables for name-grouped input, where the reads are weighed and forgotten one group at a time
+        bool grouped;
+        std::string group_name;
+        // Variables for coordinate-sorted input, where each reference sequence is closed once the next one starts
+        bool coordinate_sorted;
+        bool out_of_order;
+        int current_ref;
+        // Totals of the reads that have already been weighed and removed from the reads table, or never added to it
+        size_t flushed_columns;
+        vector<double> flushed_weights;
+        double flushed_unmapped_weight;
+        unsigned long flushed_reads, flushed_multi, flushed_singletons;
+        long flushed_secondary;
+        // Variables for merging the accumulator of a byte range parsed in parallel into that of the preceding ranges.
+        // The position of each read's first alignments, its other alignments and columns are recorded in the order added
+        bool track_order;
+        uint64_t num_added;
+        vector<uint64_t> first_order;
+        vector<uint64_t> extra_order;
+        vector<uint32_t> extra_entry;
+        vector<uint32_t> column_entry;
+        /* Class Functions */
+        CoverageAccumulator(bool multireads, int min_aln, unsigned int min_map_qual);
+        unsigned int get_ref_index(const char *ref_name, int ref_id=-1);
+        unsigned int find_ref_index(const char *ref_name);
+        void add_alignment(ALIGNMENT &aln);
+        void add_unmapped(ALIGNMENT &aln);
+        void sum_read_weights(vector<double> &weights, double &unmapped_weight);
+        void weigh_columns(size_t start);
+        long count_multireads(unsigned long &multi, unsigned long &num_singletons);
+        void flush_group();
+        void close_reference(int ref_i);
+        void weigh_by_flags(ALIGNMENT &aln, int dest);
+        void merge(CoverageAccumulator &other);
+        int finalize(vector<double> &weights, double &unmapped_weight);
+        long identify_multireads(unsigned long &multi, unsigned long &num_singletons);
+        unsigned long num_reads();
+        unsigned long long bases_covered(unsigned int ref_i);
+};
+
+unsigned long long merge_intervals(vector<pair<unsigned int, unsigned int> > &intervals);
+
+#endif //_ACCUMULATOR
@@ -0,0 +1,64 @@
+#ifndef _BAMINDEX
+#define _BAMINDEX
+#include <map>
+#include <string>
+#include <vector>
+#include <stdint.h>
+#include "bgzf.h"
+
+using namespace std;
+
+struct BAM_CHUNK {
+    /*
+      * A range of BGZF virtual file offsets, [beg, end). The upper 48 bits of a virtual offset are the address of a
+      BGZF block in the compressed file and the lower 16 bits are an offset within the uncompressed block.
+     */
+    uint64_t beg;
+    uint64_t end;
+};
+
+struct REGION {
+    /*
+      * A region of a reference sequence with 0-based, half-open [beg, end) coordinates, as in a BED file
+     */
+    std::string name;
+    uint32_t beg;
+    uint32_t end;
+};
+
+struct INDEX_REF {
+    /*
+      * The index of a single reference sequence: the chunks of each bin, the minimum virtual offset of each
+      2^min_shift window (BAI only) and the number of mapped and placed-but-unmapped records from the metadata bin.
+     */
+    map<uint32_t, vector<BAM_CHUNK> > bins;
+    map<uint32_t, uint64_t> loffsets;
+    vector<uint64_t> intervals;
+    uint64_t n_mapped;
+    uint64_t n_unmapped;
+};
+
+class BamIndex {
+    /*
+      * A BAI or CSI index of a coordinate-sorted BAM file.
+      * BAI files are a special case of CSI files with a min_shift of 14 and a depth of 5; the only other difference is
+      that BAI files store a linear index while CSI files store the lowest offset of each bin.
+     */
+    public:
+        /* Class Variables */
+        std::string filename;
+        int min_shift;
+        int depth;
+        vector<INDEX_REF> refs;
+        uint64_t n_no_coor;
+        /* Class Functions */
+        BamIndex();
+        int load(const std::string &filename);
+        uint32_t meta_bin();
+        void query(int ref_id, uint32_t beg, uint32_t end, vector<BAM_CHUNK> &chunks);
+        uint64_t num_records();
+};
+
+void merge_chunks(vector<BAM_CHUNK> &chunks);
+
+#endif //_BAMINDEX
@@ -0,0 +1,57 @@
+#ifndef _BGZF
+#define _BGZF
+#include <string>
+#include <vector>
+#include <fstream>
+#include <iostream>
+#include <stdint.h>
+#include <string.h>
+#include <zlib.h>
+#include <thread>
+
+using namespace std;
+
+#define BGZF_FOOTER_SIZE 8
+#define BGZF_MAX_BLOCK_SIZE 65536
+// The number of blocks read for each thread when blocks are decompressed in parallel
+#define BGZF_BLOCKS_PER_THREAD 16
+
+bool is_bgzf(const std::string &filename);
+
+int inflate_block(const char *src, size_t src_len, char *dst, size_t dst_len);
+
+int decompress_block(const vector<char> &block, vector<char> &data);
+
+class BgzfReader {
+    /*
+      * Reads the BGZF blocks of a BAM file, one block at a time, and provides a stream of the uncompressed bytes.
+     */
+    public:
+        /* Class Variables */
+        std::ifstream input;
+        std::string filename;
+        vector<char> compressed;
+        vector<char> data;
+        size_t offset;
+        unsigned long long block_address;
+        unsigned int n_threads;
+        vector<vector<char> > raw_batch;
+        vector<vector<char> > batch;
+        vector<unsigned long long> batch_addresses;
+        size_t batch_i;
+        // Set once a block is malformed, truncated or couldn't be decompressed, as opposed to the end of the file
+        bool failed;
+        /* Class Functions */
+        BgzfReader(const std::string &filename);
+        ~BgzfReader();
+        bool good();
+        void set_threads(unsigned int n_threads);
+        int read_raw_block(vector<char> &block);
+        size_t read_batch();
+        bool read_block();
+        size_t read(void *dst, size_t n);
+        bool seek(uint64_t virtual_offset);
+        uint64_t tell();
+};
+
+#endif //_BGZF
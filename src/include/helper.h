@@ -6,12 +6,15 @@
 #include <iterator>
 #include <assert.h>
 #include "types.h"
+#include "readtable.h"
 #include "sambamparser.h"
 
 using namespace std;
 
-void add_alignment_positions(vector<MATCH *> &all_reads, char* &index);
-void remove_low_quality_matches(vector<MATCH *> &mapped_reads, unsigned int min_map_qual, float &unmapped_weight_sum);
-bool check_reads_paired(vector<MATCH *> &mapped_reads);
+void add_filtered_weights(vector<FILTERED_ALIGNMENT> &filtered,
+                          ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
+                          float &unmapped_weight_sum);
+bool check_reads_paired(vector<MATCH *> &mapped_reads, vector<FILTERED_ALIGNMENT> &filtered);
+void set_match_subjects(vector<MATCH *> &mapped_reads, vector<std::string> &ref_names);
 
 #endif //_HELPER
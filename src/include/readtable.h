@@ -0,0 +1,149 @@
+#ifndef _READTABLE
+#define _READTABLE
+#include <deque>
+#include <vector>
+#include <stdint.h>
+#include <string.h>
+
+using namespace std;
+
+// The number of bytes in each block of a NameArena
+#define NAME_ARENA_BLOCK_SIZE 1048576
+
+uint64_t hash_read_name(const char *name);
+
+class NameArena {
+    /*
+      * Copies strings into large blocks of memory that are only freed when the arena is cleared or destroyed,
+      avoiding a heap allocation per string. The copies never move so pointers to them stay valid.
+     */
+    public:
+        /* Class Variables */
+        vector<char *> blocks;
+        size_t used;
+        /* Class Functions */
+        NameArena();
+        ~NameArena();
+        const char *copy(const char *str);
+        void clear();
+};
+
+template <typename V>
+struct READ_ENTRY {
+    /*
+      * A read in a ReadTable: the 64-bit hash of its name, the name itself if names are verified (NULL otherwise)
+      and the value associated with the read.
+     */
+    uint64_t hash;
+    const char *name;
+    V value;
+};
+
+template <typename V>
+class ReadTable {
+    /*
+      * An open-addressing hash table indexed by read names, replacing a map of strings.
+      * Reads are identified by a 64-bit hash of their name. If verify_names is true the names are also copied into a
+      NameArena so reads with colliding hashes are told apart; otherwise only the hash is stored.
+      * The entries are stored in a deque in the order they were inserted so pointers to values stay valid as the
+      table grows. The slots, linearly probed, only hold the index of an entry plus one (0 is empty).
+     */
+    public:
+        /* Class Variables */
+        bool verify_names;
+        deque<READ_ENTRY<V> > entries;
+        vector<uint32_t> slots;
+        size_t mask;
+        NameArena names;
+        /* Class Functions */
+        ReadTable(bool verify_names=true) {
+            this->verify_names = verify_names;
+            this->slots.assign(1024, 0);
+            this->mask = this->slots.size() - 1;
+        }
+
+        size_t size() {
+            return this->entries.size();
+        }
+
+        void clear() {
+            /* Removes every read. If few slots are used they are emptied individually rather than reallocated,
+            which keeps clearing cheap when the table only ever holds a handful of reads. */
+            if (8*this->entries.size() < this->slots.size()) {
+                for (size_t n = 0; n < this->entries.size(); n++) {
+                    size_t i = this->entries[n].hash & this->mask;
+                    while (this->slots[i] != n + 1)
+                        i = (i + 1) & this->mask;
+                    this->slots[i] = 0;
+                }
+            }
+            else {
+                this->slots.assign(1024, 0);
+                this->mask = this->slots.size() - 1;
+            }
+            this->entries.clear();
+            this->names.clear();
+        }
+
+        size_t probe(uint64_t hash, const char *name) {
+            /* Returns the slot that holds the read with this hash and name, or the empty slot it would be put in */
+            size_t i = hash & this->mask;
+            while (this->slots[i] != 0) {
+                READ_ENTRY<V> &entry = this->entries[this->slots[i] - 1];
+                if (entry.hash == hash && (!this->verify_names || strcmp(entry.name, name) == 0))
+                    break;
+                i = (i + 1) & this->mask;
+            }
+            return i;
+        }
+
+        V *find(const char *name) {
+            /* Returns a pointer to the value of the read, or NULL if the read is not in the table */
+            size_t i = this->probe(hash_read_name(name), name);
+            if (this->slots[i] == 0)
+                return NULL;
+            return &this->entries[this->slots[i] - 1].value;
+        }
+
+        V &insert(const char *name, const V &initial, size_t *index=NULL) {
+            /* Returns the value of the read, inserting it with the initial value if it is not in the table.
+            If index is given it is set to the position of the read in entries. */
+            return this->insert_hashed(hash_read_name(name), name, initial, index);
+        }
+
+        V &insert_hashed(uint64_t hash, const char *name, const V &initial, size_t *index=NULL) {
+            /* As insert(), for a read whose hash has already been calculated, e.g. by another ReadTable */
+            size_t i = this->probe(hash, name);
+            if (this->slots[i] == 0) {
+                READ_ENTRY<V> entry;
+                entry.hash = hash;
+                entry.name = this->verify_names ? this->names.copy(name) : NULL;
+                entry.value = initial;
+                this->entries.push_back(entry);
+                this->slots[i] = this->entries.size();
+                // Keep the load factor below 0.7 so probe sequences remain short
+                if (10*this->entries.size() > 7*this->slots.size())
+                    this->grow();
+                if (index)
+                    *index = this->entries.size() - 1;
+                return this->entries.back().value;
+            }
+            if (index)
+                *index = this->slots[i] - 1;
+            return this->entries[this->slots[i] - 1].value;
+        }
+
+        void grow() {
+            /* Doubles the number of slots and re-inserts every entry using its stored hash */
+            this->slots.assign(2*this->slots.size(), 0);
+            this->mask = this->slots.size() - 1;
+            for (size_t n = 0; n < this->entries.size(); n++) {
+                size_t i = this->entries[n].hash & this->mask;
+                while (this->slots[i] != 0)
+                    i = (i + 1) & this->mask;
+                this->slots[i] = n + 1;
+            }
+        }
+};
+
+#endif //_READTABLE
@@ -4,12 +4,79 @@
 #include <iostream>
 #include <cstdlib>
 #include <fstream>
+#include <chrono>
 #include "utilities.h"
 #include "helper.h"
 #include "types.h"
+#include "accumulator.h"
+#include "bgzf.h"
+#include "bamindex.h"
 
 using namespace std;
 
+// The number of alignments parsed without the GIL before they are converted into MATCH instances
+#define ALIGNMENT_BATCH_SIZE 65536
+// The number of lines parsed between checks of whether progress should be reported
+#define PROGRESS_CHECK_LINES 4096
+
+template <typename T>
+bool decode_bitflag(unsigned int bitflag, T *match)  {
+    /* Parameters:
+      * bitflag: The second column in a SAM file with bitwise encodings of mapping information
+      * match: A MATCH or ALIGNMENT instance
+     * Functionality:
+      * Perform bit-wise calculations to get information on the read's alignment, mate pairing, etc.
+      * Returns `true` if either the first or second read in pair mapped, else `false`.
+      * Details for the MATCH and ALIGNMENT objects are in types.h
+    */
+
+    unsigned int a = bitflag;
+    bool orphan = 0;
+    bool non_primary = 0;  // This is True if neither of the non-primary or supplementary alignment bits are set
+    a = a >> 2;  // Skip the "read mapped" and "mapped in proper pair" bits
+    match->mapped = !(a&1);  // mapped == 1 if the read was mapped b/c the third (0x4) bit isn't set
+    orphan = a&1;  // orphan == 0 if the read was unmapped
+
+    a = a >> 1;  // Move to the next, "mate unmapped" bit
+    orphan = orphan^(a&1);  // `orphan` is 1 if the mate was unmapped (or doesn't exist) XOR `orphan` is set to 1
+
+    a = a >> 3;  // Move to the sixth (0x64) "first in pair" bit
+    if ( a&1 )  {
+        match->parity = false;
+        a = a >> 1;
+    }
+    else {
+        a = a >> 1;  // Move to the seventh (0x128) "second in pair" bit
+        if ( a&1 )
+            match->parity  = true;
+        else
+            return false;
+    }
+
+    a = a >> 1;  // Move to the eighth, "not primary alignment" position
+    non_primary = a&1;  // Should be 0 if it is the primary alignment
+    a = a >> 3;  // Move to the eleventh (0x2048) "supplementary alignment" bit position
+    match->multi = non_primary^(a&1);  // Is a multiread if it is either a non-primary XOR secondary alignment
+    match->chimeric = a&1;  // This hints at a possible chimera, but it would have to be validated downstream
+    match->singleton = orphan;
+    return true;
+}
+
+class AlignmentBuffer {
+    /*
+      * Copies of alignments parsed while the GIL is released, with their query names and CIGAR strings stored in text
+      at offsets, until they are converted into MATCH instances in bulk while the GIL is held.
+     */
+    public:
+        /* Class Variables */
+        vector<ALIGNMENT> alignments;
+        vector<char> text;
+        vector<size_t> offsets;
+        /* Class Functions */
+        void add(ALIGNMENT &aln);
+        int to_matches(vector<MATCH *> &matches);
+};
+
 class MatchOutputParser {
     protected:
         // The following variables are general file parsing stats
@@ -28,15 +95,47 @@ class MatchOutputParser {
         unsigned long num_distinct_reads_mapped;
         std::string filename;
         std::string format;
-        std::ifstream input;
-        char buf[1000];
+        vector<char> buf;
         vector<char *> fields;
+        vector<pair<std::string, unsigned long> > ref_lengths;
+        // The name of each reference sequence, indexed by the ref_id of the alignments
+        vector<std::string> ref_names;
+        unsigned long long num_indexed;
+        // Set if the alignments ended with a truncated or malformed record rather than at the end of the file
+        bool truncated;
+        // Whether the first record of a file restricted to regions is paired (1) or not (0), or -1 if it is unknown
+        int first_paired;
+        std::string sort_order;
+        std::string group_order;
+        // An optional Python callable that is passed the number of lines, bytes, mapped and unmapped alignments parsed,
+        // at most once every progress_interval milliseconds
+        PyObject *progress;
+        unsigned int progress_interval;
+        std::chrono::steady_clock::time_point last_progress;
         /* Class Functions */
         MatchOutputParser(const std::string &filename, const std::string &format);
         virtual ~MatchOutputParser() = 0;
         std::string summarise();
         unsigned long get_Num_Unmapped_Reads();
-        virtual bool nextline(MATCH *match)=0;
+        virtual bool good()=0;
+        virtual void set_threads(unsigned int n_threads);
+        virtual int parse_header(vector<pair<std::string, unsigned long> > &ref_lengths)=0;
+        virtual bool next_alignment(ALIGNMENT &aln)=0;
+        virtual int restrict_to(const std::string &index_file, const vector<REGION> &regions);
+        virtual int restrict_to_bytes(size_t beg, size_t end);
+        void parse_hd_line(const char *line);
+        bool name_grouped();
+        bool coordinate_sorted();
+        void set_progress(PyObject *progress, unsigned int interval);
+        virtual unsigned long long bytes_read();
+        bool progress_due();
+        int report_progress();
+        bool count_alignment(ALIGNMENT &aln);
+        int consume(vector<MATCH *> &all_reads, bool multireads, unsigned int min_map_qual, int min_aln,
+                    ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
+                    vector<FILTERED_ALIGNMENT> &filtered);
+        int consume_into(CoverageAccumulator &accumulator);
+        virtual int consume_alignments(CoverageAccumulator &accumulator);
 };
 
 //subclass of the MatchOutputParser
@@ -44,24 +143,70 @@ class SamFileParser: virtual public MatchOutputParser {
     public:
         /* Class Variables */
         std::string header_pattern;
-        std::string unmapped_pattern;
+        MappedFile mapped;
+        vector<char> record;
+        // Maps the names in ref_names to their ref_id. Names missing from the header are added as they are found
+        ReadTable<int> ref_ids;
+        // Variables for parsing byte ranges of the file in parallel. Lines are read from offset until range_end,
+        // which is the size of the file unless a range is parsed
+        unsigned int n_threads;
+        size_t offset;
+        size_t range_end;
+        // The byte range of the file that the alignments are restricted to by restrict_to_bytes(), if bytes_end > 0
+        size_t bytes_beg;
+        size_t bytes_end;
         /* Class Functions */
         SamFileParser(const std::string &filename, const std::string &format);
-        int parse_header(map<std::string, int> &ref_dict);
-        int consume_sam(vector<MATCH *> &all_reads, bool multireads, bool verbose);
-        int alignment_multiplicity_audit(vector<MATCH *> &all_reads,
-                                         map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict);
-        virtual bool nextline(MATCH *match);
+        virtual bool good();
+        virtual void set_threads(unsigned int n_threads);
+        virtual int restrict_to_bytes(size_t beg, size_t end);
+        virtual unsigned long long bytes_read();
+        virtual int consume_alignments(CoverageAccumulator &accumulator);
+        void seek_range(size_t beg, size_t end);
+        bool next_line(const char *&line, size_t &length);
+        virtual int parse_header(vector<pair<std::string, unsigned long> > &ref_lengths);
+        virtual bool next_alignment(ALIGNMENT &aln);
         bool getMateInfo(unsigned int i, MATCH *match);
         ~SamFileParser();
 };
 
-long identify_multireads(map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
-                         map<std::string, float > &multireads, unsigned long &multi, unsigned long &num_singleton_reads);
+//subclass of the MatchOutputParser for BGZF-compressed BAM files
+class BamFileParser: virtual public MatchOutputParser {
+    public:
+        /* Class Variables */
+        BgzfReader bgzf;
+        vector<char> record;
+        vector<uint32_t> cigar_ops;
+        // Variables for reading only the records that overlap regions, found with the BAM file's index
+        bool restricted;
+        BamIndex index;
+        vector<REGION> requested;
+        map<int32_t, vector<pair<uint32_t, uint32_t> > > regions;
+        vector<BAM_CHUNK> chunks;
+        size_t chunk_i;
+        bool in_chunk;
+        /* Class Functions */
+        BamFileParser(const std::string &filename, const std::string &format);
+        virtual bool good();
+        virtual unsigned long long bytes_read();
+        virtual void set_threads(unsigned int n_threads);
+        virtual int parse_header(vector<pair<std::string, unsigned long> > &ref_lengths);
+        virtual bool next_alignment(ALIGNMENT &aln);
+        virtual int restrict_to(const std::string &index_file, const vector<REGION> &regions);
+        int resolve_regions();
+        bool read_alignment(ALIGNMENT &aln);
+        bool overlaps_regions();
+        ~BamFileParser();
+};
+
+MatchOutputParser *open_alignment_file(const std::string &filename);
+
+long identify_multireads(ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict,
+                         unsigned long &multi, unsigned long &num_singleton_reads);
 
 float calculate_weight(int parity, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> &pair);
 
 void assign_read_weights(vector<MATCH *> &all_reads,
-                         map<std::string, struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict);
+                         ReadTable<struct QUADRUPLE<bool, bool, unsigned int, unsigned int> > &reads_dict);
 
 #endif //_MATHOUTPUTPARSER
@@ -6,6 +6,9 @@
 #include <iostream>
 #include <ctype.h>
 #include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <string>
 #include "structmember.h"
 using namespace std;
 
@@ -19,13 +22,19 @@ typedef struct {
       * multi is 1 if the read is not a primary alignment
       * chimeric is 1 if parts of the read aligned to different loci
       * singleton is 1 if the mate was not successfully aligned
+      * ref_id is the index of the reference sequence in the alignment file's header, or -1 for UNMAPPED
+      * end, read_length, clip_start and clip_end are decoded from the CIGAR while the alignment is parsed
+      * query and cigar are owned by the MATCH while subject is a reference to the reference sequence's name,
+      which is shared by all of its alignments
      */
     PyObject_HEAD
     char * query;
-    char *subject;
+    PyObject *subject;
     char *cigar;
+    int ref_id;
     /*unsigned int start, end, mq; */
     unsigned int start, end, mq, read_length;
+    unsigned int clip_start, clip_end;  // The number of soft-clipped bases at the start and end of the read
     bool paired;
     bool parity; // Forward or reverse
     bool mapped; // Did it map to a reference sequence
@@ -42,7 +51,108 @@ extern PyTypeObject MatchType;
 
 MATCH *Match_cnew(PyTypeObject *type = &MatchType);
 
-void update_end_and_read_length(MATCH * self);
+struct CIGAR_LENGTHS {
+    /*
+      * The lengths decoded from a CIGAR: the number of reference bases it consumes (aln_len), the number of query bases
+      it consumes (read_len) and the number of soft-clipped bases before and after the aligned bases
+     */
+    unsigned int aln_len;
+    unsigned int read_len;
+    unsigned int clip_start;
+    unsigned int clip_end;
+};
+
+void decode_cigar(const char *cigar, CIGAR_LENGTHS &lengths);
+
+void decode_cigar_ops(const uint32_t *cigar_ops, unsigned int n_cigar_op, CIGAR_LENGTHS &lengths);
+
+std::string cigar_ops_to_string(const uint32_t *cigar_ops, unsigned int n_cigar_op);
+
+typedef struct {
+    /*
+      * A light-weight alignment record that is not a Python object.
+      * The character pointers are borrowed from the parser's line buffer and are only valid until the next line is read.
+      * Boolean fields share their meaning with those in MATCH.
+      * Alignments from SAM files have a text cigar while those from BAM files have binary cigar_ops instead.
+      * ref_id is the index of subject in the parser's ref_names, or -1 if the read was not aligned.
+      * end, read_length, clip_start and clip_end are decoded from the CIGAR by decode_alignment_cigar() as the
+      alignment is parsed, so the CIGAR never needs to be decoded again.
+     */
+    char *query;
+    char *subject;
+    int ref_id;
+    char *cigar;
+    uint32_t *cigar_ops;
+    unsigned int n_cigar_op;
+    unsigned int start, end, mq, read_length;
+    unsigned int clip_start, clip_end;
+    bool paired;
+    bool parity;
+    bool mapped;
+    bool orphan;
+    bool multi;
+    bool chimeric;
+    bool singleton;
+} ALIGNMENT;
+
+MATCH *Match_from_alignment(ALIGNMENT &aln);
+
+void decode_alignment_cigar(ALIGNMENT &aln);
+
+struct FILTERED_ALIGNMENT {
+    /*
+      * An alignment that fell below the mapping quality or aligned percentage thresholds. No MATCH is created for it;
+      only the index of its read in the reads table, its parity and whether it is paired are kept so its weight can
+      be added to the unmapped fragments once the multiplicity of every read is known.
+     */
+    size_t read_i;
+    bool parity;
+    bool paired;
+};
+
+typedef struct {
+    /*
+      * A one-dimensional array that is shared with Python through the buffer protocol, e.g. by numpy.frombuffer,
+      without being copied.
+      * data is owned by a heap-allocated vector that is freed by release() when the COLUMN is deallocated.
+     */
+    PyObject_HEAD
+    void *owner;
+    void (*release)(void *owner);
+    char *data;
+    Py_ssize_t length;
+    Py_ssize_t itemsize;
+    const char *format;
+} COLUMN;
+
+extern PyTypeObject ColumnType;
+
+template <typename T>
+void release_vector(void *owner) {
+    delete static_cast<vector<T> *>(owner);
+}
+
+template <typename T>
+PyObject *Column_from_vector(vector<T> &values, const char *format) {
+    /* Parameters:
+      * values: A vector whose contents are moved into the new COLUMN, leaving it empty
+      * format: The struct module format character for the type T, e.g. "I" for unsigned int
+     * Functionality:
+      * Creates a COLUMN that takes ownership of the vector's contents without copying them.
+    */
+    COLUMN *column = (COLUMN *)ColumnType.tp_alloc(&ColumnType, 0);
+    if (!column) return NULL;
+
+    vector<T> *owned = new vector<T>();
+    owned->swap(values);
+    column->owner = owned;
+    column->release = release_vector<T>;
+    column->data = owned->empty() ? NULL : reinterpret_cast<char *>(&(*owned)[0]);
+    column->length = owned->size();
+    column->itemsize = sizeof(T);
+    column->format = format;
+    return (PyObject *)column;
+}
 
 template< typename A, typename B, typename C, typename D>
 struct QUADRUPLE {
@@ -10,7 +10,29 @@
 
 using namespace std;
 
-void split(const std::string  &strn, std::vector<char *> &v, char *buf, char d='\t');
+// The number of bytes scanned in a MappedFile before the pages behind them are released
+#define MAPPED_RELEASE_SIZE 16777216
+
+class MappedFile {
+    /*
+      * A read-only memory mapping of a whole file, so its lines can be scanned in place without being copied.
+      * data is NULL if the file couldn't be mapped, or is empty.
+     */
+    public:
+        /* Class Variables */
+        const char *data;
+        size_t size;
+        bool opened;
+        size_t released;
+        /* Class Functions */
+        MappedFile();
+        ~MappedFile();
+        bool open(const std::string &filename);
+        void release(size_t end);
+        void close();
+};
+
+void split(const std::string  &strn, std::vector<char *> &v, std::vector<char> &buf, char d='\t');
 
 bool match_string(const string &str, const string & stringtomatch, bool fromstart=false);
 
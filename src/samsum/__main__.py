@@ -7,12 +7,14 @@ import sys
 import argparse
 import logging
 
-from samsum.commands import (info, stats)
+from samsum.commands import (info, stats, multi, merge)
 
 usage = """
 samsum <command> [<args>]
 ** Commands include:
 stats          Write the number of reads that mapped to each reference sequence
+multi          Write matrices of reference sequence abundances with a column for each sample
+merge          Write the abundance table of alignment statistics from separately summarized alignment files
 ** Other commands:
 info           Display samsum version and other information.
 Use '-h' to get subcommand-specific help, e.g.
@@ -27,6 +29,8 @@ def main(cmd_args=None) -> int:
     :return: None
     """
     commands = {"stats": stats,
+                "multi": multi,
+                "merge": merge,
                 "info": info}
     parser = argparse.ArgumentParser(description='Summarize read recruitments to reference sequences')
     parser.add_argument('command', nargs='?')
@@ -2,23 +2,29 @@ __author__ = 'Connor Morgan-Lang'
 
 import logging
 import sys
+
+import numpy
+
 from samsum import classy
 
 
-def load_references(refseq_lengths: dict) -> dict:
+def load_references(refseq_lengths: dict) -> "classy.RefTable":
     """
+    Loads the reference sequences into a RefTable, indexed by the first word of each sequence name.
 
-    :param refseq_lengths:
-    :return:
+    :param refseq_lengths: A dictionary of sequence lengths indexed by their respective sequence names
+    :return: A RefTable with a row for each reference sequence
     """
-    logging.debug("Loading the reference sequences into objects... ")
-    references = {}
-    for seq_name in refseq_lengths:  # type: str
-        if seq_name in references:
-            logging.error("Duplicate reference sequence names encountered: %s\n" % seq_name)
-            sys.exit(3)
-        ref_seq = classy.RefSequence(seq_name, refseq_lengths[seq_name])
-        references[seq_name.split(' ')[0]] = ref_seq
+    logging.debug("Loading the reference sequences into a table... ")
+    keys = [seq_name.split(' ')[0] for seq_name in refseq_lengths]  # type: list
+    references = classy.RefTable(list(refseq_lengths), list(refseq_lengths.values()), keys)
+    if len(references.index) != len(keys):
+        seen = set()
+        for key in keys:
+            if key in seen:
+                logging.error("Duplicate reference sequence names encountered: %s\n" % key)
+                sys.exit(3)
+            seen.add(key)
     logging.debug("done.\n")
     return references
 
@@ -76,9 +82,365 @@ def load_reference_coverage(refseq_dict: dict, mapped_dict: dict, min_aln: int)
     return num_unmapped, mapped_total
 
 
-def calculate_normalization_metrics(genome_dict: dict, unmapped_weight: float) -> None:
+def load_reference_stats(refseq_dict: "classy.RefTable", ref_stats: dict) -> (float, float):
+    """
+    Loads the alignment statistics that were summed for each reference sequence by _sam_module.get_reference_coverage
+    into their respective rows of the RefTable. The thresholds for mapping quality and the aligned percentage were
+    already applied while parsing so the weights of those alignments are included in the UNMAPPED weight.
+
+    :param refseq_dict: A RefTable of the reference sequences
+    :param ref_stats: A dictionary of tuples indexed by reference sequence names, returned by
+     file_parsers.sam_coverage_ext
+    :return: Total alignment weights for unmapped reads and mapped reads
+    """
+    logging.info("Loading alignment statistics for each reference sequence... ")
+    num_unmapped = 0.0
+    if "UNMAPPED" in ref_stats and "UNMAPPED" not in refseq_dict:
+        num_unmapped = ref_stats["UNMAPPED"][1]
+    refseq_names = [name for name in ref_stats if name != "UNMAPPED" or "UNMAPPED" in refseq_dict]
+    stats = numpy.array([ref_stats[name] for name in refseq_names], dtype=numpy.float64).reshape(-1, 6)
+    reads_mapped, weight_total, bases_mapped, bases_covered, leftmost, rightmost = stats.T
+    refseq_dict.add_stats(refseq_dict.rows(refseq_names), reads_mapped.astype(numpy.int64), weight_total,
+                          bases_mapped, bases_covered, leftmost.astype(numpy.int64), rightmost.astype(numpy.int64))
+    mapped_total = float(weight_total.sum())
+
+    logging.info("done.\n")
+    return num_unmapped, mapped_total
+
+
+def interval_union_lengths(group_ids: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray,
+                           num_groups: int) -> numpy.ndarray:
+    """
+    Calculates the number of positions covered by the union of [start, end) intervals within each group with a sweep
+    over the intervals sorted by group and start position. Each interval only contributes the positions past the
+    furthest end of the intervals before it in its group, so overlapping and abutting intervals are merged.
+    Intervals that are already sorted (e.g. from a coordinate-sorted alignment file) are not sorted again, making this
+    linear rather than O(n log n).
+
+    :param group_ids: An array of integer group (e.g. reference sequence) indices, one for each interval
+    :param starts: An array of interval start positions
+    :param ends: An array of interval end positions
+    :param num_groups: The number of groups, the length of the returned array
+    :return: An array with the number of positions covered in each group
+    """
+    covered = numpy.zeros(num_groups, dtype=numpy.int64)
+    if len(starts) == 0:
+        return covered
+    # Offset the coordinates by the group so a single sort and running maximum works across all groups
+    offset = group_ids.astype(numpy.int64) << 32
+    start_keys = offset + starts
+    end_keys = offset + ends
+    if numpy.any(start_keys[1:] < start_keys[:-1]):
+        order = numpy.argsort(start_keys, kind="stable")
+        start_keys = start_keys[order]
+        end_keys = end_keys[order]
+        group_ids = group_ids[order]
+    furthest = numpy.maximum.accumulate(end_keys)
+    prev_furthest = numpy.empty_like(furthest)
+    prev_furthest[0] = start_keys[0]
+    prev_furthest[1:] = furthest[:-1]
+    contribution = numpy.clip(end_keys - numpy.maximum(start_keys, prev_furthest), 0, None)
+    numpy.add.at(covered, group_ids, contribution)
+    return covered
+
+
+def load_reference_columns(refseq_dict: "classy.RefTable", columns: dict) -> (float, float):
+    """
+    The vectorised equivalent of load_reference_stats for the alignment columns returned by
+    file_parsers.sam_columns_ext. The alignment statistics are summed for all reference sequences at once with numpy
+    before being added to their respective rows of the RefTable.
+
+    :param refseq_dict: A RefTable of the reference sequences
+    :param columns: A dictionary of alignment columns returned by file_parsers.sam_columns_ext
+    :return: Total alignment weights for unmapped reads and mapped reads
+    """
+    logging.info("Loading alignment columns for each reference sequence... ")
+    ref_names = columns["ref_names"]
+    num_refs = len(ref_names)
+    ref_ids = columns["ref_id"]
+    starts = columns["start"]
+    ends = columns["end"]
+
+    reads_mapped = numpy.bincount(ref_ids, minlength=num_refs)
+    weight_totals = numpy.bincount(ref_ids, weights=columns["weight"], minlength=num_refs)
+    bases_mapped = numpy.bincount(ref_ids, weights=ends - starts, minlength=num_refs)
+    bases_covered = interval_union_lengths(ref_ids, starts, ends, num_refs)
+    leftmost = numpy.full(num_refs, numpy.iinfo(numpy.uint32).max, dtype=numpy.int64)
+    numpy.minimum.at(leftmost, ref_ids, starts)
+    rightmost = numpy.zeros(num_refs, dtype=numpy.int64)
+    numpy.maximum.at(rightmost, ref_ids, ends)
+
+    refseq_dict.add_stats(refseq_dict.rows(ref_names), reads_mapped, weight_totals, bases_mapped, bases_covered,
+                          leftmost, rightmost)
+    logging.info("done.\n")
+
+    return columns["unmapped"], float(weight_totals.sum())
+
+
+def covered_intervals(group_ids: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray) -> tuple:
+    """
+    Merges the overlapping and abutting [start, end) intervals within each group into the disjoint intervals covering
+    the same positions, sorted by group and start position. The lengths of the merged intervals of a group sum to its
+    value from interval_union_lengths. Merged intervals can be concatenated with others and merged again, so the
+    covered positions of separate alignment files can be combined exactly.
+
+    :param group_ids: An array of integer group (e.g. reference sequence) indices, one for each interval
+    :param starts: An array of interval start positions
+    :param ends: An array of interval end positions
+    :return: A tuple of the group index, start and end arrays of the merged intervals
+    """
+    if len(starts) == 0:
+        return tuple(numpy.zeros(0, dtype=numpy.int64) for _ in range(3))
+    # Offset the coordinates by the group so a single sort and running maximum works across all groups
+    offset = group_ids.astype(numpy.int64) << 32
+    start_keys = offset + starts
+    end_keys = offset + ends
+    if numpy.any(start_keys[1:] < start_keys[:-1]):
+        order = numpy.argsort(start_keys, kind="stable")
+        start_keys = start_keys[order]
+        end_keys = end_keys[order]
+    furthest = numpy.maximum.accumulate(end_keys)
+    # A merged interval begins with each interval that starts past the furthest end of those before it
+    firsts = numpy.flatnonzero(numpy.concatenate(([True], start_keys[1:] > furthest[:-1])))
+    lasts = numpy.append(firsts[1:] - 1, len(start_keys) - 1)
+    merged_groups = start_keys[firsts] >> 32
+    return merged_groups, start_keys[firsts] - (merged_groups << 32), furthest[lasts] - (merged_groups << 32)
+
+
+def sufficient_stats(refseq_dict: "classy.RefTable", columns: dict, filters: tuple) -> dict:
+    """
+    Sums the alignment columns returned by file_parsers.sam_columns_ext into the statistics of each reference sequence
+    that can be added to those of other alignment files, so the alignments of a run split into chunks can be
+    summarized separately and merged with merge_sufficient_stats. Rather than the number of covered positions, the
+    merged intervals covered by the alignments of each reference sequence are kept.
+    The statistics are exact as long as all alignments of a read are in the same alignment file, since the weight of
+    each alignment depends on the number of alignments of its read.
+
+    :param refseq_dict: A RefTable of the reference sequences
+    :param columns: A dictionary of alignment columns returned by file_parsers.sam_columns_ext
+    :param filters: A tuple of the minimum mapping quality, the minimum aligned percentage and the multireads flag the
+     alignments were parsed with, which must be the same for all statistics that are merged
+    :return: A dictionary of numpy arrays with an element for each reference sequence, in the order of the RefTable's
+     rows, along with the merged intervals and the weight of the unmapped fragments
+    """
+    num_refs = len(refseq_dict)
+    row_ids = refseq_dict.rows(columns["ref_names"])[columns["ref_id"]]
+    starts = columns["start"]
+    ends = columns["end"]
+    leftmost = refseq_dict.length.copy()
+    numpy.minimum.at(leftmost, row_ids, starts)
+    rightmost = numpy.zeros(num_refs, dtype=numpy.int64)
+    numpy.maximum.at(rightmost, row_ids, ends)
+    interval_rows, interval_starts, interval_ends = covered_intervals(row_ids, starts, ends)
+    return {"names": numpy.array(refseq_dict.names),
+            "length": refseq_dict.length.copy(),
+            "filters": numpy.array(filters, dtype=numpy.int64),
+            "unmapped": numpy.array(columns["unmapped"], dtype=numpy.float64),
+            "reads_mapped": numpy.bincount(row_ids, minlength=num_refs),
+            "weight_total": numpy.bincount(row_ids, weights=columns["weight"], minlength=num_refs),
+            "bases_mapped": numpy.bincount(row_ids, weights=ends - starts, minlength=num_refs),
+            "leftmost": leftmost,
+            "rightmost": rightmost,
+            "interval_row": interval_rows,
+            "interval_start": interval_starts,
+            "interval_end": interval_ends}
+
+
+def merge_sufficient_stats(stats_list: list) -> dict:
     """
-    Calculates the normalized abundance values for each header's RefSeq instance in genome_dict
+    Adds together the statistics of alignment files to the same reference sequences, returned by sufficient_stats.
+    The merged statistics are those of a single alignment file with all of their alignments.
+
+    :param stats_list: A list of dictionaries returned by sufficient_stats or file_parsers.read_sufficient_stats
+    :return: A dictionary of the merged statistics
+    """
+    merged = dict(stats_list[0])
+    for stats in stats_list[1:]:
+        if not (numpy.array_equal(stats["names"], merged["names"]) and
+                numpy.array_equal(stats["length"], merged["length"])):
+            logging.error("Only statistics of alignments to the same reference sequences can be merged.\n")
+            sys.exit(3)
+        if not numpy.array_equal(stats["filters"], merged["filters"]):
+            logging.error("Only statistics of alignments parsed with the same mapping quality, aligned percentage"
+                          " and multireads options can be merged.\n")
+            sys.exit(3)
+        for key in ["unmapped", "reads_mapped", "weight_total", "bases_mapped"]:
+            merged[key] = merged[key] + stats[key]
+        merged["leftmost"] = numpy.minimum(merged["leftmost"], stats["leftmost"])
+        merged["rightmost"] = numpy.maximum(merged["rightmost"], stats["rightmost"])
+        for key in ["interval_row", "interval_start", "interval_end"]:
+            merged[key] = numpy.concatenate([merged[key], stats[key]])
+    merged["interval_row"], merged["interval_start"], merged["interval_end"] = \
+        covered_intervals(merged["interval_row"], merged["interval_start"], merged["interval_end"])
+    return merged
+
+
+def load_sufficient_stats(refseq_dict: "classy.RefTable", stats: dict) -> (float, float):
+    """
+    The equivalent of load_reference_columns for the statistics returned by sufficient_stats or
+    merge_sufficient_stats, which are added to the rows of a RefTable of the same reference sequences.
+
+    :param refseq_dict: A RefTable of the reference sequences
+    :param stats: A dictionary of the statistics of each reference sequence
+    :return: Total alignment weights for unmapped reads and mapped reads
+    """
+    logging.info("Loading alignment statistics for each reference sequence... ")
+    num_refs = len(refseq_dict)
+    bases_covered = numpy.bincount(stats["interval_row"], weights=stats["interval_end"] - stats["interval_start"],
+                                   minlength=num_refs)
+    refseq_dict.add_stats(numpy.arange(num_refs), stats["reads_mapped"], stats["weight_total"], stats["bases_mapped"],
+                          bases_covered, stats["leftmost"], stats["rightmost"])
+    logging.info("done.\n")
+    return float(stats["unmapped"]), float(stats["weight_total"].sum())
+
+
+def load_reference_depths(refseq_dict: "classy.RefTable", columns: dict, depth_file=None) -> numpy.ndarray:
+    """
+    Calculates the per-base depth of every reference sequence from the alignment columns returned by
+    file_parsers.sam_columns_ext. Each alignment adds +1 at its first and -1 after its last aligned position of a
+    difference array, which is then prefix-summed to give the number of alignments covering each position.
+
+    The depths of all reference sequences are stored in a single int32 array, one segment per reference sequence,
+    which can be backed by a memory-mapped file for large assemblies. The depth_profile of each RefSequence is a
+    numpy view of its segment so no depths are copied.
+
+    :param refseq_dict: A RefTable of the reference sequences
+    :param columns: A dictionary of alignment columns returned by file_parsers.sam_columns_ext
+    :param depth_file: Optional path to a file that the depth array is memory-mapped to. It is overwritten if it exists.
+    :return: The array containing the depths of all reference sequences
+    """
+    logging.info("Calculating the per-base depth of each reference sequence... ")
+    # An extra position at the end of each segment receives the decrements of alignments ending at the last base
+    offsets = numpy.zeros(len(refseq_dict.length), dtype=numpy.int64)
+    numpy.cumsum(refseq_dict.length[:-1] + 1, out=offsets[1:])
+    total_length = int(refseq_dict.length.sum()) + len(refseq_dict.length)
+
+    if depth_file:
+        depths = numpy.memmap(depth_file, dtype=numpy.int32, mode="w+", shape=(max(total_length, 1),))
+    else:
+        depths = numpy.zeros(total_length, dtype=numpy.int32)
+
+    # Convert the positions of each alignment to indices in the depth array, skipping unknown reference sequences
+    col_rows = numpy.array([refseq_dict.index.get(name, -1) for name in columns["ref_names"]], dtype=numpy.int64)
+    aln_rows = col_rows[columns["ref_id"]]
+    known = aln_rows >= 0
+    if not numpy.all(known):
+        logging.warning("%d alignments to reference sequences that were not loaded are excluded from the depths.\n" %
+                        numpy.count_nonzero(~known))
+    aln_rows = aln_rows[known]
+    aln_offsets = offsets[aln_rows]
+    aln_lengths = refseq_dict.length[aln_rows]
+    # Alignment coordinates are 1-based and the end positions are exclusive
+    starts = numpy.minimum(columns["start"][known].astype(numpy.int64) - 1, aln_lengths)
+    ends = numpy.minimum(columns["end"][known].astype(numpy.int64) - 1, aln_lengths)
+
+    numpy.add.at(depths, aln_offsets + starts, 1)
+    numpy.subtract.at(depths, aln_offsets + ends, 1)
+    numpy.cumsum(depths, out=depths)
+    if depth_file:
+        depths.flush()
+
+    refseq_dict.depth_profiles = depths
+    refseq_dict.depth_offsets = offsets
+    logging.info("done.\n")
+
+    return depths
+
+
+def window_coverage(refseq_dict: "classy.RefTable", columns: dict, window_size=0, num_windows=0) -> dict:
+    """
+    Calculates the mean depth, breadth of coverage and fragment weight in fixed windows across every reference
+    sequence from the alignment columns returned by file_parsers.sam_columns_ext.
+
+    The windows are either window_size positions long, with a shorter last window on each reference sequence, or, if
+    num_windows is given instead, each reference sequence is split into num_windows windows whose boundaries are at
+    i*length//num_windows so every reference sequence has the same number of windows. Reference sequences shorter than
+    num_windows have a window for each position.
+    Alignments are split at window boundaries so their aligned bases and covered positions can be summed for all
+    windows at once with numpy. The weight of a fragment is added to the window that its alignment starts in.
+
+    :param refseq_dict: A RefTable of the reference sequences
+    :param columns: A dictionary of alignment columns returned by file_parsers.sam_columns_ext
+    :param window_size: The length of each window
+    :param num_windows: The number of windows each reference sequence is split into, used if window_size is 0
+    :return: A dictionary with the reference sequence names under 'names' and numpy arrays with one element per window
+     for 'ref_index' (index into names), 'start' and 'end' (1-based, inclusive), 'depth', 'covered' and 'weight'
+    """
+    logging.info("Calculating the coverage of windows across each reference sequence... ")
+    seq_names = list(refseq_dict)
+    seq_lengths = refseq_dict.length.astype(numpy.int64)
+    if window_size > 0:
+        win_counts = -(-seq_lengths // window_size)
+    elif num_windows > 0:
+        win_counts = numpy.minimum(seq_lengths, num_windows)
+    else:
+        logging.error("Either a window size or number of windows greater than zero is required.\n")
+        sys.exit(3)
+    win_offsets = numpy.zeros(len(seq_names), dtype=numpy.int64)
+    win_offsets[1:] = numpy.cumsum(win_counts)[:-1]
+    total_windows = int(win_counts.sum())
+
+    # Describe each window by its reference sequence and 0-based, half-open coordinates
+    win_refs = numpy.repeat(numpy.arange(len(seq_names)), win_counts)
+    win_i = numpy.arange(total_windows) - win_offsets[win_refs]
+    if window_size > 0:
+        win_starts = win_i * window_size
+        win_ends = numpy.minimum(win_starts + window_size, seq_lengths[win_refs])
+    else:
+        win_starts = win_i * seq_lengths[win_refs] // win_counts[win_refs]
+        win_ends = (win_i + 1) * seq_lengths[win_refs] // win_counts[win_refs]
+    # The windows of all reference sequences laid end to end, so an alignment's windows are found by a binary search
+    seq_offsets = numpy.zeros(len(seq_names), dtype=numpy.int64)
+    seq_offsets[1:] = numpy.cumsum(seq_lengths)[:-1]
+    win_positions = seq_offsets[win_refs] + win_starts
+
+    # Map the alignments to the reference sequences in refseq_dict, skipping unknown reference sequences
+    col_refs = numpy.array([refseq_dict.index.get(name, -1) for name in columns["ref_names"]], dtype=numpy.int64)
+    aln_refs = col_refs[columns["ref_id"]]
+    known = aln_refs >= 0
+    known[known] = seq_lengths[aln_refs[known]] > 0
+    aln_refs = aln_refs[known]
+    aln_lengths = seq_lengths[aln_refs]
+    starts = numpy.minimum(columns["start"][known].astype(numpy.int64) - 1, aln_lengths)
+    ends = numpy.minimum(columns["end"][known].astype(numpy.int64) - 1, aln_lengths)
+    ends = numpy.maximum(ends, starts)
+
+    # Positions past the end of a reference sequence are in its last window
+    first_win = numpy.searchsorted(win_positions, seq_offsets[aln_refs] + numpy.minimum(starts, aln_lengths - 1),
+                                   side="right") - 1
+    last_win = numpy.searchsorted(win_positions,
+                                  seq_offsets[aln_refs] + numpy.minimum(numpy.maximum(ends - 1, starts), aln_lengths - 1),
+                                  side="right") - 1
+    weight = numpy.bincount(first_win, weights=columns["weight"][known], minlength=total_windows)
+
+    # Split each alignment into the pieces that fall within each window it spans
+    pieces_per_aln = last_win - first_win + 1
+    piece_alns = numpy.repeat(numpy.arange(len(starts)), pieces_per_aln)
+    piece_offsets = numpy.zeros(len(starts), dtype=numpy.int64)
+    piece_offsets[1:] = numpy.cumsum(pieces_per_aln)[:-1]
+    piece_ids = first_win[piece_alns] + numpy.arange(len(piece_alns)) - piece_offsets[piece_alns]
+    piece_starts = numpy.maximum(starts[piece_alns], win_starts[piece_ids])
+    piece_ends = numpy.maximum(numpy.minimum(ends[piece_alns], win_ends[piece_ids]), piece_starts)
+
+    win_lengths = win_ends - win_starts
+    bases = numpy.bincount(piece_ids, weights=piece_ends - piece_starts, minlength=total_windows)
+    covered = interval_union_lengths(piece_ids, piece_starts - win_starts[piece_ids],
+                                     piece_ends - win_starts[piece_ids], total_windows)
+    logging.info("done.\n")
+
+    return {"names": seq_names,
+            "ref_index": win_refs,
+            "start": win_starts + 1,
+            "end": win_ends,
+            "depth": bases / win_lengths,
+            "covered": covered / win_lengths,
+            "weight": weight}
+
+
+def calculate_normalization_metrics(genome_dict: "classy.RefTable", unmapped_weight: float,
+                                    excluded_density=0.0) -> None:
+    """
+    Calculates the normalized abundance values for each reference sequence in genome_dict
         1. Reads per kilobase (RPK) is calculated using the reference sequence's length and number of reads (provided
         by the user via CLI)
         2. Fragments per kilobase per million mappable reads (FPKM) is calculated from the number of fragments
@@ -86,45 +448,56 @@ def calculate_normalization_metrics(genome_dict: dict, unmapped_weight: float) -
         normalized by the reference sequence length and the number of reads mapped.
         2. Transcripts per million (TPM) is calculated similarly to FPKM but the order of operations is different.
 
-    :param genome_dict: A dictionary of RefSeq instances indexed by headers (sequence names)
+    :param genome_dict: A RefTable of the reference sequences
     :param unmapped_weight: This represents the million-mappable reads for unaligned sequences. The 'weight' refers to
      this value being library-type agnostic; number of fragments (not reads!) for either a SE or PE library.
+    :param excluded_density: The sum of fragment weight per base of reference sequences excluded from genome_dict,
+     e.g. from excluded_weight_density, so TPM is relative to every reference sequence in the alignment file
     :return: None
     """
-    fpkm_sum = 0  # The total fragments per kilobase (FPK) of all reference sequences
-    mill_frag_denom = unmapped_weight
-    for header, ref_seq in sorted(genome_dict.items()):  # type: (str, classy.RefSequence)
-        mill_frag_denom += ref_seq.weight_total
+    genome_dict.calc_normalization(unmapped_weight, excluded_density)
+    return
 
-    for header, ref_seq in sorted(genome_dict.items()):  # type: (str, classy.RefSequence)
-        if ref_seq.weight_total == 0:
-            continue
-        ref_seq.calc_fpkm(mill_frag_denom)
-        fpkm_sum += ref_seq.fpkm
 
-    for header in genome_dict.keys():
-        ref_seq = genome_dict[header]  # type: classy.RefSequence
-        ref_seq.calc_tpm(fpkm_sum)
+def excluded_weight_density(index_stats: dict, seq_lengths_map: dict, references: "classy.RefTable") -> float:
+    """
+    Estimates the sum of fragment weight per base of the reference sequences that were excluded from a run restricted
+    to regions, for the TPM denominator. Each mapped record counted by the BAM index is given the average fragment
+    weight of the mapped records in the regions. This is only an estimate: the reads of the excluded reference
+    sequences may be weighed differently, e.g. if more of them are multireads, orphans or fail the alignment
+    thresholds, and the index counts secondary and supplementary records as well.
 
-    return
+    :param index_stats: A dictionary of (mapped, unmapped) record counts indexed by reference sequence names,
+     returned by file_parsers.bam_index_stats
+    :param seq_lengths_map: A dictionary of the lengths of every reference sequence in the alignment file
+    :param references: A RefTable of the reference sequences that were included, with their alignment stats loaded
+    :return: The sum of the estimated fragment weight divided by length for each excluded reference sequence
+    """
+    num_records = int(references.reads_mapped.sum())
+    if num_records == 0:
+        return 0.0
+    record_weight = float(references.weight_total.sum())/num_records
+    density = 0.0
+    for seq_name, (mapped, _) in index_stats.items():  # type: (str, tuple)
+        if seq_name in references or seq_lengths_map.get(seq_name, 0) == 0:
+            continue
+        density += mapped*record_weight/seq_lengths_map[seq_name]
+    return density
 
 
-def proportion_filter(references: dict, p_aln: int) -> float:
+def proportion_filter(references: "classy.RefTable", p_aln: int) -> float:
     """
     Removes all read alignments from a RefSequence with too little coverage, controlled by p_aln.
     The RefSequence.weight_total is then added to the discarded_weight, to be added to num_unmapped
 
-    :param references: A dictionary of RefSequence instances indexed by headers (sequence names)
+    :param references: A RefTable of the reference sequences
     :param p_aln: The minimum percentage of the reference sequence required to be covered by reads
     :return: The summed weight of each of the reads that were removed from low-coverage RefSequences
     """
-    discarded_weight = 0.0
     logging.info("Filtering out reference sequences with coverage below " + str(p_aln) + "%... ")
-    for seq_name in sorted(references):
-        ref_seq = references[seq_name]  # type: classy.RefSequence
-        if 100*ref_seq.covered < p_aln:
-            discarded_weight += ref_seq.weight_total
-            ref_seq.clear_alignments()
+    low_coverage = 100*references.covered < p_aln
+    discarded_weight = float(references.weight_total[low_coverage].sum())
+    references.clear_alignments(low_coverage)
     logging.info("done.\n")
     return discarded_weight
 
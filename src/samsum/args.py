@@ -34,13 +34,15 @@ class SAMSumArgumentParser(argparse.ArgumentParser):
 
         return args
 
-    def add_stats_args(self):
-        self.reqs.add_argument("-f", "--ref_fasta",
-                               required=True, dest="fasta_file",
-                               help="Path to the reference file used to generate the SAM/BAM file.")
-        self.reqs.add_argument("-a", "--alignments",
-                               required=True, dest="am_file",
-                               help="Path to a SAM/BAM file containing the read alignments to the reference FASTA.")
+    def add_abundance_args(self):
+        """
+        Adds the arguments for the reference sequences and the alignment filters, shared by the sub-commands that
+        calculate abundances.
+        """
+        self.optopt.add_argument("-f", "--ref_fasta",
+                                 required=False, dest="fasta_file", default=None,
+                                 help="Path to the reference file used to generate the SAM/BAM file. Only needed if"
+                                      " the SAM/BAM header has no @SQ lines; otherwise it is used for validation.")
         self.seqops.add_argument("-l", "--aln_percent",
                                  required=False, dest="min_aln",
                                  default=10, type=int,
@@ -60,6 +62,146 @@ class SAMSumArgumentParser(argparse.ArgumentParser):
                                  default=False, action="store_true",
                                  help="Flag indicating whether reads that mapped ambiguously to multiple positions"
                                       " (multireads) should be used in the counts.")
+        self.seqops.add_argument("--name_grouped",
+                                 required=False,
+                                 default=False, action="store_true",
+                                 help="Flag indicating all alignments of a read are adjacent in the alignment file, as"
+                                      " in a queryname-sorted file, so reads are weighed as they are parsed in constant"
+                                      " memory. This is detected automatically from the SAM/BAM header's @HD line.")
+        self.optopt.add_argument("--ref_cache",
+                                 required=False, nargs='?', const="", default=None,
+                                 help="Store the reference FASTA's sequence lengths in a catalogue so later runs don't"
+                                      " need to read the FASTA. The catalogue is written to this directory, or next"
+                                      " to the FASTA if no directory is given.")
+        return
+
+    def add_stats_args(self):
+        self.reqs.add_argument("-a", "--alignments",
+                               required=True, dest="am_file",
+                               help="Path to a SAM/BAM file containing the read alignments to the reference FASTA.")
+        self.add_abundance_args()
+        self.optopt.add_argument("--refs",
+                                 required=False, default=None,
+                                 help="Path to a file listing the reference sequences to report, one name per line."
+                                      " Only their alignments are read, which requires a BAI or CSI index of the BAM"
+                                      " file. FPKM and TPM remain relative to all reads in the file but are estimated"
+                                      " from the index: FPKM is slightly low if the file has secondary or"
+                                      " supplementary alignments, and TPM can be off by a few percent since the"
+                                      " excluded sequences' reads are assumed to weigh as much as those read.")
+        self.optopt.add_argument("--regions",
+                                 required=False, default=None,
+                                 help="Path to a BED file of the reference sequences to report, as with --refs."
+                                      " Each region must span its whole reference sequence, since coverage and"
+                                      " abundances are reported over full sequences; partial regions are an error.")
+        self.optopt.add_argument("-o", "--output_table",
+                                 required=False,
+                                 default="./samsum_table.csv",
+                                 help="Name of a file to write the alignment stats to."
+                                      " (DEFAULT = ./samsum_table.csv)")
+        self.optopt.add_argument("-s", "--sep",
+                                 required=False,
+                                 default=",", type=str,
+                                 help="Field-separator character to be used when writing the output table."
+                                      " (DEFAULT = ',')")
+        self.optopt.add_argument("--stats_output",
+                                 required=False, default=None,
+                                 help="Path to a file to write the alignment statistics of each reference sequence"
+                                      " to, before the coverage filter, so they can be merged with those of other"
+                                      " alignment files by `samsum merge`.")
+        self.optopt.add_argument("--follow",
+                                 required=False,
+                                 default=False, action="store_true",
+                                 help="Summarize a SAM file that is still being written, or SAM alignments read from"
+                                      " stdin with '-a -', rewriting the output table as alignments are read."
+                                      " The alignments of each read must be adjacent, as aligners write them.")
+        self.optopt.add_argument("--update_records",
+                                 required=False,
+                                 default=100000, type=int,
+                                 help="With --follow, the number of alignments after which the output table is"
+                                      " rewritten. (DEFAULT = 100000)")
+        self.optopt.add_argument("--update_seconds",
+                                 required=False,
+                                 default=60, type=float,
+                                 help="With --follow, the number of seconds after which the output table is"
+                                      " rewritten if new alignments were read. (DEFAULT = 60)")
+        self.optopt.add_argument("--idle_timeout",
+                                 required=False,
+                                 default=300, type=float,
+                                 help="With --follow, the number of seconds a followed SAM file must not grow for"
+                                      " before it is considered complete. (DEFAULT = 300)")
+        self.optopt.add_argument("--checkpoint",
+                                 required=False, default=None,
+                                 help="Path to a file that the progress of parsing a SAM file is saved to, so an"
+                                      " interrupted run can be continued with --resume. The alignments of each read"
+                                      " must be adjacent. (DEFAULT = the output table's path + '.checkpoint.npz')")
+        self.optopt.add_argument("--checkpoint_interval",
+                                 required=False,
+                                 default=1024, type=int,
+                                 help="The number of megabytes of the SAM file parsed between checkpoints."
+                                      " (DEFAULT = 1024)")
+        self.optopt.add_argument("--resume",
+                                 required=False,
+                                 default=False, action="store_true",
+                                 help="Continue from the last checkpoint, if there is one, and write checkpoints.")
+        self.optopt.add_argument("-w", "--window_size",
+                                 required=False,
+                                 default=0, type=int,
+                                 help="Length of the windows to summarize the coverage of each reference sequence in."
+                                      " The window table is written next to the output table. (DEFAULT = 0, off)")
+        self.optopt.add_argument("--num_windows",
+                                 required=False,
+                                 default=0, type=int,
+                                 help="Number of equal-length windows to split each reference sequence into"
+                                      " instead of using --window_size. (DEFAULT = 0, off)")
+        self.miscellany.add_argument("-t", "--threads",
+                                     required=False, dest="num_threads",
+                                     default=1, type=int,
+                                     help="The number of threads to use for decompressing BAM files or parsing SAM files."
+                                          " (DEFAULT = 1)")
+        return
+
+    def add_multi_args(self):
+        self.reqs.add_argument("-a", "--alignments",
+                               required=True, dest="am_files", nargs='+',
+                               help="Paths to the SAM/BAM files of each sample, with the read alignments to the"
+                                    " same reference sequences.")
+        self.add_abundance_args()
+        self.optopt.add_argument("-o", "--output_prefix",
+                                 required=False,
+                                 default="./samsum_matrix",
+                                 help="Prefix of the files the TPM, FPKM, fragments and coverage matrices are written"
+                                      " to, e.g. PREFIX_TPM.csv. (DEFAULT = ./samsum_matrix)")
+        self.optopt.add_argument("-s", "--sep",
+                                 required=False,
+                                 default=",", type=str,
+                                 help="Field-separator character to be used when writing the output matrices."
+                                      " (DEFAULT = ',')")
+        self.optopt.add_argument("--memory",
+                                 required=False,
+                                 default=0, type=int,
+                                 help="The number of megabytes of memory the samples processed in parallel may use,"
+                                      " estimated from the sizes of their alignment files. (DEFAULT = 0, unlimited)")
+        self.miscellany.add_argument("-t", "--threads",
+                                     required=False, dest="num_threads",
+                                     default=1, type=int,
+                                     help="The number of samples to process in parallel. (DEFAULT = 1)")
+        return
+
+    def add_merge_args(self):
+        self.reqs.add_argument("-i", "--stats_files",
+                               required=True, nargs='+',
+                               help="Paths to the alignment statistics files written by `samsum stats --stats_output`"
+                                    " for alignment files to the same reference sequences. All alignments of a read"
+                                    " must be in the same alignment file.")
+        self.seqops.add_argument("-p", "--seq_coverage",
+                                 required=False, dest="p_cov",
+                                 default=50, type=int,
+                                 help="The minimum percentage a reference sequence must be covered for its coverage"
+                                      " stats to be included; they are set to zero otherwise. (DEFAULT = 50%%)")
+        self.optopt.add_argument("-n", "--query_name",
+                                 required=False, default=None,
+                                 help="Name written to the QueryName column of the output table."
+                                      " (DEFAULT = the name of the first statistics file's alignment file)")
         self.optopt.add_argument("-o", "--output_table",
                                  required=False,
                                  default="./samsum_table.csv",
@@ -1,26 +1,195 @@
 __author__ = 'Connor Morgan-Lang'
 
+import sys
 import logging
+
+import numpy
+
+import _sam_module
 from samsum import utilities as ss_utils
 from samsum import alignment_utils as ss_aln_utils
 
 
+class RefTable:
+    """
+    Columnar storage for the statistics of all reference sequences, with one numpy array per statistic and one element
+    per reference sequence, so they can be loaded, normalized and filtered without a Python object per sequence.
+    RefTable behaves like a read-only dictionary of RefSequence instances indexed by sequence name, where each
+    RefSequence is a view of a single row that is only created when it is accessed.
+    """
+    def __init__(self, names: list, lengths, keys=None) -> None:
+        self.names = list(names)
+        self.keys_ = list(keys) if keys is not None else list(self.names)
+        self.index = {key: i for i, key in enumerate(self.keys_)}
+        self.length = numpy.array(lengths, dtype=numpy.int64)
+        self.leftmost = self.length.copy()
+        self.rightmost = numpy.zeros(len(self.names), dtype=numpy.int64)
+        self.reads_mapped = numpy.zeros(len(self.names), dtype=numpy.int64)
+        self.weight_total = numpy.zeros(len(self.names), dtype=numpy.float64)
+        self.bases_mapped = numpy.zeros(len(self.names), dtype=numpy.float64)
+        self.bases_covered = numpy.zeros(len(self.names), dtype=numpy.float64)
+        self.depth = numpy.zeros(len(self.names), dtype=numpy.float64)
+        self.covered = numpy.zeros(len(self.names), dtype=numpy.float64)
+        self.fpkm = numpy.zeros(len(self.names), dtype=numpy.float64)
+        self.tpm = numpy.zeros(len(self.names), dtype=numpy.float64)
+        self.depth_profiles = None
+        self.depth_offsets = None
+        self.views = {}
+        return
+
+    def __len__(self) -> int:
+        return len(self.keys_)
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __contains__(self, key) -> bool:
+        return key in self.index
+
+    def __getitem__(self, key):
+        i = self.index[key]
+        try:
+            return self.views[i]
+        except KeyError:
+            ref_seq = RefSequence(self.names[i], table=self, row=i)
+            self.views[i] = ref_seq
+            return ref_seq
+
+    def get(self, key, default=None):
+        if key in self.index:
+            return self[key]
+        return default
+
+    def keys(self):
+        return iter(self.keys_)
+
+    def values(self):
+        for key in self.keys_:
+            yield self[key]
+
+    def items(self):
+        for key in self.keys_:
+            yield key, self[key]
+
+    def rows(self, keys) -> numpy.ndarray:
+        """
+        Finds the rows of reference sequences in the table, exiting if any are not found.
+
+        :param keys: An iterable of reference sequence names
+        :return: A numpy array with the row index of each reference sequence
+        """
+        rows = numpy.empty(len(keys), dtype=numpy.int64)
+        for i, key in enumerate(keys):
+            try:
+                rows[i] = self.index[key]
+            except KeyError:
+                logging.error("Reference sequence from SAM file not found in FASTA: %s\n" % key)
+                sys.exit(3)
+        return rows
+
+    def add_stats(self, rows, reads_mapped, weight_total, bases_mapped, bases_covered, leftmost, rightmost) -> None:
+        """
+        Adds the alignment statistics of reference sequences, each an array with an element for each row in rows,
+        to the table. Rows may be repeated and stats may be added to a row more than once, as when parts of an
+        alignment file are merged, so the bases mapped and covered are summed and depth and covered are recalculated
+        from the sums. Positions covered in more than one part are counted once per part, up to the sequence length.
+
+        :return: None
+        """
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        reads_mapped = numpy.asarray(reads_mapped)
+        numpy.add.at(self.reads_mapped, rows, reads_mapped)
+        numpy.add.at(self.weight_total, rows, weight_total)
+        numpy.add.at(self.bases_mapped, rows, bases_mapped)
+        numpy.add.at(self.bases_covered, rows, bases_covered)
+        updated = numpy.unique(rows)
+        self.depth[updated] = self.bases_mapped[updated] / self.length[updated]
+        self.covered[updated] = numpy.minimum(self.bases_covered[updated], self.length[updated]) / self.length[updated]
+        mapped = reads_mapped > 0
+        numpy.minimum.at(self.leftmost, rows[mapped], numpy.asarray(leftmost)[mapped])
+        numpy.maximum.at(self.rightmost, rows[mapped], numpy.asarray(rightmost)[mapped])
+        return
+
+    def calc_normalization(self, unmapped_weight: float, excluded_density=0.0) -> None:
+        """
+        Calculates the FPKM and TPM of every reference sequence with fragments mapped to it, as RefSequence.calc_fpkm
+        and RefSequence.calc_tpm do for a single reference sequence.
+
+        :param unmapped_weight: The weight of all fragments that were not mapped to a reference sequence in the table
+        :param excluded_density: The sum of fragment weight per base of reference sequences that were mapped to but
+         aren't in the table, which is added to the TPM denominator
+        :return: None
+        """
+        mapped = self.weight_total > 0
+        mmr = (unmapped_weight + self.weight_total.sum())/1E6
+        self.fpkm[:] = 0
+        self.fpkm[mapped] = (self.weight_total[mapped]/self.length[mapped])/mmr
+        fpkm_sum = self.fpkm.sum() + excluded_density/mmr
+        self.tpm[mapped] = 1E6*(self.fpkm[mapped]/fpkm_sum)
+        return
+
+    def clear_alignments(self, rows) -> None:
+        """
+        Clears the alignment statistics of the reference sequences in rows, as RefSequence.clear_alignments does.
+
+        :param rows: An array of row indices or a boolean mask of the rows to clear
+        :return: None
+        """
+        for column in [self.reads_mapped, self.bases_mapped, self.depth, self.weight_total, self.fpkm, self.tpm]:
+            column[rows] = 0
+        cleared = numpy.zeros(len(self.names), dtype=bool)
+        cleared[rows] = True
+        for i, ref_seq in self.views.items():
+            if cleared[i]:
+                ref_seq.alignments.clear()
+        return
+
+
+def _table_column(name: str) -> property:
+    """
+    Creates a property of RefSequence that gets and sets the element of its row in one of its RefTable's columns.
+    """
+    def getter(self):
+        return getattr(self.table, name)[self.row].item()
+
+    def setter(self, value):
+        getattr(self.table, name)[self.row] = value
+
+    return property(getter, setter)
+
+
 class RefSequence:
-    def __init__(self, ref_seq: str, seq_length: int):
+    """
+    A view of the statistics of a single reference sequence in a RefTable. A RefSequence created on its own is the
+    only row in a new RefTable.
+    """
+    length = _table_column("length")
+    leftmost = _table_column("leftmost")
+    rightmost = _table_column("rightmost")
+    reads_mapped = _table_column("reads_mapped")
+    weight_total = _table_column("weight_total")
+    depth = _table_column("depth")
+    covered = _table_column("covered")
+    fpkm = _table_column("fpkm")
+    tpm = _table_column("tpm")
+
+    def __init__(self, ref_seq: str, seq_length=0, table=None, row=0):
+        if table is None:
+            table = RefTable([ref_seq], [seq_length])
+        self.table = table
+        self.row = row
         self.name = ref_seq
-        self.length = seq_length
-        self.leftmost = seq_length
-        self.rightmost = 0
-        self.reads_mapped = 0
-        self.depth = 0.0
-        self.covered = 0.0
-        self.weight_total = 0.0
-        self.fpkm = 0.0
-        self.tpm = 0.0
         self.alignments = []
         self.tiles = []
         return
 
+    @property
+    def depth_profile(self):
+        if self.table.depth_profiles is None:
+            return None
+        offset = self.table.depth_offsets[self.row]
+        return self.table.depth_profiles[offset:offset + self.length]
+
     def get_info(self):
         summary_str = "Reference sequence '%s':\n\t" % self.name
         summary_str += "\n\t".join(["Length = " + str(self.length) + "bp",
@@ -42,25 +211,19 @@ class RefSequence:
 
     def merge_tiles(self) -> None:
         """
-        Checks for Tile instances with overlapping ranges. Tile instances must have a 'start' and 'end' variable.
+        Merges Tile instances with overlapping ranges. Tile instances must have a 'start' and 'end' variable.
+        The tiles are sorted once by their start position so each only needs to be compared to the last merged tile.
 
         :return: None
         """
-        i = 0
-        while i < len(self.tiles):
-            tiles = sorted(self.tiles, key=lambda x: x.start)
-            tile_i = tiles[i]  # type: Tile
-            j = i + 1
-            while j < len(tiles):
-                tile_j = tiles[j]  # type: Tile
-                if ss_aln_utils.overlapping_intervals((tile_i.start, tile_i.end), (tile_j.start, tile_j.end)):
-                    # print("Merging:")
-                    # print(tile_i.get_info(), "and", tile_j.get_info())
-                    tile_i.merge(tile_j)
-                    tiles.pop(j)
-                else:
-                    j += 1
-            i += 1
+        merged_tiles = []
+        for tile in sorted(self.tiles, key=lambda x: x.start):  # type: Tile
+            if merged_tiles and ss_aln_utils.overlapping_intervals((merged_tiles[-1].start, merged_tiles[-1].end),
+                                                                   (tile.start, tile.end)):
+                merged_tiles[-1].merge(tile)
+            else:
+                merged_tiles.append(tile)
+        self.tiles = merged_tiles
         return
 
     def proportion_covered(self) -> float:
@@ -68,36 +231,19 @@ class RefSequence:
         Calculate the proportion of the RefSequence that was covered by mapped reads.
 
         The algorithm works as follows:
-            1. For each AlignmentDat instance in self.alignments:
-                bin it into a continuously aligned regions (Tile)
-            2. Merge the Tile instances from step one into the most contiguous possible
-            3. Calculate the combined lengths of Tiles across the reference sequence and divide by its length
+            1. Gather the start and end positions of each AlignmentDat instance in self.alignments into arrays
+            2. Sweep over the intervals, sorted by their start, summing the positions not covered by previous intervals
+            3. Divide the number of positions covered by the length of the reference sequence
 
         :return: Float representing the proportion of the Reference Sequence that was covered
         """
         if self.reads_mapped == 0:
             return 0
-        self.tiles.clear()
-        for aln_dat in sorted(self.alignments, key=lambda x: x.start):  # type: AlignmentDat
-            tile = Tile()
-            tile.load_from_alignment_dat(aln_dat)
-            i = 0
-            while i < len(self.tiles):
-                aln_coords = self.tiles[i]  # type: Tile
-                if ss_aln_utils.overlapping_intervals((aln_coords.start, aln_coords.end), (aln_dat.start, aln_dat.end)):
-                    aln_coords = self.tiles.pop(i)
-                    tile.merge(aln_coords)
-                    i = len(self.tiles)  # Increase i to the length of self.tiles to exit while loop
-                i += 1
-            self.tiles.append(tile)
-
-        # Since coordinates are not compared as the tiles are merged the tiles can overlap necessitating a final merge
-        self.merge_tiles()
-
-        # Calculate the combined lengths of all tiles across the reference sequence
-        total_tiled = 0
-        for tile in self.tiles:
-            total_tiled += (tile.end - tile.start)
+        num_alignments = len(self.alignments)
+        starts = numpy.fromiter((aln_dat.start for aln_dat in self.alignments), dtype=numpy.int64, count=num_alignments)
+        ends = numpy.fromiter((aln_dat.end for aln_dat in self.alignments), dtype=numpy.int64, count=num_alignments)
+        total_tiled = ss_aln_utils.interval_union_lengths(numpy.zeros(num_alignments, dtype=numpy.int64),
+                                                          starts, ends, 1)[0]
         return total_tiled/self.length
 
     def calc_coverage(self) -> None:
@@ -218,27 +364,11 @@ class AlignmentDat(Tile):
         The cigar string is parsed from the SAM file and represents the different states (e.g. insertion, deletion)
         and the length of these states across the aligned length.
         Also calculated in the alignment length itself and this length is returned as an integer.
+        The CIGAR is decoded by _sam_module, with the same decoder that is used while parsing alignment files.
 
         :return: An integer representing the alignment length
         """
-        self.read_length = 0
-        aln_len = 0
-        i = 0
-        buffer = ""
-        consume_ref = {"M", "D", "N", "=", "X"}  # type: set
-        consume_query = {"M", "I", "S", "=", "X"}  # type: set
-        while i < len(self.cigar):
-            if self.cigar[i].isdigit():
-                buffer += self.cigar[i]
-            elif buffer:
-                if self.cigar[i] in consume_ref:
-                    aln_len += int(buffer)
-                if self.cigar[i] in consume_query:
-                    self.read_length += int(buffer)
-                buffer = ""
-            else:
-                buffer = ""
-            i += 1
+        aln_len, self.read_length, _, _ = _sam_module.decode_cigar(self.cigar)
         return aln_len
 
     def load_sam(self, aln_fields: list) -> None:
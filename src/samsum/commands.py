@@ -1,5 +1,7 @@
 import os
+import sys
 import logging
+import multiprocessing
 import numpy
 
 from samsum import _version as ss_version
@@ -12,6 +14,9 @@ from samsum import alignment_utils as ss_aln_utils
 
 __author__ = 'Connor Morgan-Lang'
 
+# The minimum number of milliseconds between the messages logging how many alignments have been parsed
+PROGRESS_INTERVAL = 5000
+
 
 def info(sys_args):
     """
@@ -48,40 +53,79 @@ def info(sys_args):
     return 0
 
 
-def ref_sequence_abundances(aln_file: str, seq_file: str, map_qual=0, p_cov=50, min_aln=10, multireads=False) -> dict:
+def ref_sequence_abundances(aln_file: str, seq_file=None, map_qual=0, p_cov=50, min_aln=10, multireads=False,
+                            threads=1, ref_cache=None, name_grouped=False, regions=None) -> dict:
     """
-    An API function that will return a dictionary of RefSequence instances indexed by their sequence names/headers
-    The RefSequence instances contain the populated variables:
+    An API function that will return a RefTable, which behaves like a dictionary of RefSequence instances indexed by
+    their sequence names/headers. The RefSequence instances contain the populated variables:
 
 
     :param aln_file: Path to a SAM/BAM file containing the read alignments to the reference FASTA
-    :param seq_file: Path to the reference FASTA file used to generate the SAM/BAM file
+    :param seq_file: Optional path to the reference FASTA file used to generate the SAM/BAM file. The reference sequence
+    lengths are otherwise read from the SAM/BAM header.
     :param map_qual: The minimum mapping quality threshold for an alignment to pass
     :param min_aln: The minimum percentage of a read's length that must be aligned to be included
     :param multireads: Flag indicating whether reads that mapped ambiguously to multiple positions (multireads)
     should be used in the counts
     :param p_cov: The minimum percentage a reference sequence must be covered for its coverage stats to be included;
     they are set to zero otherwise
-    :return: Dictionary of RefSequence instances indexed by their sequence names/headers
+    :param threads: The number of threads to use for decompressing BAM files or parsing SAM files
+    :param ref_cache: Optional path to a directory where the lengths of the reference FASTA's sequences are cached
+    :param name_grouped: Flag indicating all alignments of a read are adjacent in the alignment file, so only one read
+    needs to be held in memory at a time
+    :param regions: Optional list of reference sequence names and (name, start, end) tuples, with 0-based half-open
+    coordinates, to restrict the abundances to. Each region must span its whole reference sequence since abundances
+    are calculated over the full length. Only these parts of an indexed BAM file are read, and the RefTable only
+    contains their reference sequences.
+    :return: RefTable of the reference sequences, indexed by their sequence names/headers
     """
-    refseq_lengths = ss_fp.fasta_seq_lengths(seq_file)
-    references = ss_aln_utils.load_references(refseq_lengths)
+    refseq_lengths = ss_fp.reference_seq_lengths(aln_file, seq_file, ref_cache)
+    references, _ = reference_abundances(aln_file, refseq_lengths, map_qual, p_cov, min_aln, multireads, threads,
+                                         name_grouped, regions)
     refseq_lengths.clear()
 
-    # Parse the alignments and return the strings of reads mapped to each reference sequence
-    mapped_dict = ss_fp.sam_parser_ext(aln_file, multireads, map_qual)
+    return references
+
 
-    num_unmapped, _ = ss_aln_utils.load_reference_coverage(refseq_dict=references, mapped_dict=mapped_dict,
-                                                           min_aln=min_aln)
-    mapped_dict.clear()
+def reference_abundances(aln_file: str, refseq_lengths: dict, map_qual=0, p_cov=50, min_aln=10, multireads=False,
+                         threads=1, name_grouped=False, regions=None, progress=ss_fp.log_progress) -> tuple:
+    """
+    Summarizes the alignments of an alignment file over reference sequences whose lengths are already known, e.g. when
+    the same reference sequences are shared by many alignment files. See ref_sequence_abundances for the parameters.
+
+    :param refseq_lengths: A dictionary of sequence lengths indexed by their respective sequence names
+    :param progress: Optional callable passed the parsing progress, as in file_parsers.sam_coverage_ext
+    :return: A tuple of the RefTable of the reference sequences and the number of fragments that were either unmapped
+    or filtered
+    """
+    if regions is not None:
+        regions = ss_fp.resolve_regions(regions, refseq_lengths, whole_sequences=True)
+        selected = {region[0] for region in regions}
+        references = ss_aln_utils.load_references({name: length for name, length in refseq_lengths.items()
+                                                   if name in selected})
+    else:
+        references = ss_aln_utils.load_references(refseq_lengths)
+
+    # Parse the alignments and sum the alignment statistics for each reference sequence
+    ref_stats = ss_fp.sam_coverage_ext(aln_file, multireads, min_aln, map_qual, threads, name_grouped, regions,
+                                       progress, PROGRESS_INTERVAL)
+
+    num_unmapped, mapped_weight_sum = ss_aln_utils.load_reference_stats(refseq_dict=references, ref_stats=ref_stats)
+    ref_stats.clear()
+
+    # The reference sequences outside of the regions still count towards the TPM denominator
+    excluded_density = 0.0
+    if regions is not None:
+        excluded_density = ss_aln_utils.excluded_weight_density(ss_fp.bam_index_stats(aln_file), refseq_lengths,
+                                                                references)
 
     # Filter out alignments that with either short alignments or are from low-coverage reference sequences
     num_unmapped += ss_aln_utils.proportion_filter(references, p_cov)
 
     # Calculate the RPKM, FPKM and TPM for each reference sequence with reads mapped to it
-    ss_aln_utils.calculate_normalization_metrics(references, num_unmapped)
+    ss_aln_utils.calculate_normalization_metrics(references, num_unmapped, excluded_density)
 
-    return references
+    return references, num_unmapped
 
 
 def stats(sys_args):
@@ -96,33 +140,375 @@ def stats(sys_args):
     args = parser.parse_args(sys_args)
 
     ss_log.prep_logging(os.path.dirname(args.output_table) + os.sep + "samsum_log.txt", args.verbose)
+    if args.follow:
+        return follow_stats(args)
+    if args.checkpoint or args.resume:
+        return checkpoint_stats(args)
     stats_ss = ss_class.SAMSumBase("stats")
     stats_ss.aln_file = args.am_file
     stats_ss.seq_file = args.fasta_file
 
-    # Parse the FASTA file, calculating the length of each reference sequence and return this as a dictionary
-    refseq_lengths = ss_fp.fasta_seq_lengths(stats_ss.seq_file)
-    references = ss_aln_utils.load_references(refseq_lengths)
-    refseq_lengths.clear()
-
-    # Parse the alignments and return the strings of reads mapped to each reference sequence
-    mapped_dict = ss_fp.sam_parser_ext(stats_ss.aln_file, args.multireads, args.map_qual)
-
-    logging.debug(stats_ss.get_info())
-    num_unmapped, mapped_weight_sum = ss_aln_utils.load_reference_coverage(refseq_dict=references,
-                                                                           mapped_dict=mapped_dict,
-                                                                           min_aln=args.min_aln)
-    mapped_dict.clear()
+    # Find the length of each reference sequence from the alignment file's header, validated by the optional FASTA
+    ref_cache = args.ref_cache
+    if ref_cache == "" and stats_ss.seq_file:
+        ref_cache = os.path.dirname(os.path.abspath(stats_ss.seq_file))
+    refseq_lengths = ss_fp.reference_seq_lengths(stats_ss.aln_file, stats_ss.seq_file, ref_cache)
+    # Restrict the analysis to the requested reference sequences and regions, which are read using the BAM index
+    regions = None
+    if args.refs or args.regions:
+        regions = ss_fp.resolve_regions(ss_fp.read_regions(args.refs, args.regions), refseq_lengths,
+                                        whole_sequences=True)
+        selected = {region[0] for region in regions}
+        references = ss_aln_utils.load_references({name: length for name, length in refseq_lengths.items()
+                                                   if name in selected})
+    else:
+        references = ss_aln_utils.load_references(refseq_lengths)
+
+    windows = None
+    if args.stats_output and regions is not None:
+        logging.error("Statistics for merging can only be written for all reference sequences,"
+                      " not with --refs or --regions.\n")
+        sys.exit(3)
+    if args.window_size > 0 or args.num_windows > 0 or args.stats_output:
+        if args.window_size > 0 and args.num_windows > 0:
+            logging.error("Only one of --window_size and --num_windows can be used.\n")
+            sys.exit(3)
+        # The alignments are needed for the windows and the covered intervals so they are returned as columns instead
+        # of summed per reference
+        columns = ss_fp.sam_columns_ext(stats_ss.aln_file, args.multireads, args.min_aln, args.map_qual,
+                                        args.num_threads, args.name_grouped, regions,
+                                        ss_fp.log_progress, PROGRESS_INTERVAL)
+        logging.debug(stats_ss.get_info())
+        num_unmapped, mapped_weight_sum = ss_aln_utils.load_reference_columns(refseq_dict=references, columns=columns)
+        if args.window_size > 0 or args.num_windows > 0:
+            windows = ss_aln_utils.window_coverage(references, columns, args.window_size, args.num_windows)
+        if args.stats_output:
+            # The statistics are written before the coverage filter, which can only be applied once they are merged
+            aln_stats = ss_aln_utils.sufficient_stats(references, columns,
+                                                      (args.map_qual, args.min_aln, args.multireads))
+            aln_stats["sample"] = numpy.array(ss_utils.file_prefix(stats_ss.aln_file))
+            ss_fp.write_sufficient_stats(aln_stats, args.stats_output)
+        columns.clear()
+    else:
+        # Parse the alignments and sum the alignment statistics for each reference sequence
+        ref_stats = ss_fp.sam_coverage_ext(stats_ss.aln_file, args.multireads, args.min_aln, args.map_qual,
+                                           args.num_threads, args.name_grouped, regions,
+                                           ss_fp.log_progress, PROGRESS_INTERVAL)
+        logging.debug(stats_ss.get_info())
+        num_unmapped, mapped_weight_sum = ss_aln_utils.load_reference_stats(refseq_dict=references,
+                                                                            ref_stats=ref_stats)
+        ref_stats.clear()
     stats_ss.num_frags = num_unmapped + mapped_weight_sum
 
+    # The reference sequences outside of the regions still count towards the TPM denominator
+    excluded_density = 0.0
+    if regions is not None:
+        excluded_density = ss_aln_utils.excluded_weight_density(ss_fp.bam_index_stats(stats_ss.aln_file),
+                                                                refseq_lengths, references)
+    refseq_lengths.clear()
+
     # Filter out alignments that with either short alignments or are from low-coverage reference sequences
     num_unmapped += ss_aln_utils.proportion_filter(references, args.p_cov)
 
     # Calculate the RPKM, FPKM and TPM for each reference sequence with reads mapped to it
-    ss_aln_utils.calculate_normalization_metrics(references, num_unmapped)
+    ss_aln_utils.calculate_normalization_metrics(references, num_unmapped, excluded_density)
 
     # Write the summary table with each of the above metrics as well as variance for each
     ss_fp.write_summary_table(references, args.output_table,
                               ss_utils.file_prefix(stats_ss.aln_file), num_unmapped, args.sep)
+    if windows:
+        table_prefix, table_ext = os.path.splitext(args.output_table)
+        ss_fp.write_window_table(windows, table_prefix + "_windows" + table_ext,
+                                 ss_utils.file_prefix(stats_ss.aln_file), args.sep)
+
+    return 0
+
+
+def merge(sys_args):
+    """
+    A user-facing sub-command to write the abundance table of alignments that were split across many alignment files,
+    e.g. chunks of a run aligned separately, from the statistics written by `samsum stats --stats_output`.
+    The table is the same as that of `samsum stats` run on a single alignment file with all of the alignments.
+
+    :param sys_args: List of arguments parsed from the command-line.
+    :return: None
+    """
+    parser = ss_args.SAMSumArgumentParser(description="Merge the alignment statistics of separately summarized"
+                                                      " alignment files into a single abundance table.")
+    parser.add_merge_args()
+    args = parser.parse_args(sys_args)
+
+    ss_log.prep_logging(os.path.join(os.path.dirname(args.output_table), "samsum_log.txt"), args.verbose)
+
+    logging.info("Merging the alignment statistics of %d files... " % len(args.stats_files))
+    aln_stats = ss_aln_utils.merge_sufficient_stats([ss_fp.read_sufficient_stats(stats_file)
+                                                     for stats_file in args.stats_files])
+    logging.info("done.\n")
+    query_name = args.query_name if args.query_name else str(aln_stats["sample"])
+    write_stats_table(aln_stats, args.output_table, query_name, args.p_cov, args.sep)
+
+    return 0
+
+
+def write_stats_table(aln_stats: dict, output_table: str, query_name: str, p_cov: int, sep=",") -> None:
+    """
+    Writes the abundance table of the alignment statistics returned by alignment_utils.sufficient_stats or
+    alignment_utils.merge_sufficient_stats, after filtering the reference sequences by their coverage.
+    The table is written to a temporary file that replaces output_table, so it is never read while partially written.
+
+    :param aln_stats: A dictionary of the alignment statistics of each reference sequence
+    :param output_table: A string representing the path of the file to write to
+    :param query_name: String representing the origin of the query reads, or alignment experiment name
+    :param p_cov: The minimum percentage a reference sequence must be covered for its coverage stats to be included
+    :param sep: Field separator to use. The default is a comma.
+    :return: None
+    """
+    references = ss_aln_utils.load_references(dict(zip(aln_stats["names"].tolist(), aln_stats["length"].tolist())))
+    num_unmapped, _ = ss_aln_utils.load_sufficient_stats(references, aln_stats)
+
+    # Filter out alignments that with either short alignments or are from low-coverage reference sequences
+    num_unmapped += ss_aln_utils.proportion_filter(references, p_cov)
+
+    # Calculate the RPKM, FPKM and TPM for each reference sequence with reads mapped to it
+    ss_aln_utils.calculate_normalization_metrics(references, num_unmapped)
+
+    tmp_table = output_table + ".%d.tmp" % os.getpid()
+    ss_fp.write_summary_table(references, tmp_table, query_name, num_unmapped, sep)
+    os.replace(tmp_table, output_table)
+    return
+
+
+def follow_stats(args) -> int:
+    """
+    Summarizes the alignments of a SAM stream that is still being written for `samsum stats --follow`, from stdin or
+    a growing file. The stream is parsed in batches of whole reads whose alignment statistics are added to those of
+    the previous batches, and the output table is rewritten after every batch. Since only the summed statistics of
+    each reference sequence are kept, memory doesn't grow with the number of alignments and the final table is the
+    same as that of a run on the complete file.
+
+    :param args: The arguments of `samsum stats`, parsed from the command-line
+    :return: 0 once the stream has ended
+    """
+    if args.refs or args.regions or args.window_size > 0 or args.num_windows > 0:
+        logging.error("--follow can't be combined with --refs, --regions, --window_size or --num_windows.\n")
+        sys.exit(3)
+    query_name = "stdin" if args.am_file == "-" else ss_utils.file_prefix(args.am_file)
+    filters = (args.map_qual, args.min_aln, args.multireads)
+
+    references = None
+    aln_stats = None
+    for batch_file in ss_fp.follow_sam_batches(args.am_file, args.update_records, args.update_seconds,
+                                               args.idle_timeout):
+        # The reference sequences are read from the stream's header, which is written to every batch
+        if references is None:
+            ref_cache = args.ref_cache
+            if ref_cache == "" and args.fasta_file:
+                ref_cache = os.path.dirname(os.path.abspath(args.fasta_file))
+            references = ss_aln_utils.load_references(ss_fp.reference_seq_lengths(batch_file, args.fasta_file,
+                                                                                  ref_cache))
+        columns = ss_fp.sam_columns_ext(batch_file, args.multireads, args.min_aln, args.map_qual, 1,
+                                        args.name_grouped)
+        batch_stats = ss_aln_utils.sufficient_stats(references, columns, filters)
+        columns.clear()
+        if aln_stats is None:
+            batch_stats["sample"] = numpy.array(query_name)
+            aln_stats = batch_stats
+        else:
+            aln_stats = ss_aln_utils.merge_sufficient_stats([aln_stats, batch_stats])
+        write_stats_table(aln_stats, args.output_table, query_name, args.p_cov, args.sep)
+        logging.info("Updated '%s' with %d reads mapped.\n" % (args.output_table, aln_stats["reads_mapped"].sum()))
+
+    if args.stats_output:
+        ss_fp.write_sufficient_stats(aln_stats, args.stats_output)
+
+    return 0
+
+
+def checkpoint_stats(args) -> int:
+    """
+    Summarizes a SAM file in parts for `samsum stats --checkpoint`, writing a checkpoint after each part so a run that
+    is interrupted continues from its last checkpoint with --resume rather than from the start of the file.
+    Each part ends where a read's alignments start, found by file_parsers.next_read_offset, so no read is split between
+    parts and the multiplicity of the reads parsed so far never needs to be kept. A checkpoint holds the offset the
+    next part starts at, the signature of the SAM file and the summed alignment statistics of the parts parsed so far,
+    which are merged as by `samsum merge` so the table is the same as that of a run without checkpoints.
+
+    :param args: The arguments of `samsum stats`, parsed from the command-line
+    :return: 0 once the table has been written
+    """
+    if args.refs or args.regions or args.window_size > 0 or args.num_windows > 0:
+        logging.error("Checkpoints can't be combined with --refs, --regions, --window_size or --num_windows.\n")
+        sys.exit(3)
+    if ss_fp.is_bgzf(args.am_file):
+        logging.error("Checkpoints can only be written for SAM files, '%s' is compressed.\n" % args.am_file)
+        sys.exit(3)
+    if not args.name_grouped and not ss_fp.sam_header_grouped(args.am_file):
+        logging.error("Checkpoints require the alignments of each read to be adjacent, as aligners write them."
+                      " Use --name_grouped if they are but the header doesn't say so.\n")
+        sys.exit(3)
+    checkpoint_file = args.checkpoint if args.checkpoint else args.output_table + ".checkpoint.npz"
+    query_name = ss_utils.file_prefix(args.am_file)
+    filters = (args.map_qual, args.min_aln, args.multireads)
+    signature = ss_fp.fasta_signature(args.am_file)
+    file_size = signature[0]
+
+    ref_cache = args.ref_cache
+    if ref_cache == "" and args.fasta_file:
+        ref_cache = os.path.dirname(os.path.abspath(args.fasta_file))
+    references = ss_aln_utils.load_references(ss_fp.reference_seq_lengths(args.am_file, args.fasta_file, ref_cache))
+
+    aln_stats = None
+    offset = 0
+    if args.resume and os.path.isfile(checkpoint_file):
+        aln_stats = ss_fp.read_sufficient_stats(checkpoint_file)
+        # The modification time isn't compared since copying the SAM file to another node changes it
+        checkpoint_signature = aln_stats.pop("signature").tolist()
+        if (checkpoint_signature[0], checkpoint_signature[2]) != (signature[0], signature[2]):
+            logging.error("The checkpoint '%s' is not of the SAM file '%s'.\n" % (checkpoint_file, args.am_file))
+            sys.exit(3)
+        if aln_stats["filters"].tolist() != list(filters):
+            logging.error("The checkpoint '%s' was written with different mapping quality, aligned percentage or"
+                          " multireads options.\n" % checkpoint_file)
+            sys.exit(3)
+        offset = int(aln_stats.pop("offset"))
+        logging.info("Resuming from byte %d of %d in '%s'.\n" % (offset, file_size, args.am_file))
+
+    part_size = args.checkpoint_interval * 1024 * 1024
+    while aln_stats is None or offset < file_size:
+        part_end = ss_fp.next_read_offset(args.am_file, offset + part_size)
+        columns = ss_fp.sam_columns_ext(args.am_file, args.multireads, args.min_aln, args.map_qual, args.num_threads,
+                                        True, None, ss_fp.log_progress, PROGRESS_INTERVAL, (offset, part_end))
+        part_stats = ss_aln_utils.sufficient_stats(references, columns, filters)
+        columns.clear()
+        if aln_stats is None:
+            part_stats["sample"] = numpy.array(query_name)
+            aln_stats = part_stats
+        else:
+            aln_stats = ss_aln_utils.merge_sufficient_stats([aln_stats, part_stats])
+        offset = part_end
+
+        checkpoint = dict(aln_stats)
+        checkpoint["offset"] = numpy.array(offset)
+        checkpoint["signature"] = numpy.array(signature)
+        ss_fp.write_sufficient_stats(checkpoint, checkpoint_file)
+        logging.info("Checkpoint written at byte %d of %d.\n" % (offset, file_size))
+
+    write_stats_table(aln_stats, args.output_table, query_name, args.p_cov, args.sep)
+    if args.stats_output:
+        ss_fp.write_sufficient_stats(aln_stats, args.stats_output)
+    os.remove(checkpoint_file)
+
+    return 0
+
+
+# The reference sequence lengths shared by the samples a multi worker process summarizes, set by init_sample_worker
+SAMPLE_REFSEQ_LENGTHS = {}
+
+
+def init_sample_worker(refseq_lengths: dict) -> None:
+    """
+    Initializes a worker process of `samsum multi` with the reference sequence lengths, so they are only sent to each
+    process once rather than with every sample.
+
+    :param refseq_lengths: A dictionary of sequence lengths indexed by their respective sequence names
+    :return: None
+    """
+    SAMPLE_REFSEQ_LENGTHS.clear()
+    SAMPLE_REFSEQ_LENGTHS.update(refseq_lengths)
+    return
+
+
+def sample_abundances(sample: tuple):
+    """
+    Calculates the abundances of the reference sequences in a single sample for `samsum multi`.
+    The sample's alignment file header is checked against the reference sequences shared by all samples.
+
+    :param sample: A tuple of the alignment file's path, the minimum mapping quality, the minimum percentage a reference
+    sequence must be covered, the minimum aligned percentage of a read, and the multireads and name_grouped flags
+    :return: A tuple of the numpy arrays of the coverage, fragments, FPKM and TPM of each reference sequence followed
+    by the number of unmapped fragments, or None if the sample couldn't be summarized
+    """
+    aln_file, map_qual, p_cov, min_aln, multireads, name_grouped = sample
+    try:
+        ss_fp.check_header_lengths(ss_fp.sam_seq_lengths(aln_file), SAMPLE_REFSEQ_LENGTHS)
+        references, num_unmapped = reference_abundances(aln_file, SAMPLE_REFSEQ_LENGTHS, map_qual, p_cov, min_aln,
+                                                        multireads, 1, name_grouped, None, None)
+    except SystemExit:
+        # Worker processes of a pool must return rather than exit, the reason has already been logged
+        return None
+
+    return references.depth, references.weight_total, references.fpkm, references.tpm, num_unmapped
+
+
+def multi(sys_args):
+    """
+    A user-facing sub-command to write matrices of abundance metrics, with one column per sample, from the alignment
+    files of many samples to the same reference sequences.
+    The reference sequence lengths are loaded once and the samples are summarized in parallel by a pool of processes.
+
+    :param sys_args: List of arguments parsed from the command-line.
+    :return: None
+    """
+    parser = ss_args.SAMSumArgumentParser(description="Write matrices of read coverage stats over reference sequences"
+                                                      " with a column for each sample.")
+    parser.add_multi_args()
+    args = parser.parse_args(sys_args)
+
+    ss_log.prep_logging(os.path.join(os.path.dirname(args.output_prefix), "samsum_log.txt"), args.verbose)
+
+    samples = [ss_utils.file_prefix(aln_file) for aln_file in args.am_files]
+    if len(set(samples)) != len(samples):
+        logging.error("The alignment files' names must be unique, as they are used for the sample names.\n")
+        sys.exit(3)
+
+    # Find the length of each reference sequence once, from the FASTA or the header of the first alignment file
+    ref_cache = args.ref_cache
+    if ref_cache == "" and args.fasta_file:
+        ref_cache = os.path.dirname(os.path.abspath(args.fasta_file))
+    refseq_lengths = ss_fp.reference_seq_lengths(args.am_files[0], args.fasta_file, ref_cache)
+    references = ss_aln_utils.load_references(refseq_lengths)
+
+    # Bound the number of samples summarized at once by the number of threads and the estimated memory of the largest
+    num_procs = max(1, min(args.num_threads, len(samples)))
+    if args.memory > 0:
+        sample_bytes = max(ss_fp.alignment_memory_estimate(aln_file) for aln_file in args.am_files)
+        sample_bytes += 128 * len(references)
+        num_procs = max(1, min(num_procs, args.memory * 1024 * 1024 // sample_bytes))
+    logging.info("Summarizing %d samples with %d processes.\n" % (len(samples), num_procs))
+
+    tasks = [(aln_file, args.map_qual, args.p_cov, args.min_aln, args.multireads, args.name_grouped)
+             for aln_file in args.am_files]
+    if num_procs == 1:
+        init_sample_worker(refseq_lengths)
+        results = map(sample_abundances, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_procs, initializer=init_sample_worker, initargs=(refseq_lengths,))
+        results = pool.imap(sample_abundances, tasks)
+
+    matrices = {metric: numpy.zeros((len(references), len(samples)), dtype=numpy.float64)
+                for metric in ["Coverage", "Fragments", "FPKM", "TPM"]}
+    unmapped = []
+    for i, result in enumerate(results):
+        if result is None:
+            if pool:
+                pool.terminate()
+            logging.error("Unable to summarize the alignments in '%s'.\n" % args.am_files[i])
+            sys.exit(3)
+        for metric, values in zip(["Coverage", "Fragments", "FPKM", "TPM"], result):
+            matrices[metric][:, i] = values
+        unmapped.append(result[-1])
+        logging.info("Summarized the alignments of sample '%s'.\n" % samples[i])
+    if pool:
+        pool.close()
+        pool.join()
+    refseq_lengths.clear()
+    init_sample_worker({})
+
+    # Write one matrix per metric, with the unmapped fragments of each sample in the fragments matrix
+    table_ext = ".tsv" if args.sep == "\t" else ".csv"
+    for metric, values in matrices.items():
+        ss_fp.write_abundance_matrix(references.names, samples, values, args.output_prefix + "_" + metric + table_ext,
+                                     unmapped if metric == "Fragments" else None, args.sep)
 
     return 0
@@ -1,8 +1,13 @@
 import os
 import sys
+import gzip
+import time
+import zlib
+import struct
 import logging
-import itertools
+import tempfile
 
+import numpy
 from pyfastx import Fasta
 
 import _sam_module
@@ -11,46 +16,451 @@ from samsum import classy as ss_class
 __author__ = 'Connor Morgan-Lang'
 
 
-def sam_parser_ext(sam_file: str, multireads=False, aln_percent=0, min_mq=0) -> dict:
+def log_progress(lines: int, num_bytes: int, mapped: int, unmapped: int) -> None:
+    """
+    A progress callback for the _sam_module extension's parsing functions that logs the number of alignment lines
+    parsed so far.
+
+    :param lines: The number of alignment lines or records parsed
+    :param num_bytes: The number of bytes of the alignment file read; compressed bytes for BAM files
+    :param mapped: The number of alignments that passed the filters
+    :param unmapped: The number of unmapped alignments
+    :return: None
+    """
+    logging.info("Parsed %d alignment lines (%.1f MB): %d mapped and %d unmapped.\n" %
+                 (lines, num_bytes / 1E6, mapped, unmapped))
+    return
+
+
+def sam_parser_ext(sam_file: str, multireads=False, aln_percent=0, min_mq=0, progress=None,
+                   progress_interval=1000) -> dict:
     """
     Wrapper function for using the _sam_parser extension to rapidly parse SAM files.
 
+    :param sam_file: Path to the SAM file to be parsed
+    :param multireads: Boolean flag indicating whether reads that have multiple ambiguous mapping positions are used
+    :param aln_percent: The minimum percentage of a read's length that must be aligned to be included.
+    :param min_mq: The minimum mapping quality for a read to be included in the analysis (as mapped).
+     Alignments below either threshold are filtered by the extension and only their weight is returned, as part of the
+     unmapped weight.
+    :param progress: Optional callable that is passed the number of lines, bytes, mapped and unmapped alignments
+     parsed, such as log_progress. The file is parsed without holding the GIL so other Python threads keep running.
+    :param progress_interval: The minimum number of milliseconds between calls to progress
+    :return: A dictionary mapping reference sequence names to lists of their alignments, as Match instances in the
+     order they were parsed. The weight of the unmapped fragments is stored by a single Match under "UNMAPPED".
+    """
+    if not os.path.isfile(sam_file):
+        logging.error("SAM file '%s' doesn't exist.\n" % sam_file)
+        sys.exit(3)
+
+    check_bgzf_eof(sam_file)
+    # The alignments are grouped by reference sequence by the extension
+    try:
+        reads_mapped = _sam_module.get_reference_alignments(sam_file, multireads, aln_percent, min_mq,
+                                                            progress, progress_interval)
+    except IOError as error:
+        logging.error(str(error) + "\n")
+        sys.exit(3)
+    if len(reads_mapped) <= 1:
+        logging.warning("No alignments passed the filters in SAM file '%s'\n" % sam_file)
+
+    logging.debug("%d reference sequences returned by _sam_module.\n" % (len(reads_mapped) - 1))
+
+    return reads_mapped
+
+
+def sam_coverage_ext(sam_file: str, multireads=False, aln_percent=0, min_mq=0, threads=1, name_grouped=False,
+                     regions=None, progress=None, progress_interval=1000) -> dict:
+    """
+    Wrapper function for using the _sam_module extension to sum the alignment statistics for each reference sequence
+    while the SAM file is parsed. Unlike sam_parser_ext, no objects are created for the individual alignments so memory
+    is proportional to the number of reference sequences and reads rather than the number of alignments.
+
     :param sam_file: Path to the SAM file to be parsed
     :param multireads: Boolean flag indicating whether reads that have multiple ambiguous mapping positions are used
     :param aln_percent: The minimum percentage of a read's length that must be aligned to be included.
     :param min_mq: The minimum mapping quality for a read to be included in the analysis (as mapped)
-    :return: A dictionary mapping query sequence (read) names to a list of alignment data strings
+    :param threads: The number of threads to use for decompressing BAM files or parsing SAM files
+    :param name_grouped: Flag indicating all alignments of a read are adjacent, so reads can be weighed as they are
+     parsed. This is detected automatically from the header's @HD SO:queryname or GO:query tags.
+    :param regions: Optional list of (name, start, end) tuples, with 0-based half-open coordinates, that the
+     alignments are restricted to. Only the parts of an indexed BAM file that hold these regions are read and the
+     weight of every other fragment, estimated from the index, is included in the unmapped weight.
+    :param progress: Optional callable that is passed the number of lines, bytes, mapped and unmapped alignments
+     parsed, such as log_progress
+    :param progress_interval: The minimum number of milliseconds between calls to progress
+    :return: A dictionary mapping reference sequence names to tuples of
+     (reads_mapped, weight_total, bases_mapped, bases_covered, leftmost, rightmost)
     """
     if not os.path.isfile(sam_file):
         logging.error("SAM file '%s' doesn't exist.\n" % sam_file)
         sys.exit(3)
 
-    reads_mapped = dict()
-    mapping_list = iter(_sam_module.get_mapped_reads(sam_file, multireads, aln_percent, min_mq, 'r'))
-    if not mapping_list:
-        logging.error("No alignments were read from SAM file '%s'\n" % sam_file)
-        sys.exit(5)
+    check_bgzf_eof(sam_file)
+    index_file = bam_index_path(sam_file) if regions is not None else None
+    try:
+        ref_stats = _sam_module.get_reference_coverage(sam_file, multireads, aln_percent, min_mq, threads,
+                                                       name_grouped, index_file, regions, progress, progress_interval)
+    except IOError as error:
+        logging.error(str(error) + "\n")
+        sys.exit(3)
+    if len(ref_stats) == 1:
+        logging.warning("No alignments passed the filters in SAM file '%s'\n" % sam_file)
+
+    logging.debug("%d reference sequences returned by _sam_module.\n" % (len(ref_stats) - 1))
+
+    return ref_stats
+
 
-    mapping_list_grouped = itertools.groupby(sorted(mapping_list, key=lambda x: x.subject), lambda x: x.subject)
+def sam_columns_ext(sam_file: str, multireads=False, aln_percent=0, min_mq=0, threads=1, name_grouped=False,
+                    regions=None, progress=None, progress_interval=1000, byte_range=None) -> dict:
+    """
+    Wrapper function for using the _sam_module extension to parse a SAM or BAM file into columns of alignment values.
+    Each column is a numpy array that shares its memory with the extension, with one element per alignment that passed
+    the mapping quality and aligned percentage thresholds.
 
-    logging.info("Grouping alignment data by reference sequence... ")
+    :param sam_file: Path to the SAM/BAM file to be parsed
+    :param multireads: Boolean flag indicating whether reads that have multiple ambiguous mapping positions are used
+    :param aln_percent: The minimum percentage of a read's length that must be aligned to be included.
+    :param min_mq: The minimum mapping quality for a read to be included in the analysis (as mapped)
+    :param threads: The number of threads to use for decompressing BAM files or parsing SAM files
+    :param name_grouped: Flag indicating all alignments of a read are adjacent, so reads can be weighed as they are
+     parsed. This is detected automatically from the header's @HD SO:queryname or GO:query tags.
+    :param regions: Optional list of (name, start, end) tuples, with 0-based half-open coordinates, that the
+     alignments are restricted to. Only the parts of an indexed BAM file that hold these regions are read and the
+     weight of every other fragment, estimated from the index, is included in the unmapped weight.
+    :param progress: Optional callable that is passed the number of lines, bytes, mapped and unmapped alignments
+     parsed, such as log_progress
+    :param progress_interval: The minimum number of milliseconds between calls to progress
+    :param byte_range: Optional (start, end) tuple of offsets in a SAM file. Only the alignment lines that start in
+     this range are parsed, e.g. between two offsets from next_read_offset.
+    :return: A dictionary with numpy arrays for 'ref_id', 'start', 'end', 'weight', 'mapq' and 'read_length',
+     a list of reference sequence names indexed by ref_id under 'ref_names' and the weight of unmapped fragments under
+     'unmapped'
+    """
+    if not os.path.isfile(sam_file):
+        logging.error("SAM file '%s' doesn't exist.\n" % sam_file)
+        sys.exit(3)
 
-    for key, group in mapping_list_grouped:
-        reads_mapped[key] = list(group)
+    check_bgzf_eof(sam_file)
+    index_file = bam_index_path(sam_file) if regions is not None else None
+    byte_start, byte_end = byte_range if byte_range else (0, 0)
+    try:
+        columns = _sam_module.get_alignment_columns(sam_file, multireads, aln_percent, min_mq, threads,
+                                                    name_grouped, index_file, regions, progress, progress_interval,
+                                                    byte_start, byte_end)
+    except IOError as error:
+        logging.error(str(error) + "\n")
+        sys.exit(3)
+    for name, dtype in [("ref_id", numpy.uint32), ("start", numpy.uint32), ("end", numpy.uint32),
+                        ("weight", numpy.float32), ("mapq", numpy.uint8), ("read_length", numpy.uint32)]:
+        columns[name] = numpy.frombuffer(columns[name], dtype=dtype)
 
-    logging.info("done.\n")
+    logging.debug("%d alignments to %d reference sequences returned by _sam_module.\n" %
+                  (len(columns["ref_id"]), len(columns["ref_names"])))
 
-    logging.debug("%d of unique read names returned by _sam_module.\n" % len(reads_mapped))
+    return columns
 
-    return reads_mapped
+
+def sam_header_grouped(sam_file: str) -> bool:
+    """
+    Reads the @HD line in the header of a SAM file to find whether all alignments of a read are adjacent, either
+    because the file is sorted by query name (SO:queryname) or grouped by query (GO:query).
+
+    :param sam_file: Path to the SAM file
+    :return: True if the header declares the alignments to be grouped by read, False otherwise
+    """
+    with open(sam_file, 'rb') as sam_handler:
+        for line in sam_handler:
+            if not line.startswith(b"@"):
+                break
+            if line.startswith(b"@HD"):
+                tags = line.rstrip().split(b"\t")[1:]
+                return b"SO:queryname" in tags or b"GO:query" in tags
+    return False
+
+
+def next_read_offset(sam_file: str, offset: int) -> int:
+    """
+    Finds the offset of the first line in a SAM file, at or after offset, whose query name differs from that of the
+    line before it. If the alignments of each read are adjacent, the parts of the file either side of this offset
+    hold the alignments of separate reads and can be summarized separately.
+
+    :param sam_file: Path to the SAM file
+    :param offset: The offset in the file to start searching from
+    :return: The offset of the start of a read's alignments, or the size of the file if there are none after offset
+    """
+    if offset <= 0:
+        return 0
+    if offset >= os.path.getsize(sam_file):
+        return os.path.getsize(sam_file)
+    with open(sam_file, 'rb') as sam_handler:
+        sam_handler.seek(offset - 1)
+        # Move to the start of the next line, unless offset is already the start of a line
+        if sam_handler.read(1) != b"\n":
+            sam_handler.readline()
+        line_start = sam_handler.tell()
+        line = sam_handler.readline()
+        read_name = line.split(b"\t", 1)[0]
+        while line:
+            line_start = sam_handler.tell()
+            line = sam_handler.readline()
+            if line.split(b"\t", 1)[0] != read_name:
+                break
+    return line_start
+
+
+def follow_sam_batches(aln_file: str, max_records=100000, max_seconds=60.0, idle_timeout=300.0, poll_interval=1.0):
+    """
+    Generator that reads a SAM stream that is still being written, either from stdin if aln_file is '-' or by
+    following a growing file as `tail -f` does, and divides its alignments into batches. Each batch is written with the
+    header to a temporary SAM file whose path is yielded, so it can be parsed by the _sam_module extension; the file is
+    overwritten by the next batch and removed once the stream ends.
+    A batch ends at the first read after max_records alignment lines or max_seconds seconds. The alignments of each
+    read must be adjacent, as aligners write them, so they are all in the same batch.
+    Reading stdin ends at EOF, while following a file ends once it hasn't grown for idle_timeout seconds.
+
+    :param aln_file: Path to the SAM file to follow, or '-' for stdin
+    :param max_records: The maximum number of alignment lines in a batch, except for the alignments of its last read
+    :param max_seconds: The maximum number of seconds between batches, if any alignments were read
+    :param idle_timeout: The number of seconds a followed file must not grow for before it is considered complete
+    :param poll_interval: The number of seconds to wait before reading a followed file again once its end is reached
+    :return: Paths to the SAM files of each batch
+    """
+    if aln_file == "-":
+        stream = sys.stdin.buffer
+    else:
+        try:
+            stream = open(aln_file, 'rb')
+        except IOError:
+            logging.error("Unable to open SAM file '%s' for reading.\n" % aln_file)
+            sys.exit(3)
+
+    batch_fd, batch_file = tempfile.mkstemp(prefix="samsum_batch_", suffix=".sam")
+    os.close(batch_fd)
+    header = []
+    batch = []
+    read_lines = []
+    partial = b""
+    read_name = None
+    last_batch = last_growth = time.time()
+    num_batches = 0
+    try:
+        while True:
+            line = stream.readline()
+            if line:
+                last_growth = time.time()
+                partial += line
+                # A followed file may end part way through a line that is still being written
+                if not partial.endswith(b"\n"):
+                    continue
+                line, partial = partial, b""
+            elif aln_file == "-" or time.time() - last_growth >= idle_timeout:
+                break
+            else:
+                # The followed file hasn't grown; write the reads that are complete if a batch is due
+                if batch and time.time() - last_batch >= max_seconds:
+                    write_sam_batch(batch_file, header, batch)
+                    batch.clear()
+                    last_batch = time.time()
+                    num_batches += 1
+                    yield batch_file
+                time.sleep(poll_interval)
+                continue
+
+            if not header and not read_lines and line.startswith(b"\x1f\x8b"):
+                logging.error("Only SAM alignments can be followed, '%s' is compressed.\n" % aln_file)
+                sys.exit(3)
+            if line.startswith(b"@") and not batch and not read_lines:
+                header.append(line)
+                continue
+            name = line.split(b"\t", 1)[0]
+            if name != read_name:
+                batch.extend(read_lines)
+                read_lines.clear()
+                read_name = name
+                if len(batch) >= max_records or (batch and time.time() - last_batch >= max_seconds):
+                    write_sam_batch(batch_file, header, batch)
+                    batch.clear()
+                    last_batch = time.time()
+                    num_batches += 1
+                    yield batch_file
+            read_lines.append(line)
+
+        if partial:
+            read_lines.append(partial + b"\n")
+        batch.extend(read_lines)
+        if batch or num_batches == 0:
+            write_sam_batch(batch_file, header, batch)
+            yield batch_file
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+        os.remove(batch_file)
+    return
 
 
-def fasta_seq_lengths(fasta_file: str, min_seq_length=0) -> dict:
+def write_sam_batch(batch_file: str, header: list, batch: list) -> None:
     """
-    Function for calculating the lengths of all sequences in a FASTA file.
+    Writes the header and alignment lines of a batch from follow_sam_batches to a SAM file.
+
+    :param batch_file: Path to the SAM file to write
+    :param header: A list of the header lines, as bytes
+    :param batch: A list of the alignment lines, as bytes
+    :return: None
+    """
+    with open(batch_file, 'wb') as batch_handler:
+        batch_handler.writelines(header)
+        batch_handler.writelines(batch)
+    return
+
+
+# Header of a reference catalogue: magic string, FASTA size, modification time (ns) and checksum, number of sequences
+# and the length of the newline-separated sequence names. The int64 lengths and then the names follow the header.
+CATALOGUE_MAGIC = b"SSREFCAT"
+CATALOGUE_HEADER = struct.Struct("<8sQqIQQ")
+CATALOGUE_LENGTHS_OFFSET = 48
+
+
+def fasta_signature(fasta_file: str, sample_size=65536) -> tuple:
+    """
+    Summarizes a FASTA file by its size, modification time and a checksum of its first and last bytes, which is
+    enough to tell whether a reference catalogue is out of date without reading the whole file.
+
+    :param fasta_file: Path to a FASTA file
+    :param sample_size: The number of bytes at each end of the file that the checksum is calculated from
+    :return: A tuple of the file's size, modification time in nanoseconds and checksum
+    """
+    stat = os.stat(fasta_file)
+    with open(fasta_file, 'rb') as fa_handler:
+        checksum = zlib.crc32(fa_handler.read(sample_size))
+        if stat.st_size > sample_size:
+            fa_handler.seek(max(sample_size, stat.st_size - sample_size))
+            checksum = zlib.crc32(fa_handler.read(sample_size), checksum)
+    return stat.st_size, stat.st_mtime_ns, checksum
+
+
+def catalogue_path(fasta_file: str, cache_dir: str) -> str:
+    """
+    Names the reference catalogue of a FASTA file in cache_dir. The name includes a checksum of the FASTA's absolute
+    path so FASTA files with the same name in different directories can share a cache directory.
+
+    :param fasta_file: Path to a FASTA file
+    :param cache_dir: Path to the directory the catalogue is stored in
+    :return: Path to the reference catalogue
+    """
+    path_hash = "%08x" % zlib.crc32(os.path.abspath(fasta_file).encode())
+    return os.path.join(cache_dir, os.path.basename(fasta_file) + "." + path_hash + ".sscat")
+
+
+def write_reference_catalogue(catalogue_file: str, signature: tuple, seq_lengths_map: dict) -> None:
+    """
+    Writes the names and lengths of the sequences in a FASTA file to a reference catalogue. The sequences' integer IDs
+    are their positions in the catalogue. The catalogue is written to a temporary file that is then renamed so
+    concurrent runs never read a partially written catalogue.
+
+    :param catalogue_file: Path to the reference catalogue
+    :param signature: The size, modification time and checksum of the FASTA file, from fasta_signature
+    :param seq_lengths_map: A dictionary of sequence lengths indexed by their respective sequence names
+    :return: None
+    """
+    names = "\n".join(seq_lengths_map).encode()
+    lengths = numpy.fromiter(seq_lengths_map.values(), dtype=numpy.int64, count=len(seq_lengths_map))
+    tmp_file = catalogue_file + ".%d.tmp" % os.getpid()
+    with open(tmp_file, 'wb') as cat_handler:
+        cat_handler.write(CATALOGUE_HEADER.pack(CATALOGUE_MAGIC, *signature, len(lengths), len(names)))
+        cat_handler.write(b"\0" * (CATALOGUE_LENGTHS_OFFSET - CATALOGUE_HEADER.size))
+        cat_handler.write(lengths.tobytes())
+        cat_handler.write(names)
+    os.replace(tmp_file, catalogue_file)
+    return
+
+
+def read_reference_catalogue(catalogue_file: str, signature: tuple):
+    """
+    Reads the sequence names and lengths from a reference catalogue if it matches the FASTA file's signature.
+    The lengths are memory-mapped rather than read.
+
+    :param catalogue_file: Path to the reference catalogue
+    :param signature: The size, modification time and checksum of the FASTA file, from fasta_signature
+    :return: A list of sequence names and a numpy array of their lengths, or None if the catalogue is missing,
+     corrupt or out of date
+    """
+    try:
+        with open(catalogue_file, 'rb') as cat_handler:
+            header = cat_handler.read(CATALOGUE_HEADER.size)
+    except IOError:
+        return None
+    if len(header) < CATALOGUE_HEADER.size:
+        return None
+    magic, size, mtime, checksum, num_seqs, names_size = CATALOGUE_HEADER.unpack(header)
+    if magic != CATALOGUE_MAGIC or (size, mtime, checksum) != tuple(signature):
+        return None
+    names_offset = CATALOGUE_LENGTHS_OFFSET + 8*num_seqs
+    if os.path.getsize(catalogue_file) != names_offset + names_size or num_seqs == 0:
+        return None
+
+    lengths = numpy.memmap(catalogue_file, dtype=numpy.int64, mode='r', offset=CATALOGUE_LENGTHS_OFFSET,
+                           shape=(num_seqs,))
+    names = numpy.memmap(catalogue_file, dtype=numpy.uint8, mode='r', offset=names_offset,
+                         shape=(names_size,)).tobytes().decode().split("\n")
+    if len(names) != num_seqs:
+        return None
+    return names, lengths
+
+
+def fai_seq_lengths(fai_file: str, fasta_file: str) -> dict:
+    """
+    Function for reading the lengths of all sequences from a FASTA index (.fai) file created by samtools faidx.
+    The index only holds the sequence names up to the first whitespace, so the full names are read from the header
+    lines of the FASTA file, which end where the index says each sequence starts. Only the last line of the previous
+    sequence and the header line are read for each sequence.
+
+    :param fai_file: Path to a FASTA index file
+    :param fasta_file: Path to the FASTA file that was indexed, which may be gzip-compressed
+    :return: A dictionary of sequence lengths indexed by their respective full sequence names, or an empty dictionary
+     if the header lines of the FASTA file don't match the index
+    """
+    entries = []
+    with open(fai_file) as fai_handler:
+        for line in fai_handler:
+            fields = line.split("\t")
+            if len(fields) >= 5:
+                entries.append((int(fields[2]), fields[0], int(fields[1]), int(fields[3]), int(fields[4])))
+    entries.sort()
+
+    seq_lengths_map = {}
+    with open(fasta_file, 'rb') as fasta_handler:
+        opener = gzip.open if fasta_handler.read(2) == b"\x1f\x8b" else open
+    # The offsets only increase so a gzip-compressed FASTA file is never rewound
+    with opener(fasta_file, 'rb') as fasta_handler:
+        seq_end = 0
+        for offset, name, length, line_bases, line_width in entries:
+            fasta_handler.seek(seq_end)
+            header = fasta_handler.read(offset - seq_end).rstrip(b"\r\n").rsplit(b"\n", 1)[-1].decode().strip()
+            if not header.startswith('>') or header[1:].split()[:1] != [name]:
+                logging.debug("Header line of '%s' in '%s' doesn't match the index '%s'.\n" %
+                              (name, fasta_file, fai_file))
+                return {}
+            seq_lengths_map[header[1:]] = length
+            # The next header line starts after the last line of this sequence
+            if line_bases > 0:
+                seq_end = offset + (max(length - 1, 0)//line_bases)*line_width
+    return seq_lengths_map
+
+
+def fasta_seq_lengths(fasta_file: str, min_seq_length=0, cache_dir=None) -> dict:
+    """
+    Function for calculating the lengths of all sequences in a FASTA file, which may be gzip-compressed.
+    If a FASTA index (.fai) that is newer than the FASTA file exists the lengths are read from it instead, along with the
+    full sequence names from the FASTA's header lines.
+
+    When a cache_dir is provided the lengths are stored in a reference catalogue so later calls with the same, unchanged
+    FASTA file only need to memory-map the catalogue.
 
     :param fasta_file: Path to a FASTA file to be parsed
     :param min_seq_length: The minimum length for a reference sequence to be included
+    :param cache_dir: Optional path to the directory where the reference catalogue is stored
     :return: A dictionary of sequence lengths indexed by their respective sequence names
     """
     if not os.path.isfile(fasta_file):
@@ -58,27 +468,312 @@ def fasta_seq_lengths(fasta_file: str, min_seq_length=0) -> dict:
         sys.exit(3)
 
     seq_lengths_map = {}
-    logging.debug("Using Pyfastx to retrieve sequence lengths from FASTA... ")
-    try:
-        py_fa = Fasta(fasta_file, build_index=False, full_name=True)
-    except RuntimeError as error:
-        logging.debug(str(error)+"\n")
-        return seq_lengths_map
+    catalogue_file = None
+    catalogue = None
+    signature = None
+    if cache_dir is not None:
+        catalogue_file = catalogue_path(fasta_file, cache_dir)
+        signature = fasta_signature(fasta_file)
+        catalogue = read_reference_catalogue(catalogue_file, signature)
+        if catalogue:
+            logging.debug("Reading sequence lengths from the reference catalogue '%s'.\n" % catalogue_file)
+            names, lengths = catalogue
+            seq_lengths_map = dict(zip(names, lengths.tolist()))
+
+    fai_file = fasta_file + ".fai"
+    if not seq_lengths_map and os.path.isfile(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file):
+        logging.debug("Reading sequence lengths from the FASTA index '%s'.\n" % fai_file)
+        seq_lengths_map = fai_seq_lengths(fai_file, fasta_file)
 
-    for name, seq in py_fa:  # type: (str, str)
-        if len(seq) > min_seq_length:
+    if not seq_lengths_map:
+        logging.debug("Using Pyfastx to retrieve sequence lengths from FASTA... ")
+        try:
+            py_fa = Fasta(fasta_file, build_index=False, full_name=True)
+        except RuntimeError as error:
+            logging.debug(str(error)+"\n")
+            return seq_lengths_map
+
+        for name, seq in py_fa:  # type: (str, str)
             seq_lengths_map[name] = len(seq)
+        logging.debug("done.\n")
 
+    if catalogue_file and seq_lengths_map and not catalogue:
+        try:
+            write_reference_catalogue(catalogue_file, signature, seq_lengths_map)
+        except IOError as error:
+            logging.warning("Unable to write the reference catalogue '%s': %s\n" % (catalogue_file, str(error)))
+
+    seq_lengths_map = {name: length for name, length in seq_lengths_map.items() if length > min_seq_length}
     if not seq_lengths_map:
         logging.error("No sequences were parsed from the FASTA file '%s'\n" % fasta_file)
         sys.exit(5)
-    logging.debug("done.\n")
 
     logging.info(str(len(seq_lengths_map)) + " sequences were read from " + fasta_file + "\n")
 
     return seq_lengths_map
 
 
+def sam_seq_lengths(sam_file: str) -> dict:
+    """
+    Wrapper function for using the _sam_module extension to read the lengths of the reference sequences from the
+    @SQ lines in the header of a SAM or BAM file. Only the header is read.
+
+    :param sam_file: Path to the SAM/BAM file to be parsed
+    :return: A dictionary of sequence lengths indexed by their respective sequence names, in the order of the header
+    """
+    if not os.path.isfile(sam_file):
+        logging.error("SAM file '%s' doesn't exist.\n" % sam_file)
+        sys.exit(3)
+
+    try:
+        seq_lengths_map = _sam_module.get_reference_lengths(sam_file)
+    except IOError as error:
+        logging.error(str(error) + "\n")
+        sys.exit(3)
+    logging.debug("%d reference sequences were read from the header of %s\n" % (len(seq_lengths_map), sam_file))
+
+    return seq_lengths_map
+
+
+def bam_index_path(bam_file: str) -> str:
+    """
+    Finds the BAI or CSI index of a BAM file, named either by appending '.bai' or '.csi' to the BAM file's name or by
+    replacing its '.bam' extension with '.bai', as samtools does.
+
+    :param bam_file: Path to a coordinate-sorted BAM file
+    :return: Path to the BAM file's index
+    """
+    candidates = [bam_file + ".bai", bam_file + ".csi"]
+    if bam_file.endswith(".bam"):
+        candidates.append(bam_file[:-len(".bam")] + ".bai")
+    for index_file in candidates:
+        if os.path.isfile(index_file):
+            return index_file
+    logging.error("Unable to find a BAI or CSI index for '%s'. Regions can only be read from indexed BAM files.\n" %
+                  bam_file)
+    sys.exit(3)
+
+
+def bam_index_stats(bam_file: str) -> dict:
+    """
+    Wrapper function for using the _sam_module extension to read the number of records of each reference sequence from
+    a BAM file's index, without reading any alignments.
+
+    :param bam_file: Path to an indexed BAM file
+    :return: A dictionary of (mapped, unmapped) record counts indexed by reference sequence names. The number of
+     unmapped records that were not placed on a reference sequence is stored under '*'.
+    """
+    try:
+        return _sam_module.get_index_stats(bam_file, bam_index_path(bam_file))
+    except IOError as error:
+        logging.error(str(error) + "\n")
+        sys.exit(3)
+
+
+def read_regions(refs_file=None, bed_file=None) -> list:
+    """
+    Reads the reference sequences and regions that an analysis is restricted to. The reference sequences file has one
+    sequence name per line, while the BED file has a sequence name, 0-based start and end position on each line.
+
+    :param refs_file: Optional path to a file listing reference sequence names
+    :param bed_file: Optional path to a BED file of regions
+    :return: A list of reference sequence names (from refs_file) and (name, start, end) tuples (from bed_file)
+    """
+    regions = []
+    if refs_file:
+        with open(refs_file) as refs_handler:
+            for line in refs_handler:
+                if line.strip():
+                    regions.append(line.split()[0])
+    if bed_file:
+        with open(bed_file) as bed_handler:
+            for line_no, line in enumerate(bed_handler, 1):
+                if not line.strip() or line.startswith(('#', "track", "browser")):
+                    continue
+                fields = line.split("\t")
+                try:
+                    regions.append((fields[0], int(fields[1]), int(fields[2])))
+                except (IndexError, ValueError):
+                    logging.error("Line %d of BED file '%s' is not formatted as 'name<tab>start<tab>end'.\n" %
+                                  (line_no, bed_file))
+                    sys.exit(3)
+    return regions
+
+
+def resolve_regions(regions: list, seq_lengths_map: dict, whole_sequences=False) -> list:
+    """
+    Converts reference sequence names into regions covering the whole sequence and ensures every region is on a
+    reference sequence in seq_lengths_map, clipping regions that extend past the end of their sequence.
+
+    :param regions: A list of reference sequence names and (name, start, end) tuples with 0-based half-open coordinates
+    :param seq_lengths_map: A dictionary of sequence lengths indexed by their respective sequence names
+    :param whole_sequences: Flag indicating every region must span its whole reference sequence, e.g. when each
+     reference sequence's coverage and abundance are reported over its full length. Exits if one doesn't.
+    :return: A list of (name, start, end) tuples
+    """
+    resolved = []
+    for region in regions:
+        name, start, end = (region, 0, None) if isinstance(region, str) else region
+        if name not in seq_lengths_map:
+            logging.error("Reference sequence '%s' from the regions wasn't found in the alignment file's header.\n" %
+                          name)
+            sys.exit(3)
+        length = seq_lengths_map[name]
+        end = length if end is None else min(end, length)
+        if start < 0 or start >= end:
+            logging.error("Region %s:%d-%d is empty or outside of the reference sequence.\n" % (name, start, end))
+            sys.exit(3)
+        if whole_sequences and (start > 0 or end < length):
+            logging.error("Region %s:%d-%d doesn't span the whole reference sequence (%d bp). Abundances are reported"
+                          " for whole reference sequences only.\n" % (name, start, end, length))
+            sys.exit(3)
+        resolved.append((name, start, end))
+    return resolved
+
+
+def reference_seq_lengths(aln_file: str, fasta_file=None, cache_dir=None) -> dict:
+    """
+    Function for finding the lengths of the reference sequences the reads were aligned to. They are taken from the
+    header of the alignment file so the FASTA file doesn't need to be read. If a FASTA file is provided, its sequence
+    lengths are used instead after ensuring every reference sequence in the header is in the FASTA with the same length.
+
+    :param aln_file: Path to the SAM/BAM file containing the read alignments
+    :param fasta_file: Optional path to the FASTA file of reference sequences used to generate the alignment file
+    :param cache_dir: Optional path to the directory where the FASTA file's reference catalogue is stored
+    :return: A dictionary of sequence lengths indexed by their respective sequence names
+    """
+    header_lengths = sam_seq_lengths(aln_file)
+    if not fasta_file:
+        if not header_lengths:
+            logging.error("No @SQ lines were found in the header of '%s' so a reference FASTA file is required.\n" %
+                          aln_file)
+            sys.exit(5)
+        logging.info(str(len(header_lengths)) + " sequences were read from the header of " + aln_file + "\n")
+        return header_lengths
+
+    fasta_lengths = fasta_seq_lengths(fasta_file, cache_dir=cache_dir)
+    check_header_lengths(header_lengths, fasta_lengths)
+
+    return fasta_lengths
+
+
+def check_header_lengths(header_lengths: dict, seq_lengths_map: dict) -> None:
+    """
+    Ensures every reference sequence in the header of an alignment file is in a dictionary of sequence lengths, such as
+    those read from the reference FASTA, with the same length. Exits if one isn't.
+
+    :param header_lengths: A dictionary of sequence lengths read from the @SQ lines of an alignment file's header
+    :param seq_lengths_map: A dictionary of sequence lengths indexed by their respective sequence names
+    :return: None
+    """
+    # Alignment files only contain the sequence names up to the first whitespace
+    full_names = {seq_name.split(' ')[0]: seq_name for seq_name in seq_lengths_map}
+    for seq_name, seq_length in header_lengths.items():  # type: (str, int)
+        if seq_name not in full_names:
+            logging.error("Reference sequence from SAM file not found in FASTA: %s\n" % seq_name)
+            sys.exit(3)
+        if seq_lengths_map[full_names[seq_name]] != seq_length:
+            logging.error("Length of reference sequence '%s' in SAM file (%d) differs from the FASTA (%d).\n" %
+                          (seq_name, seq_length, seq_lengths_map[full_names[seq_name]]))
+            sys.exit(3)
+    return
+
+
+def alignment_memory_estimate(aln_file: str) -> int:
+    """
+    Estimates the number of bytes of memory needed to summarize the alignments in a SAM/BAM file.
+    Most of it is used by the table of read names, which holds an entry of roughly 100 bytes for each read until its
+    multiplicity is known. A SAM line is about three times that size, while BGZF compresses BAM records around
+    three-fold, so the estimate is a third of a SAM file's size or the whole size of a BAM file.
+
+    :param aln_file: Path to the SAM/BAM file containing the read alignments
+    :return: The estimated number of bytes
+    """
+    if is_bgzf(aln_file):
+        return os.path.getsize(aln_file)
+    return os.path.getsize(aln_file) // 3
+
+
+def is_bgzf(aln_file: str) -> bool:
+    """
+    Checks whether a file is BGZF-compressed, as BAM files are, from the gzip magic number and extra field flag.
+
+    :param aln_file: Path to the SAM/BAM file
+    :return: True if the file is BGZF-compressed, False otherwise
+    """
+    with open(aln_file, 'rb') as aln_handler:
+        return aln_handler.read(4) == b"\x1f\x8b\x08\x04"
+
+
+# The empty BGZF block that BAM files end with, written by htslib and samtools
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00" \
+           b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def check_bgzf_eof(aln_file: str) -> bool:
+    """
+    Checks whether a BGZF-compressed file ends with the empty EOF block, as htslib does. Without it the file may have
+    been truncated between two blocks, which can't be told from its end otherwise, so a warning is logged.
+
+    :param aln_file: Path to the SAM/BAM file
+    :return: False if the file is BGZF-compressed and the EOF block is missing, True otherwise
+    """
+    if not is_bgzf(aln_file):
+        return True
+    with open(aln_file, 'rb') as aln_handler:
+        aln_handler.seek(0, os.SEEK_END)
+        if aln_handler.tell() >= len(BGZF_EOF):
+            aln_handler.seek(-len(BGZF_EOF), os.SEEK_END)
+            if aln_handler.read() == BGZF_EOF:
+                return True
+    logging.warning("The EOF marker is absent from '%s'; it may be truncated.\n" % aln_file)
+    return False
+
+
+# The version of the format of the files written by write_sufficient_stats
+SUFFICIENT_STATS_VERSION = 1
+
+
+def write_sufficient_stats(stats: dict, stats_file: str) -> None:
+    """
+    Writes the statistics of each reference sequence returned by alignment_utils.sufficient_stats to a compressed numpy
+    (.npz) file, so the statistics of alignment files summarized separately can be merged later by `samsum merge`.
+    As with the reference catalogue, a temporary file is written and renamed so partially written files are never read.
+
+    :param stats: A dictionary of numpy arrays returned by alignment_utils.sufficient_stats
+    :param stats_file: Path to the file to write
+    :return: None
+    """
+    tmp_file = stats_file + ".%d.tmp" % os.getpid()
+    try:
+        with open(tmp_file, 'wb') as stats_handler:
+            numpy.savez_compressed(stats_handler, version=numpy.array(SUFFICIENT_STATS_VERSION), **stats)
+        os.replace(tmp_file, stats_file)
+    except (IOError, OSError):
+        logging.error("Unable to write the alignment statistics to '%s'.\n" % stats_file)
+        sys.exit(3)
+    return
+
+
+def read_sufficient_stats(stats_file: str) -> dict:
+    """
+    Reads the statistics of each reference sequence written by write_sufficient_stats.
+
+    :param stats_file: Path to the file written by write_sufficient_stats
+    :return: A dictionary of numpy arrays, as returned by alignment_utils.sufficient_stats
+    """
+    try:
+        with numpy.load(stats_file, allow_pickle=False) as stats_npz:
+            stats = {key: stats_npz[key] for key in stats_npz.files}
+    except (IOError, OSError, ValueError):
+        logging.error("Unable to read the alignment statistics in '%s'.\n" % stats_file)
+        sys.exit(3)
+    if stats.pop("version", None) != SUFFICIENT_STATS_VERSION:
+        logging.error("'%s' is not a samsum alignment statistics file of a supported version.\n" % stats_file)
+        sys.exit(3)
+    return stats
+
+
 def write_summary_table(references: dict, output_table: str, samsum_exp: str, unmapped_reads: float, sep=",") -> None:
     """
     Writes the output file most people care about - the table summarizing abundance metrics for each reference sequence.
@@ -87,7 +782,7 @@ def write_summary_table(references: dict, output_table: str, samsum_exp: str, un
     [RefSequence.name, Query.name, ProportionCovered, Reads, RPKM, FPKM, TPM]
     Included in this table as the first row are the unmapped reads (UNMAPPED) with relevant information where possible
 
-    :param references: A dictionary of RefSequence instances indexed by the reference sequence names (headers)
+    :param references: A RefTable of the reference sequences
     :param samsum_exp: String representing the origin of the query reads, or alignment experiment name
     :param output_table: A string representing the path of the file to write to
     :param unmapped_reads: The number of reads that were not mapped to the reference sequences
@@ -105,15 +800,88 @@ def write_summary_table(references: dict, output_table: str, samsum_exp: str, un
         logging.error("Unable to open output table '%s' for writing.\n" % output_table)
         sys.exit(3)
 
-    for seq_name in sorted(references, key=lambda x: references[x].tpm, reverse=True):  # type: str
-        ref_seq = references[seq_name]  # type: ss_class.RefSequence
-        data_fields = [ref_seq.covered, ref_seq.depth, ref_seq.weight_total, ref_seq.fpkm, ref_seq.tpm]
+    data_columns = numpy.column_stack([references.covered, references.depth, references.weight_total,
+                                       references.fpkm, references.tpm]).tolist()
+    for i in numpy.argsort(-references.tpm, kind="stable"):
+        buffer += sep.join([samsum_exp, references.names[i]] +
+                           [str(round(x, 3)) for x in data_columns[i]]) + "\n"
+        if len(buffer) > 1E6:
+            ot_handler.write(buffer)
+            buffer = ""
+    ot_handler.write(buffer)
+    ot_handler.close()
+
+    return
+
+
+def write_abundance_matrix(names: list, samples: list, values, output_table: str, unmapped=None, sep=",") -> None:
+    """
+    Writes a wide table of a single abundance metric, such as TPM, with a row for each reference sequence and a column
+    for each sample. The rows are in the order of the reference sequences.
+    Current header is:
+    [RefSequence, Sample1, Sample2, ...]
+
+    :param names: A list of the reference sequence names
+    :param samples: A list of the sample names, used as the column names
+    :param values: A numpy array with a row for each reference sequence and a column for each sample
+    :param output_table: A string representing the path of the file to write to
+    :param unmapped: Optional list with the number of unmapped fragments of each sample, written as the first row
+    :param sep: Field separator to use. The default is a comma.
+    :return: None
+    """
+    buffer = sep.join(["RefSequence"] + samples) + "\n"
+    if unmapped is not None:
+        buffer += sep.join(["UNMAPPED"] + [str(round(x, 3)) for x in unmapped]) + "\n"
+
+    try:
+        ot_handler = open(output_table, 'w')
+    except IOError:
+        logging.error("Unable to open output table '%s' for writing.\n" % output_table)
+        sys.exit(3)
+
+    for name, row in zip(names, values.tolist()):
+        buffer += sep.join([name] + [str(round(x, 3)) for x in row]) + "\n"
+        if len(buffer) > 1E6:
+            ot_handler.write(buffer)
+            buffer = ""
+    ot_handler.write(buffer)
+    ot_handler.close()
+
+    return
+
+
+def write_window_table(windows: dict, output_table: str, samsum_exp: str, sep=",") -> None:
+    """
+    Writes a long-format table with the coverage of each window across the reference sequences, as calculated by
+    alignment_utils.window_coverage. Current header is:
+    [Query.name, RefSequence.name, Start, End, ProportionCovered, Coverage, Fragments]
+    Start and End are the 1-based, inclusive coordinates of each window on its reference sequence.
+
+    :param windows: A dictionary of window names and numpy arrays returned by alignment_utils.window_coverage
+    :param output_table: A string representing the path of the file to write to
+    :param samsum_exp: String representing the origin of the query reads, or alignment experiment name
+    :param sep: Field separator to use. The default is a comma.
+    :return: None
+    """
+    header = ["QueryName", "RefSequence", "Start", "End", "ProportionCovered", "Coverage", "Fragments"]
+    buffer = sep.join(header) + "\n"
+
+    try:
+        ot_handler = open(output_table, 'w')
+    except IOError:
+        logging.error("Unable to open output table '%s' for writing.\n" % output_table)
+        sys.exit(3)
 
-        buffer += sep.join([samsum_exp, ref_seq.name] +
-                           [str(round(x, 3)) for x in data_fields]) + "\n"
+    names = windows["names"]
+    for i in range(len(windows["ref_index"])):
+        data_fields = [windows["covered"][i], windows["depth"][i], windows["weight"][i]]
+        buffer += sep.join([samsum_exp, names[windows["ref_index"][i]],
+                            str(windows["start"][i]), str(windows["end"][i])] +
+                           [str(round(float(x), 3)) for x in data_fields]) + "\n"
         if len(buffer) > 1E6:
             ot_handler.write(buffer)
             buffer = ""
     ot_handler.write(buffer)
+    ot_handler.close()
 
     return
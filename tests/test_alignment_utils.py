@@ -12,6 +12,144 @@ class MyTestCase(unittest.TestCase):
         self.assertFalse(alignment_utils.overlapping_intervals(coords_one, coords_three))
         return
 
+    def test_interval_union_lengths(self):
+        import numpy
+        from samsum import alignment_utils
+        group_ids = numpy.array([1, 0, 1, 1, 0, 1])
+        starts = numpy.array([50, 10, 1, 120, 15, 100])
+        ends = numpy.array([60, 20, 51, 130, 30, 120])
+        self.assertEqual([20, 89], list(alignment_utils.interval_union_lengths(group_ids, starts, ends, 2)))
+        return
+
+    def test_covered_intervals(self):
+        import numpy
+        from samsum import alignment_utils
+        group_ids = numpy.array([1, 0, 1, 1, 0, 1])
+        starts = numpy.array([50, 10, 1, 120, 15, 100])
+        ends = numpy.array([60, 20, 51, 130, 30, 120])
+        groups, merged_starts, merged_ends = alignment_utils.covered_intervals(group_ids, starts, ends)
+        self.assertEqual([(0, 10, 30), (1, 1, 60), (1, 100, 130)],
+                         list(zip(groups.tolist(), merged_starts.tolist(), merged_ends.tolist())))
+        # Merging the intervals again doesn't change them
+        self.assertEqual([0, 1, 1], alignment_utils.covered_intervals(groups, merged_starts, merged_ends)[0].tolist())
+        return
+
+    def test_load_reference_columns(self):
+        from samsum import alignment_utils
+        from samsum import file_parsers
+        from .testing_utils import get_test_data
+        test_bam = get_test_data("samsum_test_2.bam")
+        seq_lengths = file_parsers.fasta_seq_lengths(get_test_data("samsum_test_2.fasta"))
+        col_refs = alignment_utils.load_references(seq_lengths)
+        ext_refs = alignment_utils.load_references(seq_lengths)
+        columns = file_parsers.sam_columns_ext(test_bam, True, 10, 0)
+        ref_stats = file_parsers.sam_coverage_ext(test_bam, True, 10, 0)
+        self.assertEqual(alignment_utils.load_reference_stats(ext_refs, ref_stats),
+                         alignment_utils.load_reference_columns(col_refs, columns))
+        for name, ref_seq in ext_refs.items():
+            self.assertEqual(ref_seq.reads_mapped, col_refs[name].reads_mapped)
+            self.assertEqual(ref_seq.covered, col_refs[name].covered)
+            self.assertEqual(ref_seq.rightmost, col_refs[name].rightmost)
+        return
+
+    def test_load_reference_depths(self):
+        import os
+        import numpy
+        from samsum import alignment_utils
+        from samsum import file_parsers
+        from .testing_utils import get_test_data
+        test_bam = get_test_data("samsum_test_2.bam")
+        depth_file = get_test_data("samsum_test_2_depths.bin")
+        seq_lengths = file_parsers.fasta_seq_lengths(get_test_data("samsum_test_2.fasta"))
+        refseq_dict = alignment_utils.load_references(seq_lengths)
+        columns = file_parsers.sam_columns_ext(test_bam, True, 10, 0)
+        alignment_utils.load_reference_columns(refseq_dict, columns)
+        in_memory = alignment_utils.load_reference_depths(refseq_dict, columns)
+        mapped = alignment_utils.load_reference_depths(refseq_dict, columns, depth_file)
+        self.assertTrue(numpy.array_equal(in_memory, mapped))
+        for ref_seq in refseq_dict.values():
+            self.assertEqual(ref_seq.length, len(ref_seq.depth_profile))
+            self.assertAlmostEqual(ref_seq.depth*ref_seq.length, ref_seq.depth_profile.sum())
+            self.assertAlmostEqual(ref_seq.covered, numpy.count_nonzero(ref_seq.depth_profile)/ref_seq.length)
+        del mapped
+        os.remove(depth_file)
+        return
+
+    def test_window_coverage(self):
+        import numpy
+        from samsum import alignment_utils
+        from samsum import file_parsers
+        from .testing_utils import get_test_data
+        seq_lengths = file_parsers.fasta_seq_lengths(get_test_data("samsum_test_2.fasta"))
+        refseq_dict = alignment_utils.load_references(seq_lengths)
+        columns = file_parsers.sam_columns_ext(get_test_data("samsum_test_2.bam"), True, 10, 0)
+        alignment_utils.load_reference_columns(refseq_dict, columns)
+        alignment_utils.load_reference_depths(refseq_dict, columns)
+        windows = alignment_utils.window_coverage(refseq_dict, columns, window_size=100)
+        self.assertAlmostEqual(sum(ref_seq.weight_total for ref_seq in refseq_dict.values()), windows["weight"].sum())
+        for i in range(len(windows["ref_index"])):
+            ref_seq = refseq_dict[windows["names"][windows["ref_index"][i]]]
+            depths = ref_seq.depth_profile[windows["start"][i]-1:windows["end"][i]]
+            self.assertAlmostEqual(depths.mean(), windows["depth"][i])
+            self.assertAlmostEqual(numpy.count_nonzero(depths)/len(depths), windows["covered"][i])
+        # A single window spanning each reference sequence is equivalent to the reference sequence's stats
+        windows = alignment_utils.window_coverage(refseq_dict, columns, num_windows=1)
+        for i in range(len(windows["ref_index"])):
+            ref_seq = refseq_dict[windows["names"][windows["ref_index"][i]]]
+            self.assertAlmostEqual(ref_seq.covered, windows["covered"][i])
+        # Every reference sequence is split into exactly num_windows windows, even if its length isn't a multiple
+        windows = alignment_utils.window_coverage(refseq_dict, columns, num_windows=7)
+        self.assertEqual([7] * len(refseq_dict), numpy.bincount(windows["ref_index"]).tolist())
+        self.assertAlmostEqual(sum(ref_seq.weight_total for ref_seq in refseq_dict.values()), windows["weight"].sum())
+        for i in range(len(windows["ref_index"])):
+            ref_seq = refseq_dict[windows["names"][windows["ref_index"][i]]]
+            depths = ref_seq.depth_profile[windows["start"][i]-1:windows["end"][i]]
+            self.assertAlmostEqual(depths.mean(), windows["depth"][i])
+            self.assertAlmostEqual(numpy.count_nonzero(depths)/len(depths), windows["covered"][i])
+        return
+
+    def test_ref_table(self):
+        from samsum import alignment_utils
+        from samsum import classy
+        references = alignment_utils.load_references({"contig_1 desc": 1000, "contig_2": 2000, "contig_3": 500})
+        self.assertEqual(["contig_1", "contig_2", "contig_3"], list(references))
+        self.assertEqual("contig_1 desc", references["contig_1"].name)
+        # RefSequence views read and write their row of the table
+        references["contig_1"].weight_total = 10.0
+        references["contig_2"].weight_total = 30.0
+        references["contig_1"].covered = 0.8
+        references["contig_2"].covered = 0.2
+        self.assertEqual(30.0, references.weight_total[1])
+        # The vectorised normalization must match that of individual RefSequence instances
+        alignment_utils.calculate_normalization_metrics(references, 60.0)
+        ref_seq = classy.RefSequence("contig_2", 2000)
+        ref_seq.weight_total = 30.0
+        ref_seq.calc_fpkm(100.0)
+        self.assertAlmostEqual(ref_seq.fpkm, references["contig_2"].fpkm)
+        self.assertAlmostEqual(1E6, references.tpm.sum())
+        self.assertEqual(30.0, alignment_utils.proportion_filter(references, 50))
+        self.assertEqual(0.0, references["contig_2"].tpm)
+        return
+
+    def test_ref_table_add_stats(self):
+        from samsum import alignment_utils
+        references = alignment_utils.load_references({"contig_1": 1000, "contig_2": 2000})
+        # Repeated rows, and stats added to a row by separate calls, are summed
+        references.add_stats([0, 0, 1], [2, 3, 1], [1.0, 1.5, 0.5], [200, 300, 100], [150, 250, 100],
+                             [10, 500, 20], [160, 800, 120])
+        self.assertEqual(5, references["contig_1"].reads_mapped)
+        self.assertAlmostEqual(0.5, references["contig_1"].depth)
+        self.assertAlmostEqual(0.4, references["contig_1"].covered)
+        self.assertEqual(10, references["contig_1"].leftmost)
+        self.assertEqual(800, references["contig_1"].rightmost)
+        references.add_stats([1], [4], [2.0], [300], [200], [1000], [1300])
+        self.assertEqual(5, references["contig_2"].reads_mapped)
+        self.assertAlmostEqual(2.5, references["contig_2"].weight_total)
+        self.assertAlmostEqual(0.2, references["contig_2"].depth)
+        self.assertAlmostEqual(0.15, references["contig_2"].covered)
+        self.assertAlmostEqual(0.5, references["contig_1"].depth)
+        return
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -60,6 +60,288 @@ class MyTestCase(unittest.TestCase):
                 self.assertTrue(match.end < ref_seq_lengths[match.subject])
         return
 
+    def test_reference_seq_lengths(self) -> None:
+        from samsum import file_parsers as ss_fp
+        header_lengths = ss_fp.reference_seq_lengths(self.test_sam)
+        self.assertEqual(ss_fp.fasta_seq_lengths(self.test_ref_fa), header_lengths)
+        self.assertEqual(header_lengths, ss_fp.reference_seq_lengths(get_test_data("samsum_test_2.bam")))
+        self.assertEqual(header_lengths, ss_fp.reference_seq_lengths(self.test_sam, self.test_ref_fa))
+        # The FASTA must contain every reference sequence in the header
+        with self.assertRaises(SystemExit):
+            ss_fp.reference_seq_lengths(self.test_sam, self.test_fa)
+        return
+
+    def test_name_grouped(self) -> None:
+        import tempfile
+        from samsum import file_parsers as ss_fp
+        ref_stats = ss_fp.sam_coverage_ext(self.test_sam, True, 10, 0)
+        # The alignments in the test SAM file are already grouped by read name
+        self.assertEqual(ref_stats, ss_fp.sam_coverage_ext(self.test_sam, True, 10, 0, name_grouped=True))
+
+        # Grouping is also detected from the header's @HD line
+        with tempfile.NamedTemporaryFile('w', suffix=".sam", delete=False) as sam_handler:
+            sam_handler.write("@HD\tVN:1.6\tSO:queryname\n")
+            with open(self.test_sam) as orig_handler:
+                sam_handler.write(orig_handler.read())
+        try:
+            self.assertEqual(ref_stats, ss_fp.sam_coverage_ext(sam_handler.name, True, 10, 0))
+        finally:
+            os.remove(sam_handler.name)
+        return
+
+    def test_coordinate_sorted(self) -> None:
+        import tempfile
+        from samsum import file_parsers as ss_fp
+        with open(self.test_sam) as orig_handler:
+            lines = orig_handler.readlines()
+        header = [line for line in lines if line.startswith('@')]
+        ref_order = {line.split("\t")[1][3:]: i for i, line in enumerate(header)}
+        alignments = sorted([line for line in lines if not line.startswith('@')],
+                            key=lambda x: (ref_order.get(x.split("\t")[2], len(ref_order)), int(x.split("\t")[3])))
+        with tempfile.NamedTemporaryFile('w', suffix=".sam", delete=False) as sam_handler:
+            sam_handler.write("@HD\tVN:1.6\tSO:coordinate\n")
+            sam_handler.writelines(header + alignments)
+        try:
+            for multireads in [False, True]:
+                ref_stats = ss_fp.sam_coverage_ext(self.test_sam, multireads, 10, 0)
+                sorted_stats = ss_fp.sam_coverage_ext(sam_handler.name, multireads, 10, 0)
+                self.assertEqual(set(ref_stats), set(sorted_stats))
+                for ref_name, stats in ref_stats.items():
+                    if ref_name == "UNMAPPED":
+                        self.assertAlmostEqual(stats, sorted_stats[ref_name], places=3)
+                        continue
+                    self.assertEqual(stats[0], sorted_stats[ref_name][0])
+                    self.assertAlmostEqual(stats[1], sorted_stats[ref_name][1], places=3)
+                    self.assertEqual(stats[2:], sorted_stats[ref_name][2:])
+
+            # Alignments out of order are detected
+            with open(sam_handler.name, 'w') as unsorted_handler:
+                unsorted_handler.writelines(["@HD\tVN:1.6\tSO:coordinate\n"] + lines)
+            with self.assertRaises(ValueError):
+                ss_fp.sam_coverage_ext(sam_handler.name, False, 10, 0)
+        finally:
+            os.remove(sam_handler.name)
+        return
+
+    def test_parallel_sam(self) -> None:
+        import random
+        import tempfile
+        from samsum import file_parsers as ss_fp
+        # Shuffle the alignments so the alignments of many reads are split between the byte ranges
+        with open(self.test_sam) as orig_handler:
+            lines = orig_handler.readlines()
+        alignments = [line for line in lines if not line.startswith('@')]
+        random.Random(7).shuffle(alignments)
+        with tempfile.NamedTemporaryFile('w', suffix=".sam", delete=False) as sam_handler:
+            sam_handler.writelines([line for line in lines if line.startswith('@')] + alignments)
+        try:
+            for sam_file in [self.test_sam, sam_handler.name]:
+                for multireads in [False, True]:
+                    ref_stats = ss_fp.sam_coverage_ext(sam_file, multireads, 10, 0)
+                    columns = ss_fp.sam_columns_ext(sam_file, multireads, 10, 0)
+                    for threads in [2, 5]:
+                        self.assertEqual(ref_stats, ss_fp.sam_coverage_ext(sam_file, multireads, 10, 0, threads))
+                        parallel_columns = ss_fp.sam_columns_ext(sam_file, multireads, 10, 0, threads)
+                        self.assertEqual(columns["ref_names"], parallel_columns["ref_names"])
+                        self.assertEqual(columns["unmapped"], parallel_columns["unmapped"])
+                        for name in ["ref_id", "start", "end", "weight", "mapq", "read_length"]:
+                            self.assertEqual(columns[name].tolist(), parallel_columns[name].tolist())
+        finally:
+            os.remove(sam_handler.name)
+        return
+
+    def test_sam_byte_ranges(self) -> None:
+        from samsum import file_parsers as ss_fp
+        # The byte ranges between read boundaries hold every alignment of the file, in order, with the same weights
+        size = os.path.getsize(self.test_sam)
+        bounds = [0] + [ss_fp.next_read_offset(self.test_sam, size*i//5) for i in range(1, 5)] + [size]
+        self.assertEqual(bounds, sorted(bounds))
+        self.assertEqual(size, ss_fp.next_read_offset(self.test_sam, size + 10))
+        with open(self.test_sam, 'rb') as sam_handler:
+            sam_text = sam_handler.read()
+        for bound in bounds[1:-1]:
+            previous_line = sam_text[sam_text.rindex(b"\n", 0, bound - 1) + 1:bound]
+            self.assertNotEqual(previous_line.split(b"\t")[0], sam_text[bound:].split(b"\t")[0])
+
+        columns = ss_fp.sam_columns_ext(self.test_sam, True, 10, 0)
+        parts = [ss_fp.sam_columns_ext(self.test_sam, True, 10, 0, byte_range=(beg, end))
+                 for beg, end in zip(bounds, bounds[1:])]
+        self.assertEqual(columns["unmapped"], sum(part["unmapped"] for part in parts))
+        for name in ["start", "end", "weight"]:
+            self.assertEqual(columns[name].tolist(), [x for part in parts for x in part[name].tolist()])
+        # The reference sequences of the columns are numbered in the order they are aligned to in each range
+        self.assertEqual([columns["ref_names"][i] for i in columns["ref_id"]],
+                         [part["ref_names"][i] for part in parts for i in part["ref_id"]])
+
+        # Only the lines of SAM files can be found from a byte offset
+        with self.assertRaises(ValueError):
+            ss_fp.sam_columns_ext(get_test_data("samsum_test_2.bam"), True, 10, 0, byte_range=(0, 100))
+        return
+
+    def test_unterminated_sam(self) -> None:
+        import tempfile
+        from samsum import file_parsers as ss_fp
+        # The last alignment is parsed even if the file doesn't end with a newline
+        with open(self.test_sam) as orig_handler:
+            sam_text = orig_handler.read()
+        with tempfile.NamedTemporaryFile('w', suffix=".sam", delete=False) as sam_handler:
+            sam_handler.write(sam_text.rstrip("\n"))
+        try:
+            self.assertEqual(ss_fp.sam_coverage_ext(self.test_sam, True, 10, 0),
+                             ss_fp.sam_coverage_ext(sam_handler.name, True, 10, 0))
+        finally:
+            os.remove(sam_handler.name)
+        return
+
+    def test_truncated_bam(self) -> None:
+        import tempfile
+        from samsum import file_parsers as ss_fp
+        test_bam = get_test_data("samsum_test_2.bam")
+        with open(test_bam, 'rb') as bam_handler:
+            bam_bytes = bam_handler.read()
+        self.assertTrue(ss_fp.check_bgzf_eof(test_bam))
+        with tempfile.NamedTemporaryFile('wb', suffix=".bam", delete=False) as bam_handler:
+            bam_handler.write(bam_bytes[:600000])
+        try:
+            # A file that ends within a BGZF block can't be parsed, whether the blocks are decompressed in parallel or not
+            self.assertFalse(ss_fp.check_bgzf_eof(bam_handler.name))
+            for threads in [1, 4]:
+                with self.assertRaises(SystemExit):
+                    ss_fp.sam_coverage_ext(bam_handler.name, True, 10, 0, threads)
+            with self.assertRaises(SystemExit):
+                ss_fp.sam_parser_ext(bam_handler.name, True, 10, 0)
+
+            # Without the EOF marker the file may have been truncated between blocks, which is only warned about
+            with open(bam_handler.name, 'wb') as truncated_handler:
+                truncated_handler.write(bam_bytes[:-len(ss_fp.BGZF_EOF)])
+            self.assertFalse(ss_fp.check_bgzf_eof(bam_handler.name))
+            self.assertEqual(ss_fp.sam_coverage_ext(test_bam, True, 10, 0),
+                             ss_fp.sam_coverage_ext(bam_handler.name, True, 10, 0))
+        finally:
+            os.remove(bam_handler.name)
+        return
+
+    def test_regions(self) -> None:
+        import tempfile
+        from samsum import file_parsers as ss_fp
+        sorted_bam = get_test_data("samsum_test_2.sorted.bam")
+        ref_lengths = ss_fp.reference_seq_lengths(sorted_bam)
+        ref_stats = ss_fp.sam_coverage_ext(sorted_bam, False, 10, 0)
+        total_weight = sum(stats[1] for stats in ref_stats.values())
+
+        # Restricting the alignments to every reference sequence changes nothing but the unmapped weight, which is
+        # estimated from the index. It doesn't tell supplementary records apart, so the file's one is counted too
+        regions = ss_fp.resolve_regions(list(ref_lengths), ref_lengths)
+        restricted_stats = ss_fp.sam_coverage_ext(sorted_bam, False, 10, 0, regions=regions)
+        self.assertEqual(ref_stats["UNMAPPED"][1] + 0.5, restricted_stats.pop("UNMAPPED")[1])
+        self.assertEqual({name: stats for name, stats in ref_stats.items() if name != "UNMAPPED"}, restricted_stats)
+
+        # Only the selected reference sequences are returned but the total fragment weight is unchanged
+        selected = sorted([name for name in ref_stats if name != "UNMAPPED"], key=lambda x: -ref_stats[x][0])[:2]
+        with tempfile.NamedTemporaryFile('w', suffix=".bed", delete=False) as bed_handler:
+            bed_handler.write("track name=markers\n")
+            for seq_name in selected:
+                bed_handler.write("%s\t0\t%d\n" % (seq_name, ref_lengths[seq_name]))
+            bed_handler.write("%s\t100\t2000\n" % selected[0])
+        try:
+            regions = ss_fp.resolve_regions(ss_fp.read_regions(bed_file=bed_handler.name), ref_lengths)
+        finally:
+            os.remove(bed_handler.name)
+        restricted_stats = ss_fp.sam_coverage_ext(sorted_bam, False, 10, 0, regions=regions)
+        self.assertEqual(3, len(restricted_stats))
+        for seq_name in restricted_stats:
+            if seq_name != "UNMAPPED":
+                self.assertEqual(ref_stats[seq_name], restricted_stats[seq_name])
+        self.assertAlmostEqual(total_weight + 0.5, sum(stats[1] for stats in restricted_stats.values()))
+
+        # Fragments of a paired library are weighed as such even when the regions hold no reads
+        empty = [name for name in ref_lengths if name not in ref_stats or ref_stats[name][0] == 0][0]
+        restricted_stats = ss_fp.sam_coverage_ext(sorted_bam, False, 10, 0, regions=[(empty, 0, ref_lengths[empty])])
+        self.assertEqual(total_weight + 0.5, restricted_stats["UNMAPPED"][1])
+
+        # Only part of a reference sequence
+        regions = [(selected[0], 0, ref_lengths[selected[0]]//2)]
+        restricted_stats = ss_fp.sam_coverage_ext(sorted_bam, False, 10, 0, regions=regions)
+        self.assertLess(restricted_stats[regions[0][0]][0], ref_stats[regions[0][0]][0])
+
+        # FPKM values are only changed by the estimate of the total fragments when restricting the reference sequences
+        from samsum import commands
+        full_abundances = commands.ref_sequence_abundances(sorted_bam, p_cov=0)
+        restricted_abundances = commands.ref_sequence_abundances(sorted_bam, p_cov=0, regions=selected)
+        self.assertEqual(set(selected), set(restricted_abundances.keys()))
+        for seq_name in selected:
+            self.assertAlmostEqual(1, restricted_abundances[seq_name].fpkm/full_abundances[seq_name].fpkm, places=3)
+
+        index_stats = ss_fp.bam_index_stats(sorted_bam)
+        self.assertEqual(set(ref_lengths).union({'*'}), set(index_stats))
+        # An index is required
+        with self.assertRaises(SystemExit):
+            ss_fp.sam_coverage_ext(get_test_data("samsum_test_2.bam"), False, 10, 0, regions=regions)
+        return
+
+    @staticmethod
+    def write_fai(fasta_file: str, indexed_file=None) -> str:
+        """ Writes a FASTA index of fasta_file as samtools faidx does, named after indexed_file if it is given """
+        entries = []
+        offset = 0
+        with open(fasta_file, 'rb') as fasta_handler:
+            for line in fasta_handler:
+                if line.startswith(b'>'):
+                    entries.append([line[1:].split()[0].decode(), 0, offset + len(line), 0, 0])
+                elif line.strip():
+                    if entries[-1][3] == 0:
+                        entries[-1][3:] = [len(line.rstrip(b"\r\n")), len(line)]
+                    entries[-1][1] += len(line.rstrip(b"\r\n"))
+                offset += len(line)
+        fai_file = (indexed_file or fasta_file) + ".fai"
+        with open(fai_file, 'w') as fai_handler:
+            for entry in entries:
+                fai_handler.write("\t".join(str(field) for field in entry) + "\n")
+        return fai_file
+
+    def test_reference_catalogue(self) -> None:
+        import gzip
+        import shutil
+        import tempfile
+        from samsum import file_parsers as ss_fp
+        ref_seq_lengths = ss_fp.fasta_seq_lengths(self.test_ref_fa)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            # The first call writes the catalogue and the second reads it
+            self.assertEqual(ref_seq_lengths, ss_fp.fasta_seq_lengths(self.test_ref_fa, cache_dir=cache_dir))
+            catalogue_file = ss_fp.catalogue_path(self.test_ref_fa, cache_dir)
+            self.assertTrue(os.path.isfile(catalogue_file))
+            names, lengths = ss_fp.read_reference_catalogue(catalogue_file, ss_fp.fasta_signature(self.test_ref_fa))
+            self.assertEqual(list(ref_seq_lengths), names)
+            self.assertEqual(list(ref_seq_lengths.values()), lengths.tolist())
+            self.assertEqual(ref_seq_lengths, ss_fp.fasta_seq_lengths(self.test_ref_fa, cache_dir=cache_dir))
+            # A catalogue that doesn't match the FASTA is ignored
+            self.assertIsNone(ss_fp.read_reference_catalogue(catalogue_file, ss_fp.fasta_signature(self.test_fa)))
+
+            # Gzip-compressed FASTA files and FASTA indices are also supported
+            gz_fasta = os.path.join(cache_dir, "ref.fasta.gz")
+            with open(self.test_ref_fa, 'rb') as fa_handler, gzip.open(gz_fasta, 'wb', compresslevel=1) as gz_handler:
+                shutil.copyfileobj(fa_handler, gz_handler)
+            self.assertEqual(ref_seq_lengths, ss_fp.fasta_seq_lengths(gz_fasta, cache_dir=cache_dir))
+            self.assertEqual(ref_seq_lengths, ss_fp.fai_seq_lengths(self.write_fai(self.test_ref_fa, gz_fasta), gz_fasta))
+            # An index that doesn't match the FASTA file is ignored
+            with open(gz_fasta + ".fai", 'w') as fai_handler:
+                fai_handler.write("seq_1\t100\t7\t60\t61\n")
+            self.assertEqual({}, ss_fp.fai_seq_lengths(gz_fasta + ".fai", gz_fasta))
+            self.assertEqual(ref_seq_lengths, ss_fp.fasta_seq_lengths(gz_fasta))
+
+            # The full names are read from the FASTA file even though the index only holds the first word
+            fasta_file = os.path.join(cache_dir, "described.fasta")
+            shutil.copy(self.test_fa, fasta_file)
+            fai_file = self.write_fai(fasta_file)
+            with open(fai_file) as fai_handler:
+                self.assertEqual(["contig", "contig"], [line.split("\t")[0] for line in fai_handler])
+            self.assertEqual({"contig 1": 16, "contig 2": 25}, ss_fp.fai_seq_lengths(fai_file, fasta_file))
+            self.assertEqual(ss_fp.fasta_seq_lengths(self.test_fa), ss_fp.fasta_seq_lengths(fasta_file))
+        finally:
+            shutil.rmtree(cache_dir)
+        return
+
     def test_fasta_reader(self) -> None:
         from samsum import file_parsers as ss_fp
         ref_seq_lengths = ss_fp.fasta_seq_lengths(fasta_file=self.test_fa)
@@ -31,6 +31,148 @@ class SamModuleTester(unittest.TestCase):
         self.assertEqual(8, len(mapping_list))
         return
 
+    def test_get_reference_coverage(self):
+        from samsum import _sam_module
+        test_sam = get_test_data('samsum_test_2.sam')
+        ref_stats = _sam_module.get_reference_coverage(test_sam, True, 10, 0)
+        mapping_list = _sam_module.get_mapped_reads(test_sam, True, 10, 0, 'q')
+        # The statistics summed while parsing must match those from the individual alignments
+        self.assertEqual(mapping_list[-1].weight, ref_stats["UNMAPPED"][1])
+        self.assertEqual(len(mapping_list) - 1, sum(stats[0] for stats in ref_stats.values()))
+        self.assertEqual(sum(match.weight for match in mapping_list[:-1]),
+                         sum(stats[1] for stats in ref_stats.values()) - ref_stats["UNMAPPED"][1])
+        reads_mapped, weight_total, bases_mapped, bases_covered, leftmost, rightmost = \
+            ref_stats['AB-755_P22_E10_NODE_6_length_36342_cov_2156.57_ID_21']
+        self.assertEqual(10, reads_mapped)
+        self.assertEqual(5.0, weight_total)
+        self.assertTrue(leftmost < rightmost)
+        self.assertTrue(bases_covered <= bases_mapped)
+        return
+
+    def test_bam_parser(self):
+        from samsum import _sam_module
+        sam_stats = _sam_module.get_reference_coverage(get_test_data('samsum_test_2.sam'), True, 10, 0)
+        bam_stats = _sam_module.get_reference_coverage(get_test_data('samsum_test_2.bam'), True, 10, 0)
+        self.assertEqual(sam_stats, bam_stats)
+        # Decompressing the BGZF blocks in parallel must not change the results
+        self.assertEqual(bam_stats, _sam_module.get_reference_coverage(get_test_data('samsum_test_2.bam'),
+                                                                        True, 10, 0, 4))
+        bam_list = _sam_module.get_mapped_reads(get_test_data('samsum_test_2.bam'), True, 10, 0, 'q')
+        sam_list = _sam_module.get_mapped_reads(get_test_data('samsum_test_2.sam'), True, 10, 0, 'q')
+        self.assertEqual(sorted((m.query, m.subject, m.start, m.end, m.cigar) for m in sam_list),
+                         sorted((m.query, m.subject, m.start, m.end, m.cigar) for m in bam_list))
+        return
+
+    def test_get_reference_alignments(self):
+        import itertools
+        from samsum import _sam_module
+        for aln_file in [get_test_data('samsum_test_2.sam'), get_test_data('samsum_test_2.bam')]:
+            mapping_list = _sam_module.get_mapped_reads(aln_file, True, 10, 0, 'q')
+            grouped = _sam_module.get_reference_alignments(aln_file, True, 10, 0)
+            # The groups match those from sorting the list by reference name, with the order of alignments kept
+            expected = {ref: [(m.query, m.start, m.cigar, m.weight) for m in group]
+                        for ref, group in itertools.groupby(sorted(mapping_list, key=lambda x: x.subject),
+                                                            lambda x: x.subject)}
+            self.assertEqual(expected, {ref: [(m.query, m.start, m.cigar, m.weight) for m in group]
+                                        for ref, group in grouped.items()})
+            self.assertEqual(1, len(grouped["UNMAPPED"]))
+        return
+
+    def test_match_ref_ids(self):
+        from samsum import _sam_module
+        from samsum import file_parsers as ss_fp
+        for aln_file in [get_test_data('samsum_test_2.sam'), get_test_data('samsum_test_2.bam')]:
+            ref_names = list(ss_fp.reference_seq_lengths(aln_file))
+            mapping_list = _sam_module.get_mapped_reads(aln_file, True, 10, 0, 'q')
+            unmapped = mapping_list.pop()
+            self.assertEqual((-1, "UNMAPPED"), (unmapped.ref_id, unmapped.subject))
+            for match in mapping_list:
+                self.assertEqual(ref_names[match.ref_id], match.subject)
+            # The alignments to a reference sequence share a single copy of its name
+            self.assertEqual(len({match.ref_id for match in mapping_list}),
+                             len({id(match.subject) for match in mapping_list}))
+
+        match = _sam_module.MATCH(start=1, end=50, weight=1.0, query="read_1", cigar="50M", subject="NODE_1",
+                                  read_length=50, percent_id=1.0)
+        self.assertEqual(("read_1", "NODE_1", "50M"), (match.query, match.subject, match.cigar))
+        return
+
+    def test_filter_thresholds(self):
+        from samsum import _sam_module
+        test_sam = get_test_data('samsum_test_2.sam')
+        mapping_list = _sam_module.get_mapped_reads(test_sam, True, 0, 0, 'q')
+        total_weight = sum(match.weight for match in mapping_list)
+        for aln_percent, min_mq in [(90, 0), (0, 20), (50, 20)]:
+            filtered_list = _sam_module.get_mapped_reads(test_sam, True, aln_percent, min_mq, 'q')
+            unmapped = filtered_list.pop()
+            self.assertTrue(len(filtered_list) < len(mapping_list) - 1)
+            for match in filtered_list:
+                self.assertTrue(100 * (match.end - match.start) / match.read_length >= aln_percent)
+            # The weight of the filtered alignments is added to the unmapped fragments
+            self.assertAlmostEqual(total_weight, unmapped.weight + sum(match.weight for match in filtered_list), 3)
+        return
+
+    def test_progress_callback(self):
+        import threading
+        from samsum import _sam_module
+        test_sam = get_test_data('samsum_test_2.sam')
+        reports = []
+        mapping_list = _sam_module.get_mapped_reads(test_sam, True, 10, 0, 'q',
+                                                    lambda *counts: reports.append(counts), 0)
+        lines, num_bytes, mapped, unmapped = reports[-1]
+        self.assertEqual(os.path.getsize(test_sam), num_bytes)
+        # Every aligned line is counted, including those that are later filtered
+        self.assertEqual((10001, 233, 9768), (lines, mapped, unmapped))
+        self.assertEqual(reports, sorted(reports))
+
+        # The summed statistics report the same counts
+        coverage_reports = []
+        _sam_module.get_reference_coverage(test_sam, True, 10, 0, 1, 0, None, None,
+                                           lambda *counts: coverage_reports.append(counts), 0)
+        self.assertEqual(reports[-1], coverage_reports[-1])
+
+        # Exceptions raised by the callback stop parsing
+        def interrupt(*counts):
+            raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            _sam_module.get_mapped_reads(test_sam, True, 10, 0, 'q', interrupt, 0)
+        with self.assertRaises(KeyboardInterrupt):
+            _sam_module.get_reference_coverage(test_sam, True, 10, 0, 1, 0, None, None, interrupt, 0)
+        with self.assertRaises(TypeError):
+            _sam_module.get_mapped_reads(test_sam, True, 10, 0, 'q', 1)
+
+        # Files can be parsed by other threads
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            _sam_module.get_mapped_reads(test_sam, True, 10, 0, 'q')))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(mapping_list), len(results[0]))
+        return
+
+    def test_logging(self):
+        import tempfile
+        from samsum import _sam_module
+        test_bam = get_test_data('samsum_test_2.sorted.bam')
+        # The extension's messages go to Python's logging rather than being written to stdout
+        stdout_fd = os.dup(1)
+        with tempfile.TemporaryFile() as stdout_handler:
+            os.dup2(stdout_handler.fileno(), 1)
+            try:
+                with self.assertLogs(level="INFO") as logs:
+                    _sam_module.get_reference_coverage(test_bam, True, 10, 0)
+                    _sam_module.get_mapped_reads(test_bam, True, 10, 0, 'q')
+            finally:
+                os.dup2(stdout_fd, 1)
+                os.close(stdout_fd)
+            stdout_handler.seek(0)
+            self.assertEqual(b"", stdout_handler.read())
+        messages = "".join(record.getMessage() for record in logs.records)
+        self.assertEqual(2, messages.count("Parsing alignment file " + test_bam))
+        self.assertIn("Alignments are sorted by coordinate", messages)
+        self.assertEqual(2, messages.count("Summary for " + test_bam))
+        return
+
     def test_load_sam(self):
         test_aln_data = ["query_read_name", "1", "5S145M", "0", "1.0"]
         self.alignment_dat_example.load_sam(test_aln_data)
@@ -56,6 +198,22 @@ class SamModuleTester(unittest.TestCase):
         self.assertEqual(19, self.alignment_dat_example.decode_cigar())
         self.assertEqual(120, self.alignment_dat_example.read_length)
 
+        from samsum import _sam_module
+        self.assertEqual((19, 150, 101, 30), _sam_module.decode_cigar(cigar_str_1))
+        self.assertEqual((19, 120, 101, 0), _sam_module.decode_cigar(cigar_str_2))
+        self.assertEqual((25, 23, 0, 4), _sam_module.decode_cigar("5H10M2I5D3N7=4S"))
+        self.assertEqual((0, 0, 0, 0), _sam_module.decode_cigar("*"))
+
+        # The lengths are decoded while parsing, identically for text and binary CIGARs
+        sam_list = _sam_module.get_mapped_reads(get_test_data('samsum_test_2.sam'), True, 0, 0, 'q')
+        bam_list = _sam_module.get_mapped_reads(get_test_data('samsum_test_2.bam'), True, 0, 0, 'q')
+        for match in sam_list[:-1]:
+            aln_len, read_length, clip_start, clip_end = _sam_module.decode_cigar(match.cigar)
+            self.assertEqual((match.start + aln_len, read_length, clip_start, clip_end),
+                             (match.end, match.read_length, match.clip_start, match.clip_end))
+        self.assertEqual(sorted((m.query, m.end, m.read_length, m.clip_start, m.clip_end) for m in sam_list),
+                         sorted((m.query, m.end, m.read_length, m.clip_start, m.clip_end) for m in bam_list))
+
         return
 
     def test_ref_sequence_abundances(self):
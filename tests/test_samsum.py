@@ -11,12 +11,20 @@ class SamsumTester(unittest.TestCase):
     def setUp(self) -> None:
         self.test_fasta = get_test_data("samsum_test_2.fasta")
         self.test_sam = get_test_data("samsum_test_2.sam")
+        self.test_bam = get_test_data("samsum_test_2.bam")
         self.output_tbl = os.path.join("tests/tmp_table.tsv")
+        self.window_tbl = os.path.join("tests/tmp_table_windows.tsv")
+        self.merged_tbl = os.path.join("tests/tmp_merged_table.tsv")
+        self.single_end_sam = os.path.join("tests/tmp_single_end.sam")
+        self.matrix_prefix = os.path.join("tests/tmp_matrix")
+        self.matrix_tbls = [self.matrix_prefix + "_" + metric + ".tsv" for metric in ["Coverage", "Fragments",
+                                                                                       "FPKM", "TPM"]]
         return
 
     def tearDown(self) -> None:
-        if os.path.isfile(self.output_tbl):
-            os.remove(self.output_tbl)
+        for table in [self.output_tbl, self.window_tbl, self.merged_tbl, self.single_end_sam] + self.matrix_tbls:
+            if os.path.isfile(table):
+                os.remove(table)
         return
 
     def test_main(self):
@@ -48,6 +56,313 @@ class SamsumTester(unittest.TestCase):
                                   "--map_quality", str(1),
                                   "--sep", "\t"])
         self.assertEqual(0, retcode)
+
+        # Test with a BAM file decompressed by multiple threads
+        retcode = commands.stats(["--ref_fasta", self.test_fasta,
+                                  "--alignments", self.test_bam,
+                                  "--output_table", self.output_tbl,
+                                  "--threads", str(2)])
+        self.assertEqual(0, retcode)
+
+        # Test without the reference FASTA, using the lengths in the BAM header
+        retcode = commands.stats(["--alignments", self.test_bam,
+                                  "--output_table", self.output_tbl])
+        self.assertEqual(0, retcode)
+
+        # Test the windowed coverage table
+        retcode = commands.stats(["--ref_fasta", self.test_fasta,
+                                  "--alignments", self.test_bam,
+                                  "--output_table", self.output_tbl,
+                                  "--window_size", str(1000)])
+        self.assertEqual(0, retcode)
+        self.assertTrue(os.path.isfile(self.window_tbl))
+
+        # Test restricting the reference sequences using the BAM index. The numbers of fragments are unchanged, while
+        # FPKM and TPM are estimated relative to the whole file
+        import csv
+        sorted_bam = get_test_data("samsum_test_2.sorted.bam")
+        retcode = commands.stats(["--alignments", sorted_bam,
+                                  "--output_table", self.output_tbl,
+                                  "--seq_coverage", str(0)])
+        self.assertEqual(0, retcode)
+        with open(self.output_tbl) as table_handler:
+            full_rows = {row["RefSequence"]: row for row in csv.DictReader(table_handler)}
+        selected = sorted([name for name in full_rows if name != "UNMAPPED"],
+                          key=lambda x: -float(full_rows[x]["Fragments"]))[:5]
+        refs_file = os.path.join("tests/tmp_refs.txt")
+        with open(refs_file, 'w') as refs_handler:
+            refs_handler.write("\n".join(selected) + "\n")
+        try:
+            retcode = commands.stats(["--alignments", sorted_bam,
+                                      "--output_table", self.merged_tbl,
+                                      "--seq_coverage", str(0),
+                                      "--refs", refs_file])
+        finally:
+            os.remove(refs_file)
+        self.assertEqual(0, retcode)
+        with open(self.merged_tbl) as table_handler:
+            restricted_rows = {row["RefSequence"]: row for row in csv.DictReader(table_handler)}
+        self.assertEqual(set(selected + ["UNMAPPED"]), set(restricted_rows))
+        for seq_name in selected:
+            full_row, restricted_row = full_rows[seq_name], restricted_rows[seq_name]
+            self.assertEqual(full_row["Fragments"], restricted_row["Fragments"])
+            self.assertAlmostEqual(1, float(restricted_row["FPKM"])/float(full_row["FPKM"]), delta=0.001)
+            self.assertAlmostEqual(1, float(restricted_row["TPM"])/float(full_row["TPM"]), delta=0.03)
+
+        # BED regions select whole reference sequences, as coverage and abundances are reported over their full length
+        from samsum import file_parsers as ss_fp
+        ref_lengths = ss_fp.reference_seq_lengths(sorted_bam)
+        bed_file = os.path.join("tests/tmp_regions.bed")
+        try:
+            with open(bed_file, 'w') as bed_handler:
+                bed_handler.write("".join("%s\t0\t%d\n" % (name, ref_lengths[name]) for name in selected))
+            retcode = commands.stats(["--alignments", sorted_bam,
+                                      "--output_table", self.output_tbl,
+                                      "--seq_coverage", str(0),
+                                      "--regions", bed_file])
+            self.assertEqual(0, retcode)
+            with open(self.output_tbl) as bed_table, open(self.merged_tbl) as refs_table:
+                self.assertEqual(sorted(refs_table.readlines()), sorted(bed_table.readlines()))
+            with open(bed_file, 'w') as bed_handler:
+                bed_handler.write("%s\t1000\t3000\n" % selected[0])
+            with pytest.raises(SystemExit):
+                commands.stats(["--alignments", sorted_bam,
+                                "--output_table", self.output_tbl,
+                                "--regions", bed_file])
+        finally:
+            os.remove(bed_file)
+        return
+
+    def test_samsum_multi(self):
+        """ Integrative test for samsum multi, comparing each sample's column with the table from samsum stats """
+        import csv
+        import shutil
+        from samsum import commands
+        with pytest.raises(SystemExit):
+            commands.multi(["-h"])
+        # The columns must have unique sample names
+        with pytest.raises(SystemExit):
+            commands.multi(["--alignments", self.test_sam, self.test_bam,
+                            "--output_prefix", self.matrix_prefix])
+
+        # The sample names come from the file names, so the SAM file is copied to be a second sample
+        copy_sam = os.path.join("tests/tmp_copy.sam")
+        sorted_bam = get_test_data("samsum_test_2.sorted.bam")
+        shutil.copy(self.test_sam, copy_sam)
+        try:
+            for threads, memory in [("1", "0"), ("2", "0"), ("2", "1")]:
+                retcode = commands.multi(["--ref_fasta", self.test_fasta,
+                                          "--alignments", self.test_sam, sorted_bam, copy_sam,
+                                          "--output_prefix", self.matrix_prefix,
+                                          "--map_quality", str(1),
+                                          "--sep", "\t",
+                                          "--threads", threads,
+                                          "--memory", memory])
+                self.assertEqual(0, retcode)
+                with open(self.matrix_prefix + "_TPM.tsv") as matrix_handler:
+                    tpm = list(csv.reader(matrix_handler, delimiter="\t"))
+                self.assertEqual(["RefSequence", "samsum_test_2", "samsum_test_2.sorted", "tmp_copy"], tpm[0])
+        finally:
+            os.remove(copy_sam)
+        # The SAM and BAM files have the same alignments, whichever process summarized them
+        self.assertTrue(all(row[1] == row[2] == row[3] for row in tpm[1:]))
+
+        commands.stats(["--ref_fasta", self.test_fasta,
+                        "--alignments", self.test_sam,
+                        "--output_table", self.output_tbl,
+                        "--map_quality", str(1),
+                        "--sep", "\t"])
+        with open(self.output_tbl) as table_handler:
+            table = {row[1]: row for row in csv.reader(table_handler, delimiter="\t")}
+        self.assertEqual({row[0]: row[1] for row in tpm[1:]}, {name: row[6] for name, row in table.items()
+                                                               if name not in ["RefSequence", "UNMAPPED"]})
+        with open(self.matrix_prefix + "_Fragments.tsv") as matrix_handler:
+            unmapped = list(csv.reader(matrix_handler, delimiter="\t"))[1]
+        self.assertEqual(["UNMAPPED"] + [str(round(float(table["UNMAPPED"][4]), 3))] * 3, unmapped)
+        return
+
+    def test_samsum_merge(self):
+        """ Integrative test for samsum merge, which must reproduce the table of a single samsum stats run """
+        import zlib
+        from samsum import commands
+        with pytest.raises(SystemExit):
+            commands.merge(["-h"])
+
+        # Split the alignments into chunks, keeping all alignments of a read together
+        chunk_files = [os.path.join("tests/tmp_chunk_%d.sam" % i) for i in range(3)]
+        chunk_handlers = [open(chunk_file, 'w') for chunk_file in chunk_files]
+        with open(self.test_sam) as sam_handler:
+            for line in sam_handler:
+                if line.startswith('@'):
+                    for chunk_handler in chunk_handlers:
+                        chunk_handler.write(line)
+                else:
+                    chunk_handlers[zlib.crc32(line.split('\t')[0].encode()) % 3].write(line)
+        for chunk_handler in chunk_handlers:
+            chunk_handler.close()
+
+        stats_files = [chunk_file + ".npz" for chunk_file in chunk_files]
+        try:
+            for chunk_file, stats_file in zip(chunk_files, stats_files):
+                retcode = commands.stats(["--alignments", chunk_file,
+                                          "--output_table", self.output_tbl,
+                                          "--aln_percent", str(50),
+                                          "--multireads",
+                                          "--stats_output", stats_file])
+                self.assertEqual(0, retcode)
+            retcode = commands.merge(["--stats_files"] + stats_files +
+                                     ["--output_table", self.merged_tbl,
+                                      "--seq_coverage", str(20),
+                                      "--query_name", "samsum_test_2"])
+            self.assertEqual(0, retcode)
+            # Statistics of alignments parsed with different thresholds can't be merged
+            commands.stats(["--alignments", chunk_files[0],
+                            "--output_table", self.output_tbl,
+                            "--stats_output", stats_files[0]])
+            with pytest.raises(SystemExit):
+                commands.merge(["--stats_files"] + stats_files + ["--output_table", self.merged_tbl])
+        finally:
+            for tmp_file in chunk_files + stats_files:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+
+        retcode = commands.stats(["--alignments", self.test_sam,
+                                  "--output_table", self.output_tbl,
+                                  "--aln_percent", str(50),
+                                  "--seq_coverage", str(20),
+                                  "--multireads"])
+        self.assertEqual(0, retcode)
+        with open(self.output_tbl) as table_handler, open(self.merged_tbl) as merged_handler:
+            self.assertEqual(table_handler.read(), merged_handler.read())
+        return
+
+    def test_samsum_stats_follow(self):
+        """ Test that following a SAM file or stdin in batches writes the same table as summarizing the whole file """
+        import io
+        import sys
+        from unittest import mock
+        from samsum import commands
+        retcode = commands.stats(["--alignments", self.test_sam,
+                                  "--output_table", self.output_tbl,
+                                  "--aln_percent", str(30),
+                                  "--seq_coverage", str(20)])
+        self.assertEqual(0, retcode)
+        with open(self.output_tbl) as table_handler:
+            table = table_handler.readlines()
+
+        retcode = commands.stats(["--alignments", self.test_sam,
+                                  "--output_table", self.merged_tbl,
+                                  "--aln_percent", str(30),
+                                  "--seq_coverage", str(20),
+                                  "--follow", "--update_records", str(1000), "--idle_timeout", str(0)])
+        self.assertEqual(0, retcode)
+        with open(self.merged_tbl) as table_handler:
+            self.assertEqual(table, table_handler.readlines())
+
+        with open(self.test_sam, 'rb') as sam_handler:
+            with mock.patch.object(sys, "stdin", io.TextIOWrapper(sam_handler)):
+                retcode = commands.stats(["--alignments", "-",
+                                          "--output_table", self.merged_tbl,
+                                          "--aln_percent", str(30),
+                                          "--seq_coverage", str(20),
+                                          "--follow", "--update_records", str(2000)])
+        self.assertEqual(0, retcode)
+        with open(self.merged_tbl) as table_handler:
+            self.assertEqual([line.replace("samsum_test_2", "stdin", 1) for line in table],
+                             table_handler.readlines())
+        return
+
+    def test_samsum_stats_follow_single_end(self):
+        """ Test that batches holding only unmapped single-end reads are not weighted as paired fragments """
+        import io
+        import sys
+        from unittest import mock
+        from samsum import commands
+        # Rewrite the paired alignments as single-end reads with the unmapped reads at the end of the file
+        header, mapped, unmapped = [], [], []
+        with open(self.test_sam) as sam_handler:
+            for line in sam_handler:
+                if line.startswith('@'):
+                    header.append(line)
+                    continue
+                fields = line.split("\t")
+                flag = int(fields[1])
+                fields[0] += "/2" if flag & 0x80 else "/1"
+                fields[1] = str(flag & ~(0x1 | 0x2 | 0x8 | 0x20 | 0x40 | 0x80))
+                fields[6:9] = ["*", "0", "0"]
+                if fields[2] == '*':
+                    unmapped.append("\t".join(fields))
+                else:
+                    mapped.append("\t".join(fields))
+        with open(self.single_end_sam, 'w') as sam_handler:
+            sam_handler.writelines(header + mapped + unmapped)
+
+        retcode = commands.stats(["--alignments", self.single_end_sam,
+                                  "--output_table", self.output_tbl])
+        self.assertEqual(0, retcode)
+        with open(self.output_tbl) as table_handler:
+            table = table_handler.readlines()
+
+        with open(self.single_end_sam, 'rb') as sam_handler:
+            with mock.patch.object(sys, "stdin", io.TextIOWrapper(sam_handler)):
+                retcode = commands.stats(["--alignments", "-",
+                                          "--output_table", self.merged_tbl,
+                                          "--follow", "--update_records", str(300)])
+        self.assertEqual(0, retcode)
+        with open(self.merged_tbl) as table_handler:
+            self.assertEqual([line.replace("tmp_single_end", "stdin", 1) for line in table],
+                             table_handler.readlines())
+        return
+
+    def test_samsum_stats_resume(self):
+        """ Test that a run interrupted after a checkpoint resumes from it and writes the same table """
+        from unittest import mock
+        from samsum import commands
+        from samsum import file_parsers as ss_fp
+        checkpoint = os.path.join("tests/tmp_checkpoint.npz")
+        stats_args = ["--alignments", self.test_sam,
+                      "--output_table", self.merged_tbl,
+                      "--aln_percent", str(30),
+                      "--seq_coverage", str(20),
+                      "--name_grouped",
+                      "--multireads"]
+        retcode = commands.stats(stats_args[:2] + ["--output_table", self.output_tbl] + stats_args[4:])
+        self.assertEqual(0, retcode)
+        with open(self.output_tbl) as table_handler:
+            table = table_handler.read()
+
+        # Interrupt the run once the first part has been checkpointed
+        sam_columns_ext = ss_fp.sam_columns_ext
+        parts = []
+
+        def interrupted_columns(*args, **kwargs):
+            parts.append(args[-1])
+            if len(parts) > 1:
+                raise KeyboardInterrupt
+            return sam_columns_ext(*args, **kwargs)
+        try:
+            with mock.patch.object(ss_fp, "sam_columns_ext", interrupted_columns):
+                with pytest.raises(KeyboardInterrupt):
+                    commands.stats(stats_args + ["--checkpoint", checkpoint, "--checkpoint_interval", str(1)])
+            self.assertTrue(os.path.isfile(checkpoint))
+            self.assertFalse(os.path.isfile(self.merged_tbl))
+
+            # The checkpoint must be of a run with the same filters
+            with pytest.raises(SystemExit):
+                commands.stats(stats_args[:-1] + ["--checkpoint", checkpoint, "--resume"])
+
+            with mock.patch.object(ss_fp, "sam_columns_ext", side_effect=sam_columns_ext) as resumed_columns:
+                retcode = commands.stats(stats_args + ["--checkpoint", checkpoint, "--resume",
+                                                       "--checkpoint_interval", str(1)])
+            self.assertEqual(0, retcode)
+            # The part parsed before the interruption isn't parsed again
+            self.assertEqual(parts[1], resumed_columns.call_args_list[0][0][-1])
+            self.assertFalse(os.path.isfile(checkpoint))
+        finally:
+            if os.path.isfile(checkpoint):
+                os.remove(checkpoint)
+        with open(self.merged_tbl) as table_handler:
+            self.assertEqual(table, table_handler.read())
         return
 
 